@@ -16,6 +16,49 @@ NAME_PREFIX = "ci"
 # HuggingFace AuthToken
 HF_TOKEN = 'hf_xxxx'
 DZ_MAX_SPEAKERS = 2
+# Chunks decoded together by the transcription endpoint, 1 decodes one chunk at a time
+TRANSCRIBE_BATCH_SIZE = 8
+# Transcription endpoint hardware. For a CPU endpoint (e.g. ml.c6i.8xlarge) use WHISPER_DEVICE "cpu" with
+# WHISPER_COMPUTE_TYPE "int8" and set WHISPER_CPU_THREADS to the number of vCPUs
+TRANSCRIBE_INSTANCE_TYPE = "ml.g5.2xlarge"
+WHISPER_MODEL_SIZE = "large-v2"
+WHISPER_DEVICE = "auto"
+WHISPER_COMPUTE_TYPE = ""
+WHISPER_CPU_THREADS = 0
+# Voice activity filter before decoding: "off", "energy" or "silero"
+TRANSCRIBE_VAD = "off"
+# "jsonl" has the transcription endpoint write one packed transcript per conversation, "txt" one file per chunk
+TRANSCRIPT_FORMAT = "txt"
+# Convert MP3 uploads to 16 kHz mono 16-bit WAV, the format the diarization and transcription models use
+NORMALIZE_AUDIO = False
+# "json" has the diarization endpoint return segments with float second timings next to pyannote's text output
+DIARIZATION_FORMAT = "txt"
+# With the jsonl format, speaker turns shorter than CHUNK_MIN_SECONDS are merged into one transcription chunk and
+# turns longer than CHUNK_MAX_SECONDS are split. CHUNK_MIN_SECONDS = 0 keeps one chunk per turn
+CHUNK_MIN_SECONDS = 0
+CHUNK_MAX_SECONDS = 30
+CHUNK_MAX_GAP_SECONDS = 1.5
+# Calls up to these limits are converted and chunked in Lambda instead of AWS Batch, 0 always uses Batch. Lambda
+# runs up to 15 minutes with 10 GB of memory, long calls stay on Batch
+LAMBDA_MAX_CONTENT_LENGTH_MB = 0
+LAMBDA_MAX_DURATION_SECONDS = 600
+LAMBDA_PROCESSING_MEMORY_MB = 4096
+# Transcripts up to these limits get sentiment and entities from the synchronous Comprehend batch APIs instead of
+# asynchronous jobs, 0 always starts jobs. Every line must also be under the 5,000 byte limit of the batch APIs
+COMPREHEND_SYNC_MAX_LINES = 0
+COMPREHEND_SYNC_MAX_BYTES = 64 * 1024
+# Run the Comprehend jobs of longer transcripts together, one sentiment and one entities job over the transcripts of
+# every conversation queued within COMPREHEND_AGGREGATION_WINDOW_MINUTES, instead of two jobs per conversation
+COMPREHEND_AGGREGATION = False
+COMPREHEND_AGGREGATION_WINDOW_MINUTES = 5
+COMPREHEND_AGGREGATION_MAX_CONVERSATIONS = 500
+# Bounds of the wait between two checks of an endpoint result or Comprehend job, in between it follows the length
+# of the call, the processing time observed on earlier conversations and the retries
+POLLING_MIN_WAIT_SECONDS = 10
+POLLING_MAX_WAIT_SECONDS = 600
+# Endpoint results still missing this long after the request, or after 3 times the expected processing time when that
+# is longer, are given up on
+POLLING_MAX_ELAPSED_SECONDS = 3600
 
 # General Naming Constants
 S3_ML_OUTPUT_BUCKET = "process"  # Adding Hyphen as S3 name can only be Hyphen
@@ -34,6 +77,14 @@ SSM_LLM_CALLBACK_PROMPT = "ci_callback_prompt"
 SSM_LLM_POLITE_PROMPT = "ci_politeness_prompt"
 SSM_LLM_AGENT_SENTIMENT_PROMPT = "ci_agent_sentiment_prompt"
 SSM_LLM_CUSTOMER_SENTIMENT_PROMPT = "ci_customer_sentiment_prompt"
+SSM_LLM_COMBINED_PROMPT = "ci_combined_insights_prompt"
+
+# Bedrock limits for the summarization Lambda, per Lambda container
+BEDROCK_MAX_WORKERS = 3
+BEDROCK_REQUESTS_PER_MINUTE = 20
+BEDROCK_TOKENS_PER_MINUTE = 200000
+# "per_prompt" sends one Bedrock request per prompt, "combined" asks for all insights in one JSON answer
+SUMMARIZE_MODE = "per_prompt"
 
 CI_DIARIZATION_ENDPOINT_PARAM = "ci-diarization-endpoint"
 CI_TRANSCRIPTION_ENDPOINT_PARAM = "ci-transcription-endpoint"
@@ -25,9 +25,10 @@ class SpeakerDiarizationStack:
     :param model_execution_role: Execution Role required for SageMaker Model / Container
     :param ml_processing_bucket: Bucket where all files are processed and output stored
     :param sagemaker_invocation_policy: Invocation policy that should be attached to the SageMaker model
+    :param async_notification_config: SNS topics notified when an async inference completes or fails
     """
     def __init__(self, cdk_scope, model_execution_role,
-                 ml_processing_bucket, sagemaker_invocation_policy):
+                 ml_processing_bucket, sagemaker_invocation_policy, async_notification_config):
 
         # Speaker Diarization Image
         diarization_image = DockerImageAsset(
@@ -61,11 +62,14 @@ class SpeakerDiarizationStack:
             instance_type="ml.g5.2xlarge",
             initial_instance_count=1,
             initial_variant_weight=1,
+            # The container reports healthy only after the pipeline has been loaded on the GPU
+            container_startup_health_check_timeout_in_seconds=600,
         )
 
         async_config = sagemaker.CfnEndpointConfig.AsyncInferenceConfigProperty(
             output_config=sagemaker.CfnEndpointConfig.AsyncInferenceOutputConfigProperty(
-                s3_output_path=f"s3://{ml_processing_bucket.bucket_name}/diarization/"
+                s3_output_path=f"s3://{ml_processing_bucket.bucket_name}/diarization/",
+                notification_config=async_notification_config,
             ),
             client_config=sagemaker.CfnEndpointConfig.AsyncInferenceClientConfigProperty(
                 max_concurrent_invocations_per_instance=2
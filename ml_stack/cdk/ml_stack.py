@@ -5,6 +5,8 @@ import cfg
 from aws_cdk import (
     aws_iam as iam,
     aws_s3 as s3,
+    aws_sagemaker as sagemaker,
+    aws_sns as sns,
     Stack,
     CfnOutput,
 )
@@ -35,6 +37,15 @@ class MLStack(Stack):
             encryption=s3.BucketEncryption.S3_MANAGED,
         )
 
+        # SageMaker publishes to these when an async inference completes or fails, the server stack resumes the
+        # workflow waiting for the result
+        async_success_topic = sns.Topic(self, "async_inference_success_topic")
+        async_error_topic = sns.Topic(self, "async_inference_error_topic")
+        async_notification_config = sagemaker.CfnEndpointConfig.AsyncInferenceNotificationConfigProperty(
+            success_topic=async_success_topic.topic_arn,
+            error_topic=async_error_topic.topic_arn,
+        )
+
         model_execution_role = iam.Role(
             self,
             "model_execution_role",
@@ -113,6 +124,11 @@ class MLStack(Stack):
                         "s3:PutObjectVersionTagging",
                     ],
                 ),
+                iam.PolicyStatement(
+                    effect=iam.Effect.ALLOW,
+                    resources=[async_success_topic.topic_arn, async_error_topic.topic_arn],
+                    actions=["sns:Publish"],
+                ),
             ],
         )
         model_execution_role.add_managed_policy(
@@ -132,6 +148,7 @@ class MLStack(Stack):
             ml_processing_bucket=ml_output_bucket,
             sagemaker_invocation_policy=sagemaker_invocation_policy,
             model_execution_role=model_execution_role,
+            async_notification_config=async_notification_config,
         )
 
         TranscriptionStack(
@@ -139,6 +156,7 @@ class MLStack(Stack):
             ml_processing_bucket=ml_output_bucket,
             sagemaker_invocation_policy=sagemaker_invocation_policy,
             model_execution_role=model_execution_role,
+            async_notification_config=async_notification_config,
         )
 
         CfnOutput(
@@ -147,3 +165,17 @@ class MLStack(Stack):
             value=ml_output_bucket.bucket_arn,
             export_name="ml-process-bucket",
         )
+
+        CfnOutput(
+            self,
+            "ml_async_success_topic",
+            value=async_success_topic.topic_arn,
+            export_name="ml-async-success-topic",
+        )
+
+        CfnOutput(
+            self,
+            "ml_async_error_topic",
+            value=async_error_topic.topic_arn,
+            export_name="ml-async-error-topic",
+        )
@@ -25,10 +25,11 @@ class TranscriptionStack:
     :param model_execution_role: Execution Role required for SageMaker Model / Container
     :param ml_processing_bucket: Bucket where all files are processed and output stored
     :param sagemaker_invocation_policy: Invocation policy that should be attached to the SageMaker model
+    :param async_notification_config: SNS topics notified when an async inference completes or fails
     """
 
     def __init__(self, cdk_scope, model_execution_role, ml_processing_bucket,
-                 sagemaker_invocation_policy):
+                 sagemaker_invocation_policy, async_notification_config):
         # Transcription ML Endpoint
         transcription_image = DockerImageAsset(
             cdk_scope,
@@ -55,7 +56,15 @@ class TranscriptionStack:
             image_config=sagemaker.CfnModel.ImageConfigProperty(
                 repository_access_mode="Platform",
             ),
-            environment={"HF_AUTH_TOKEN": cfg.HF_TOKEN},
+            environment={
+                "HF_AUTH_TOKEN": cfg.HF_TOKEN,
+                "TRANSCRIBE_BATCH_SIZE": str(cfg.TRANSCRIBE_BATCH_SIZE),
+                "WHISPER_MODEL_SIZE": cfg.WHISPER_MODEL_SIZE,
+                "WHISPER_DEVICE": cfg.WHISPER_DEVICE,
+                "WHISPER_COMPUTE_TYPE": cfg.WHISPER_COMPUTE_TYPE,
+                "WHISPER_CPU_THREADS": str(cfg.WHISPER_CPU_THREADS),
+                "TRANSCRIBE_VAD": cfg.TRANSCRIBE_VAD,
+            },
         )
 
         transcription_model = sagemaker.CfnModel(
@@ -71,14 +80,15 @@ class TranscriptionStack:
         transcription_variant = sagemaker.CfnEndpointConfig.ProductionVariantProperty(
             model_name="transcription-model" + cfg.ML_MODEL_SUFFIX,
             variant_name=transcription_variant_name,
-            instance_type="ml.g5.2xlarge",
+            instance_type=cfg.TRANSCRIBE_INSTANCE_TYPE,
             initial_instance_count=1,
             initial_variant_weight=1,
         )
 
         transcription_async_config = sagemaker.CfnEndpointConfig.AsyncInferenceConfigProperty(
             output_config=sagemaker.CfnEndpointConfig.AsyncInferenceOutputConfigProperty(
-                s3_output_path=f"s3://{ml_processing_bucket.bucket_name}/transcription/"
+                s3_output_path=f"s3://{ml_processing_bucket.bucket_name}/transcription/",
+                notification_config=async_notification_config,
             ),
             client_config=sagemaker.CfnEndpointConfig.AsyncInferenceClientConfigProperty(
                 max_concurrent_invocations_per_instance=2
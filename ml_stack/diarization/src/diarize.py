@@ -7,10 +7,13 @@ import json
 import os
 import random
 import string
+import threading
 import time
+import wave
 
 import boto3
 import flask
+import numpy as np
 import torch
 from flask import request
 from pyannote.audio import Audio
@@ -24,6 +27,9 @@ os.environ['TRANSFORMERS_CACHE'] = nfs_path+'/huggingface/models'
 os.environ['PYANNOTE_CACHE'] = nfs_path+'/huggingface'
 hf_auth_token = os.environ.get("HF_AUTH_TOKEN", "")
 diarization_max_speakers = int(os.environ.get("DZ_MAX_SPEAKERS", 2))
+# Attempts to load the pipeline at start up before the worker exits, the wait between them doubles
+warm_up_attempts = int(os.environ.get("WARM_UP_ATTEMPTS", 5))
+warm_up_retry_seconds = 10
 
 prefix = "/opt/ml/"
 model_path = os.path.join(prefix, "model")
@@ -36,9 +42,61 @@ spacermilli = 2000
 # This is constraining the whole process to two speakers.
 # Need to change if the solution should support more speakers
 speakers = {'SPEAKER_00': ('Agent',), 'SPEAKER_01': ('Customer',)}
+# Sample rate the pyannote pipeline works at
+sampling_rate = 16000
 app = flask.Flask(__name__)
 
 
+class DiarizationService(object):
+    """
+    Holds the pyannote pipeline for the lifetime of the worker process, so weights are loaded and moved to
+    the GPU once instead of on every request.
+    """
+    pipeline = None
+    load_seconds = None
+    lock = threading.Lock()
+
+    @classmethod
+    def get_pipeline(cls):
+        with cls.lock:
+            if cls.pipeline is None:
+                fn_start = time.time()
+                cls.pipeline = Pipeline.from_pretrained('pyannote/speaker-diarization-3.0',
+                                                        use_auth_token=hf_auth_token).to(device)
+                cls.load_seconds = time.time() - fn_start
+                print(f'Time taken for loading diarization pipeline is : {str(cls.load_seconds)}')
+        return cls.pipeline
+
+    @classmethod
+    def is_ready(cls):
+        return cls.pipeline is not None
+
+    @classmethod
+    def load_with_retries(cls):
+        """
+        :return: True once the pipeline is loaded, False when every attempt failed
+        """
+        for attempt in range(1, warm_up_attempts + 1):
+            try:
+                cls.get_pipeline()
+                return True
+            except Exception as e:
+                print(f"Failed to load diarization pipeline, attempt {attempt} of {warm_up_attempts}: {str(e)}")
+                if attempt < warm_up_attempts:
+                    time.sleep(warm_up_retry_seconds * 2 ** (attempt - 1))
+        return False
+
+    @classmethod
+    def warm_up(cls):
+        def load():
+            if not cls.load_with_retries():
+                # /ping would report loading forever, exit so the worker is started again
+                print("Giving up loading diarization pipeline, exiting worker")
+                os._exit(1)
+
+        threading.Thread(target=load, daemon=True).start()
+
+
 def generate_random_string(length=20):
     characters = string.ascii_letters + string.digits
     random_string = ''.join(random.choice(characters) for _ in range(length))
@@ -80,19 +138,67 @@ def download_s3_file(s3_uri, local_path):
         print(f"An error occurred: {str(e)}")
 
 
-def diarization(wav_file_path):
+def load_waveform(wav_file_path):
+    """
+    Reads WAVs that are already 16 kHz mono 16-bit PCM straight into a tensor. Anything else is downmixed and
+    resampled by pyannote.
+
+    :return: (waveform, sample_rate) with waveform shaped (1, samples)
+    """
+    try:
+        with wave.open(wav_file_path, "rb") as wav_file:
+            if (wav_file.getnchannels(), wav_file.getframerate(), wav_file.getsampwidth()) == (1, sampling_rate, 2):
+                pcm = np.frombuffer(wav_file.readframes(wav_file.getnframes()), dtype=np.int16)
+                return torch.from_numpy(pcm.astype(np.float32) / 32768.0).unsqueeze(0), sampling_rate
+    except (wave.Error, EOFError):
+        # Not plain PCM, e.g. float or extensible WAVs
+        pass
+    io = Audio(mono='downmix', sample_rate=sampling_rate)
+    return io(wav_file_path)
+
+
+def diarization_document(dz):
+    """
+    Machine readable diarization with float second timings, keeping pyannote's text output alongside it.
+
+    :return: {"version": 1, "segments": [{"start", "end", "speaker"}], "text": legacy text}
+    """
+    segments = []
+    for segment, _, speaker in dz.itertracks(yield_label=True):
+        segments.append({"start": segment.start, "end": segment.end, "speaker": speaker})
+    return {"version": 1, "segments": segments, "text": str(dz)}
+
+
+def diarization(wav_file_path, timings, output_format="txt"):
+    """
+    :param output_format: txt writes pyannote's text output, json the document from diarization_document
+    :return: Path of the written diarization file
+    """
     print(f"Starting Speaker diarization of {wav_file_path}")
     fn_start = time.time()
-    
-    pipeline = Pipeline.from_pretrained('pyannote/speaker-diarization-3.0',
-                                        use_auth_token=hf_auth_token).to(device)
-    io = Audio(mono='downmix', sample_rate=16000)
-    waveform, sample_rate = io(wav_file_path)
+
+    # Only waits for the model when the request arrives before warm up has finished
+    step_start = time.time()
+    pipeline = DiarizationService.get_pipeline()
+    timings['model_wait'] = time.time() - step_start
+
+    step_start = time.time()
+    waveform, sample_rate = load_waveform(wav_file_path)
+    timings['audio_load'] = time.time() - step_start
+
+    step_start = time.time()
     dz = pipeline({"waveform": waveform, "sample_rate": sample_rate}, max_speakers=diarization_max_speakers)
-    diarization_file_path = wav_file_path.replace('.wav', '') + '_diarization.txt'
+    timings['inference'] = time.time() - step_start
+    timings['audio_seconds'] = waveform.shape[-1] / sample_rate
+    diarization_file_path = wav_file_path.replace('.wav', '') + '_diarization.' + output_format
 
+    step_start = time.time()
     with open(diarization_file_path, "w") as text_file:
-        text_file.write(str(dz))
+        if output_format == "json":
+            json.dump(diarization_document(dz), text_file)
+        else:
+            text_file.write(str(dz))
+    timings['write'] = time.time() - step_start
 
     print(f'Time taken for Speaker Diarization of {wav_file_path} is : {str(time.time() - fn_start)}')
     return diarization_file_path
@@ -100,6 +206,9 @@ def diarization(wav_file_path):
 
 @app.route("/ping", methods=["GET"])
 def ping():
+    # Report healthy only once the pipeline is loaded, so no request lands on a cold worker
+    if not DiarizationService.is_ready():
+        return flask.Response(response=json.dumps({"message": "loading"}), status=503, mimetype="application/json")
     return {"message": "ok"}
 
 
@@ -112,15 +221,27 @@ def diarize():
 
     input_location = data['input_location']
     task = data['task']
+    output_format = "json" if data.get('output_format') == "json" else "txt"
 
+    request_start = time.time()
+    timings = dict()
     input_audio_file_name = nfs_path+generate_random_string(20)+'.wav'
     download_s3_file(input_location, input_audio_file_name)
+    timings['download'] = time.time() - request_start
 
-    diarization_file_path = diarization(input_audio_file_name)
+    diarization_file_path = diarization(input_audio_file_name, timings, output_format)
     print("Diarizatio Completed, result path is:", diarization_file_path)
     result_file = open(diarization_file_path, "r")
     res = result_file.read()
     result_file.close()
 
-    return flask.Response(response=res, status=200, mimetype="text/plain")
+    timings['model_load'] = DiarizationService.load_seconds
+    timings['total'] = time.time() - request_start
+    print(f"Diarization timings for {input_location}: {json.dumps(timings)}")
+
+    mimetype = "application/json" if output_format == "json" else "text/plain"
+    return flask.Response(response=res, status=200, mimetype=mimetype)
+
 
+# Start loading the pipeline as soon as the worker imports this module
+DiarizationService.warm_up()
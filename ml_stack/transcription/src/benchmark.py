@@ -0,0 +1,163 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  SPDX-License-Identifier: MIT-0
+
+# Benchmark for the transcription container. Run it inside the container image, e.g.
+#
+#   python3 benchmark.py --batch-sizes 1,4,8,16
+#   python3 benchmark.py --chunks-dir /tmp/chunks --batch-sizes 1,8
+#   python3 benchmark.py --shared-decode
+#   python3 benchmark.py --configs cuda:float16,cpu:int8,cpu:float32 --cpu-threads 8 --batch-sizes 1,8
+#
+# Without --chunks-dir a synthetic conversation is generated. Synthetic chunks are good enough to compare
+# throughput between settings but not to compare transcript quality. The real-time factor (RTF) is the
+# processing time divided by the audio duration, lower is better.
+
+import argparse
+import os
+import tempfile
+import time
+import wave
+
+import numpy as np
+
+import transcribe
+
+
+def generate_chunks(directory, count, min_seconds, max_seconds, seed=7):
+    """
+    Writes count 16 kHz mono WAV chunks with random durations. Each chunk is a few modulated tones with
+    noise, which keeps the decoder busy roughly like speech does.
+    """
+    rng = np.random.default_rng(seed)
+    for idx in range(count):
+        duration = rng.uniform(min_seconds, max_seconds)
+        t = np.arange(int(duration * transcribe.sampling_rate)) / transcribe.sampling_rate
+        signal = np.zeros_like(t)
+        for freq in rng.uniform(120, 900, size=3):
+            signal += np.sin(2 * np.pi * freq * t) * (0.5 + 0.5 * np.sin(2 * np.pi * rng.uniform(1, 4) * t))
+        signal = signal / 3 * 0.3 + rng.normal(0, 0.02, size=t.shape)
+        pcm = (np.clip(signal, -1, 1) * 32767).astype(np.int16)
+        with wave.open(os.path.join(directory, f"{idx}.wav"), "wb") as wav_file:
+            wav_file.setnchannels(1)
+            wav_file.setsampwidth(2)
+            wav_file.setframerate(transcribe.sampling_rate)
+            wav_file.writeframes(pcm.tobytes())
+
+
+def audio_seconds(voice_files):
+    total = 0.0
+    for voice_file in voice_files:
+        with wave.open(voice_file, "rb") as wav_file:
+            total += wav_file.getnframes() / wav_file.getframerate()
+    return total
+
+
+def run(voice_files, pass_groups, repeats):
+    """
+    :param pass_groups: List of whisper task lists, each list is one pass over the chunks
+    :return: Fastest wall time over the repeats
+    """
+    elapsed = []
+    for _ in range(repeats):
+        fn_start = time.time()
+        for whisper_tasks in pass_groups:
+            for _ in transcribe.TranslateService.decode_files(voice_files, whisper_tasks):
+                pass
+        elapsed.append(time.time() - fn_start)
+    return min(elapsed)
+
+
+def benchmark_batch_sizes(voice_files, batch_sizes, whisper_task, repeats):
+    seconds = audio_seconds(voice_files)
+    print(f"{len(voice_files)} chunks, {seconds:.1f}s of audio, task {whisper_task}")
+    print(f"{'batch size':>10} {'seconds':>10} {'RTF':>8}")
+    for batch_size in batch_sizes:
+        transcribe.transcribe_batch_size = batch_size
+        elapsed = run(voice_files, [[whisper_task]], repeats)
+        print(f"{batch_size:>10} {elapsed:>10.2f} {elapsed / seconds:>8.4f}")
+
+
+def benchmark_shared_decode(voice_files, batch_sizes, repeats):
+    """
+    Compares translate_transcribe decoded as two separate passes against one pass that loads the audio and
+    detects the language once per chunk.
+    """
+    seconds = audio_seconds(voice_files)
+    print(f"{len(voice_files)} chunks, {seconds:.1f}s of audio, task translate_transcribe")
+    print(f"{'batch size':>10} {'separate':>10} {'shared':>10} {'speedup':>8}")
+    for batch_size in batch_sizes:
+        transcribe.transcribe_batch_size = batch_size
+        separate = run(voice_files, [["translate"], ["transcribe"]], repeats)
+        shared = run(voice_files, [["translate", "transcribe"]], repeats)
+        print(f"{batch_size:>10} {separate:>10.2f} {shared:>10.2f} {separate / shared:>8.2f}")
+
+
+def load_model(config, cpu_threads):
+    """
+    Switches the transcription service to another device and compute type.
+
+    :param config: device:compute_type, e.g. cpu:int8
+    """
+    transcribe.device, transcribe.compute_type = config.split(":")
+    transcribe.cpu_threads = cpu_threads
+    transcribe.TranslateService.model = None
+    transcribe.TranslateService.batched_model = None
+    load_start = time.time()
+    transcribe.TranslateService.get_model()
+    return time.time() - load_start
+
+
+def benchmark_configs(voice_files, configs, batch_sizes, whisper_task, repeats, cpu_threads):
+    seconds = audio_seconds(voice_files)
+    print(f"{len(voice_files)} chunks, {seconds:.1f}s of audio, task {whisper_task}, model {transcribe.model_size}")
+    print(f"{'config':>16} {'load':>8} {'batch size':>10} {'seconds':>10} {'RTF':>8}")
+    for config in configs:
+        load_seconds = load_model(config, cpu_threads)
+        transcribe.TranslateService.decode(voice_files[0], whisper_task)
+        for batch_size in batch_sizes:
+            transcribe.transcribe_batch_size = batch_size
+            elapsed = run(voice_files, [[whisper_task]], repeats)
+            print(f"{config:>16} {load_seconds:>8.1f} {batch_size:>10} {elapsed:>10.2f} {elapsed / seconds:>8.4f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Transcription container benchmark")
+    parser.add_argument("--chunks-dir", help="Directory with WAV chunks, synthetic chunks are used if omitted")
+    parser.add_argument("--chunks", type=int, default=64, help="Number of synthetic chunks")
+    parser.add_argument("--min-seconds", type=float, default=1.0, help="Shortest synthetic chunk")
+    parser.add_argument("--max-seconds", type=float, default=20.0, help="Longest synthetic chunk")
+    parser.add_argument("--batch-sizes", default="1,4,8,16", help="Comma separated batch sizes")
+    parser.add_argument("--task", default="transcribe", choices=["transcribe", "translate"])
+    parser.add_argument("--repeats", type=int, default=1, help="Runs per setting, the fastest one is reported")
+    parser.add_argument("--shared-decode", action="store_true",
+                        help="Compare separate and shared decoding of translate_transcribe")
+    parser.add_argument("--configs", help="Comma separated device:compute_type list, e.g. cuda:float16,cpu:int8")
+    parser.add_argument("--model-size", help="Whisper model, the WHISPER_MODEL_SIZE setting is used if omitted")
+    parser.add_argument("--cpu-threads", type=int, default=transcribe.cpu_threads, help="Threads per CPU decode")
+    args = parser.parse_args()
+
+    chunks_dir = args.chunks_dir
+    if not chunks_dir:
+        chunks_dir = tempfile.mkdtemp(prefix="chunks-", dir=transcribe.nfs_path)
+        generate_chunks(chunks_dir, args.chunks, args.min_seconds, args.max_seconds)
+    voice_files = transcribe.list_files_in_directory(chunks_dir)
+    if args.model_size:
+        transcribe.model_size = args.model_size
+
+    batch_sizes = [int(batch_size) for batch_size in args.batch_sizes.split(",")]
+    if args.configs:
+        benchmark_configs(voice_files, args.configs.split(","), batch_sizes, args.task, args.repeats,
+                          args.cpu_threads)
+        return
+
+    # Load the model and warm up the GPU before timing anything
+    transcribe.TranslateService.decode(voice_files[0], args.task)
+
+    if args.shared_decode:
+        benchmark_shared_decode(voice_files, batch_sizes, args.repeats)
+    else:
+        benchmark_batch_sizes(voice_files, batch_sizes, args.task, args.repeats)
+
+
+if __name__ == "__main__":
+    main()
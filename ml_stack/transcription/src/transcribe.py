@@ -3,17 +3,27 @@
 
 from __future__ import print_function
 
+import bisect
 import glob
 import json
 import os
+import queue
 import random
 import string
+import threading
+import time
+import wave
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse
 
 import boto3
 import flask
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+import numpy as np
 import torch
-from faster_whisper import WhisperModel
+from faster_whisper import BatchedInferencePipeline, WhisperModel, decode_audio
+from faster_whisper.vad import get_speech_timestamps
 from flask import request, json
 
 
@@ -24,92 +34,455 @@ os.environ['HF_DATASETS_CACHE'] = nfs_path+'/huggingface/datasets'
 os.environ['TRANSFORMERS_CACHE'] = nfs_path+'/huggingface/models'
 
 prefix = "/opt/ml/"
-model_size = "large-v2"
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+model_size = os.environ.get("WHISPER_MODEL_SIZE", "large-v2")
+# "auto" runs on the GPU when one is visible and on the CPU otherwise
+device = os.environ.get("WHISPER_DEVICE", "auto")
+if device == "auto":
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+# float16 on GPU, int8 is the fastest CPU option; int8_float16 and float32 are also supported
+compute_type = os.environ.get("WHISPER_COMPUTE_TYPE") or ("float16" if device == "cuda" else "int8")
+# Threads per decode on CPU, 0 uses the CTranslate2 default
+cpu_threads = int(os.environ.get("WHISPER_CPU_THREADS", 0))
+
+# Number of chunks decoded together by the batched pipeline. 1 decodes one chunk at a time.
+transcribe_batch_size = int(os.environ.get("TRANSCRIBE_BATCH_SIZE", 8))
+sampling_rate = 16000
+# Whisper decodes 30 second windows, so only chunks up to that length can share a batch
+batch_max_chunk_seconds = 30
+
+# Chunks downloaded from S3 in parallel, sharing one client and its connection pool
+s3_download_workers = int(os.environ.get("S3_DOWNLOAD_WORKERS", 16))
+s3_client = boto3.client('s3', config=Config(max_pool_connections=max(s3_download_workers, 10)))
+# Chunks are small, so every download is a single GET on the pool thread
+single_request_transfer = TransferConfig(use_threads=False)
+# Threads uploading text files and size of the queues between download, decode and upload stages
+s3_upload_workers = int(os.environ.get("S3_UPLOAD_WORKERS", 8))
+pipeline_queue_size = int(os.environ.get("PIPELINE_QUEUE_SIZE", 64))
+
+# Decode every chunk for all tasks of translate_transcribe at once, loading the audio and detecting the language
+# once per chunk instead of once per task
+shared_decode = os.environ.get("SHARED_DECODE", "true").lower() == "true"
+
+# Voice activity filter run before decoding: off, energy (frame loudness) or silero (faster-whisper's VAD model).
+# Non-speech regions are cut out of every chunk and chunks without speech are not decoded at all. The energy
+# detector is cheaper but keeps hold music, silero drops it too.
+transcribe_vad = os.environ.get("TRANSCRIBE_VAD", "off")
+vad_energy_threshold_db = float(os.environ.get("VAD_ENERGY_THRESHOLD_DB", -40))
+vad_frame_ms = 30
+vad_min_speech_ms = 250
+vad_min_silence_ms = 500
+vad_padding_ms = 200
+
+# Name of the packed transcript written instead of one text file per chunk, by output file suffix
+packed_transcript_file = "chunks.{}.jsonl"
+
+# Whisper task and output file suffix for every decode pass of a task
+task_passes = {
+    "translate_transcribe": [("translate", "translated"), ("transcribe", "original")],
+    "translate": [("translate", "translated")],
+    "transcribe": [("transcribe", "original")],
+}
 
 
 class TranslateService(object):
     model = None
+    batched_model = None
 
     @classmethod
     def get_model(cls):
         if cls.model == None:
-            cls.model = WhisperModel(model_size, device="cuda", compute_type="float16")
+            print(f"Loading whisper {model_size} on {device} with {compute_type}")
+            cls.model = WhisperModel(
+                model_size,
+                device=device,
+                compute_type=compute_type,
+                cpu_threads=cpu_threads,
+            )
         return cls.model
 
     @classmethod
-    def transcribe(cls, chunks_path, task, s3_output_uri):
-        model = cls.get_model()
-        temp_loc = generate_random_string(length=20)
-        if not os.path.exists(nfs_path + temp_loc):
-            os.makedirs(nfs_path + temp_loc)
+    def get_batched_model(cls):
+        if cls.batched_model == None:
+            cls.batched_model = BatchedInferencePipeline(model=cls.get_model())
+        return cls.batched_model
 
-        if(task=="translate_transcribe"):
-            print("Translation+Transcribe task")
-            voice_files = list_files_in_directory(chunks_path)
-
-            for voice_file in voice_files:    
-                result = " "
-                print(voice_file)
-                segments, info = model.transcribe(voice_file, beam_size=5, task="translate")
-                
-                for segment in segments:
-                    result += segment.text
-                                
-                out_file = nfs_path + temp_loc + '/'+ extract_filename_without_extension(voice_file)+'.translated.txt'
-                with open(out_file, 'w') as file:
-                    file.write(result)
-
-                upload_file_to_s3(out_file, s3_output_uri)
-                segments, info = model.transcribe(voice_file, beam_size=5)
+    @classmethod
+    def detect_language(cls, audio):
+        language, probability, _ = cls.get_model().detect_language(audio)
+        print(f"Detected language {language} ({probability:.2f})")
+        return language
 
-                for segment in segments:
-                    result +=segment.text
+    @classmethod
+    def decode(cls, audio, whisper_task, language=None):
+        """
+        :return: Text of the chunk and its segments with timestamps relative to the chunk
+        """
+        model = cls.get_model()
+        result = ""
+        timed_segments = []
+        segments, info = model.transcribe(audio, beam_size=5, task=whisper_task, language=language)
+        for segment in segments:
+            result += segment.text
+            timed_segments.append(timed_segment(segment.start, segment.end, segment.text))
+        return result, timed_segments
 
-                out_file = nfs_path + temp_loc + '/'+ extract_filename_without_extension(voice_file)+'.original.txt'
-                with open(out_file, 'w') as file:
-                    file.write(result)
+    @classmethod
+    def decode_batch(cls, audios, whisper_task, language=None):
+        """
+        Decodes several chunks in one batched call. Every chunk is padded with silence to a full Whisper window
+        and passed as a clip of its own. The pipeline packs consecutive clips into a window while they fit, so
+        without the padding short chunks of different turns would be decoded together.
+
+        :param audios: 16 kHz mono chunks, each at most batch_max_chunk_seconds long
+        :param whisper_task: transcribe or translate
+        :param language: Language of all the chunks, the pipeline detects one for the whole batch when not set
+        :return: Text and segments of every chunk, in the same order as audios
+        """
+        batched_model = cls.get_batched_model()
+        window = batch_max_chunk_seconds * sampling_rate
+        clip_timestamps = [{"start": i * batch_max_chunk_seconds, "end": (i + 1) * batch_max_chunk_seconds}
+                           for i in range(len(audios))]
+
+        segments, info = batched_model.transcribe(
+            np.concatenate([np.pad(audio, (0, window - len(audio))) for audio in audios]),
+            language=language,
+            task=whisper_task,
+            beam_size=5,
+            batch_size=len(audios),
+            chunk_length=batch_max_chunk_seconds,
+            clip_timestamps=clip_timestamps,
+            vad_filter=False,
+            # Batched decoding returns one segment per clip by default, a clip merging several turns needs the
+            # segment timings to attribute its text to each turn
+            without_timestamps=False,
+        )
+
+        # Segments carry timestamps of the concatenated windows, map them back to their chunk
+        results = [("", []) for _ in audios]
+        for segment in segments:
+            clip = min(max(int((segment.start + segment.end) / 2 // batch_max_chunk_seconds), 0), len(audios) - 1)
+            text, timed_segments = results[clip]
+            offset = clip * batch_max_chunk_seconds
+            duration = len(audios[clip]) / sampling_rate
+            timed_segments.append(timed_segment(min(segment.start - offset, duration),
+                                                min(segment.end - offset, duration), segment.text))
+            results[clip] = (text + segment.text, timed_segments)
+        return results
 
-                upload_file_to_s3(out_file, s3_output_uri)
+    @classmethod
+    def decode_chunk(cls, audio, whisper_tasks):
+        """
+        Decodes one chunk for every task. With more than one task the audio is loaded and the language detected
+        once, and both are reused by every decode.
+
+        :param audio: Chunk file, or the chunk already loaded as 16 kHz mono samples
+        :return: List of (text, segments), one per task
+        """
+        if len(whisper_tasks) == 1:
+            return [cls.decode(audio, whisper_tasks[0])]
+        if isinstance(audio, str):
+            audio = load_audio(audio)
+        language = cls.detect_language(audio)
+        return [cls.decode(audio, whisper_task, language) for whisper_task in whisper_tasks]
 
-        elif(task=="translate"):
-            print("Translation task only")
-            voice_files = list_files_in_directory(chunks_path)
+    @classmethod
+    def load_chunk(cls, voice_file, vad_stats=None):
+        """
+        Loads a chunk and cuts out its non-speech regions when the VAD is on.
+
+        :param vad_stats: Optional dict the audio and skipped seconds are added to
+        :return: (audio, spans), spans being the speech regions kept from the chunk or None without VAD. audio
+            is None when the chunk holds no speech.
+        """
+        audio = load_audio(voice_file)
+        if transcribe_vad == "off":
+            return audio, None
+
+        spans = speech_spans(audio)
+        speech = np.concatenate([audio[span["start"]:span["end"]] for span in spans]) if spans else None
+        if vad_stats is not None:
+            speech_samples = len(speech) if speech is not None else 0
+            vad_stats["audio_seconds"] += len(audio) / sampling_rate
+            vad_stats["skipped_seconds"] += (len(audio) - speech_samples) / sampling_rate
+            vad_stats["skipped_chunks"] += int(speech is None)
+        return speech, spans
 
-            for voice_file in voice_files:    
-                result = " "
+    @classmethod
+    def decode_files(cls, voice_files, whisper_tasks, vad_stats=None):
+        """
+        Decodes the chunk files for every task and yields (voice_file, outputs) tuples, with one (text, segments)
+        output per task. voice_files can be a generator, every chunk is picked up as soon as it is produced.
+        With batching enabled, chunks that fit in a Whisper window are buffered and the buffer is decoded
+        shortest first, so each batch holds chunks of similar length. Segment timestamps are relative to the
+        original chunk, also when the VAD cut parts of it.
+
+        :param vad_stats: Optional dict the audio and skipped seconds are added to
+        """
+        max_samples = batch_max_chunk_seconds * sampling_rate
+        chunk_spans = dict()
+        pending = []
+        for voice_file in voice_files:
+            audio, spans = cls.load_chunk(voice_file, vad_stats)
+            if audio is None:
+                print(f"No speech in {voice_file}, skipping it")
+                yield voice_file, [("", []) for _ in whisper_tasks]
+                continue
+            if spans:
+                chunk_spans[voice_file] = spans
+
+            if transcribe_batch_size <= 1 or not 0 < len(audio) <= max_samples:
                 print(voice_file)
-                segments, info = model.transcribe(voice_file, beam_size=5, task="translate")
-                
-                for segment in segments:
-                    result += segment.text
-                                
-                out_file = nfs_path + temp_loc + '/'+ extract_filename_without_extension(voice_file)+'.translated.txt'
-                with open(out_file, 'w') as file:
-                    file.write(result)
+                yield restore_timestamps(voice_file, cls.decode_chunk(audio, whisper_tasks), chunk_spans)
+                continue
 
-                upload_file_to_s3(out_file, s3_output_uri)
+            pending.append((voice_file, audio))
+            if len(pending) >= 2 * transcribe_batch_size:
+                pending.sort(key=lambda item: len(item[1]))
+                batch, pending = pending[:transcribe_batch_size], pending[transcribe_batch_size:]
+                for voice_file, outputs in cls.decode_buffered(batch, whisper_tasks):
+                    yield restore_timestamps(voice_file, outputs, chunk_spans)
 
-        else:
-            print("Transcribe task only")
-            voice_files = list_files_in_directory(chunks_path)
+        pending.sort(key=lambda item: len(item[1]))
+        for i in range(0, len(pending), transcribe_batch_size):
+            for voice_file, outputs in cls.decode_buffered(pending[i:i + transcribe_batch_size], whisper_tasks):
+                yield restore_timestamps(voice_file, outputs, chunk_spans)
 
-            for voice_file in voice_files:
-                result = " " 
-                print(voice_file)
-                segments, info = model.transcribe(voice_file, beam_size=5)
-                for segment in segments:
-                    result += segment.text
+    @classmethod
+    def decode_buffered(cls, batch, whisper_tasks):
+        print(f"Batch of {len(batch)} chunks: {[voice_file for voice_file, _ in batch]}")
+        audios = [audio for _, audio in batch]
+        # The batched pipeline uses one language for the whole batch. Detect it per chunk, as decoding the chunks
+        # one at a time does, and decode the chunks of each language together
+        chunks_by_language = dict()
+        for i, audio in enumerate(audios):
+            chunks_by_language.setdefault(cls.detect_language(audio), []).append(i)
+        outputs = [[None] * len(batch) for _ in whisper_tasks]
+        for language, indices in chunks_by_language.items():
+            for output, whisper_task in zip(outputs, whisper_tasks):
+                results = cls.decode_batch([audios[i] for i in indices], whisper_task, language)
+                for i, result in zip(indices, results):
+                    output[i] = result
+        return [(voice_file, [output[i] for output in outputs]) for i, (voice_file, _) in enumerate(batch)]
 
-                out_file = nfs_path + temp_loc + '/'+ extract_filename_without_extension(voice_file)+'.original.txt'
+    @classmethod
+    def transcribe(cls, voice_files, task, s3_output_uri, on_output=None, output_format="txt", vad_stats=None):
+        """
+        :param voice_files: Iterable of local chunk files, e.g. the generator from download_s3_bucket_from_uri
+        :param task: transcribe, translate or translate_transcribe
+        :param s3_output_uri: S3 prefix the text files are uploaded to
+        :param on_output: Called with every text file written. Uploads it synchronously when not set.
+        :param output_format: txt writes {gidx}.{suffix}.txt per chunk, jsonl writes a single chunks.{suffix}.jsonl
+            with one line per chunk holding its group index, text and segment timings
+        :param vad_stats: Optional dict the audio and skipped seconds of the conversation are added to
+        """
+        temp_loc = generate_random_string(length=20)
+        if not os.path.exists(nfs_path + temp_loc):
+            os.makedirs(nfs_path + temp_loc)
+        if not on_output:
+            on_output = lambda file_path: upload_file_to_s3(file_path, s3_output_uri)
+
+        if task not in task_passes:
+            task = "transcribe"
+        print(f"Task {task}")
+
+        # With shared decoding every chunk is decoded for all tasks in one go, otherwise one pass per task
+        passes = task_passes[task]
+        pass_groups = [passes] if shared_decode else [[task_pass] for task_pass in passes]
+
+        # Text of the current chunk. In translate_transcribe the .original.txt file has always started with
+        # the translation, which is kept so the output files stay the same. Packed records hold the text of their
+        # own pass only, the same text as their segments.
+        results = dict()
+        packed = {suffix: [] for _, suffix in passes}
+        for pass_group in pass_groups:
+            # The first pass consumes the chunks as they arrive, later passes reuse the files already on disk
+            pass_files = voice_files if not results else list(results)
+            whisper_tasks = [whisper_task for whisper_task, _ in pass_group]
+            # Count skipped audio on the first pass only, later passes see the same chunks again
+            pass_vad_stats = vad_stats if pass_group is pass_groups[0] else None
+            for voice_file, outputs in cls.decode_files(pass_files, whisper_tasks, pass_vad_stats):
+                for (_, suffix), (text, segments) in zip(pass_group, outputs):
+                    results[voice_file] = results.get(voice_file, " ") + text
+                    if output_format == "jsonl":
+                        packed[suffix].append({
+                            "gidx": chunk_index(voice_file),
+                            "text": " " + text,
+                            "segments": segments,
+                        })
+                        continue
+
+                    out_file = nfs_path + temp_loc + '/' + extract_filename_without_extension(voice_file) + '.' + suffix + '.txt'
+                    with open(out_file, 'w') as file:
+                        file.write(results[voice_file])
+                    on_output(out_file)
+
+        if output_format == "jsonl":
+            for suffix, records in packed.items():
+                records.sort(key=lambda record: str(record["gidx"]).zfill(10))
+                out_file = nfs_path + temp_loc + '/' + packed_transcript_file.format(suffix)
                 with open(out_file, 'w') as file:
-                    file.write(result)
-
-                upload_file_to_s3(out_file, s3_output_uri)
+                    for record in records:
+                        file.write(json.dumps(record) + '\n')
+                on_output(out_file)
 
+        if vad_stats and vad_stats["audio_seconds"]:
+            print(f"VAD skipped {vad_stats['skipped_seconds']:.1f}s of {vad_stats['audio_seconds']:.1f}s audio, "
+                  f"{vad_stats['skipped_chunks']} chunks without speech")
         return "OK"
 
 
+class StageStats(object):
+    """
+    Time spent by a pipeline stage and depth of its input queue. busy is time spent working, starved is time
+    waiting for input and blocked is time waiting for room in the next stage's queue.
+    """
+
+    def __init__(self):
+        self.items = 0
+        self.busy = 0.0
+        self.starved = 0.0
+        self.blocked = 0.0
+        self.max_queue_depth = 0
+        self.queue_depth_total = 0
+        self.queue_depth_samples = 0
+        self.lock = threading.Lock()
+
+    def add(self, busy=0.0, starved=0.0, blocked=0.0, items=0):
+        with self.lock:
+            self.busy += busy
+            self.starved += starved
+            self.blocked += blocked
+            self.items += items
+
+    def sample_queue(self, stage_queue):
+        depth = stage_queue.qsize()
+        with self.lock:
+            self.max_queue_depth = max(self.max_queue_depth, depth)
+            self.queue_depth_total += depth
+            self.queue_depth_samples += 1
+
+    def to_dict(self):
+        return {
+            "items": self.items,
+            "busy_seconds": round(self.busy, 3),
+            "starved_seconds": round(self.starved, 3),
+            "blocked_seconds": round(self.blocked, 3),
+            "max_queue_depth": self.max_queue_depth,
+            "mean_queue_depth": round(self.queue_depth_total / max(self.queue_depth_samples, 1), 2),
+        }
+
+
+class TranscriptionPipeline(object):
+    """
+    Runs download, decode and upload as concurrent stages connected by bounded queues, so the GPU does not
+    wait on S3 in either direction. Downloads and uploads run on thread pools, decoding runs on the calling
+    thread.
+
+    :param input_location: S3 prefix holding the audio chunks
+    :param output_location: S3 prefix the text files are uploaded to
+    :param local_folder: Local folder the chunks are downloaded to
+    """
+    done = object()
+
+    def __init__(self, input_location, output_location, local_folder):
+        self.input_location = input_location
+        self.output_location = output_location
+        self.local_folder = local_folder
+        self.download_queue = queue.Queue(maxsize=pipeline_queue_size)
+        self.upload_queue = queue.Queue(maxsize=pipeline_queue_size)
+        self.stats = {"download": StageStats(), "decode": StageStats(), "upload": StageStats()}
+        self.vad_stats = {"audio_seconds": 0.0, "skipped_seconds": 0.0, "skipped_chunks": 0}
+        self.errors = []
+
+    def put(self, stage_queue, item, stats):
+        wait_start = time.time()
+        stage_queue.put(item)
+        stats.add(blocked=time.time() - wait_start)
+
+    def download_stage(self):
+        stats = self.stats["download"]
+        try:
+            for local_file in download_s3_bucket_from_uri(self.input_location, self.local_folder, stats):
+                self.put(self.download_queue, local_file, stats)
+        except Exception as e:
+            print(f"Error downloading chunks: {e}")
+            self.errors.append(e)
+        finally:
+            self.download_queue.put(self.done)
+
+    def voice_files(self):
+        stats = self.stats["decode"]
+        while True:
+            stats.sample_queue(self.download_queue)
+            wait_start = time.time()
+            local_file = self.download_queue.get()
+            stats.add(starved=time.time() - wait_start)
+            if local_file is self.done:
+                return
+            yield local_file
+
+    def enqueue_upload(self, out_file):
+        self.stats["decode"].add(items=1)
+        self.put(self.upload_queue, out_file, self.stats["decode"])
+
+    def upload_stage(self):
+        stats = self.stats["upload"]
+        while True:
+            stats.sample_queue(self.upload_queue)
+            wait_start = time.time()
+            out_file = self.upload_queue.get()
+            stats.add(starved=time.time() - wait_start)
+            if out_file is self.done:
+                return
+            upload_start = time.time()
+            upload_file_to_s3(out_file, self.output_location)
+            stats.add(busy=time.time() - upload_start, items=1)
+
+    def run(self, task, output_format="txt"):
+        fn_start = time.time()
+        downloader = threading.Thread(target=self.download_stage, daemon=True)
+        uploaders = [threading.Thread(target=self.upload_stage, daemon=True) for _ in range(s3_upload_workers)]
+        downloader.start()
+        for uploader in uploaders:
+            uploader.start()
+
+        decode_stats = self.stats["decode"]
+        decode_start = time.time()
+        try:
+            res = TranslateService.transcribe(self.voice_files(), task, self.output_location, self.enqueue_upload,
+                                              output_format, self.vad_stats)
+        finally:
+            for _ in uploaders:
+                self.upload_queue.put(self.done)
+            for uploader in uploaders:
+                uploader.join()
+            # Drain what is left so the downloader can finish when decoding stopped early
+            while downloader.is_alive():
+                try:
+                    self.download_queue.get(timeout=1)
+                except queue.Empty:
+                    pass
+        decode_stats.add(busy=time.time() - decode_start - decode_stats.starved - decode_stats.blocked)
+
+        if self.errors:
+            raise self.errors[0]
+        return res, self.summary(time.time() - fn_start)
+
+    def summary(self, elapsed):
+        summary = {
+            "elapsed_seconds": round(elapsed, 3),
+            "stages": {name: stats.to_dict() for name, stats in self.stats.items()},
+        }
+        if transcribe_vad != "off":
+            summary["vad"] = {
+                "mode": transcribe_vad,
+                "audio_seconds": round(self.vad_stats["audio_seconds"], 3),
+                "skipped_seconds": round(self.vad_stats["skipped_seconds"], 3),
+                "skipped_chunks": self.vad_stats["skipped_chunks"],
+            }
+        return summary
+
+
 app = flask.Flask(__name__)
 
 
@@ -125,6 +498,109 @@ def extract_filename_without_extension(file_path):
     return filename_without_extension
 
 
+def chunk_index(voice_file):
+    # Chunks are named after their diarization group index, e.g. 12.wav
+    name = extract_filename_without_extension(voice_file)
+    return int(name) if name.isdigit() else name
+
+
+def load_audio(voice_file):
+    """
+    Reads chunks that are already 16 kHz mono 16-bit PCM directly, everything else is decoded and resampled.
+
+    :return: float32 samples at sampling_rate
+    """
+    try:
+        with wave.open(voice_file, "rb") as wav_file:
+            if (wav_file.getnchannels(), wav_file.getframerate(), wav_file.getsampwidth()) == (1, sampling_rate, 2):
+                pcm = np.frombuffer(wav_file.readframes(wav_file.getnframes()), dtype=np.int16)
+                return pcm.astype(np.float32) / 32768.0
+    except (wave.Error, EOFError):
+        pass
+    return decode_audio(voice_file, sampling_rate=sampling_rate)
+
+
+def timed_segment(start, end, text):
+    return {"start": round(start, 3), "end": round(end, 3), "text": text}
+
+
+def energy_speech_timestamps(audio):
+    """
+    Marks frames louder than VAD_ENERGY_THRESHOLD_DB as speech, bridges pauses shorter than vad_min_silence_ms
+    and drops regions shorter than vad_min_speech_ms.
+
+    :return: List of {"start", "end"} sample offsets, like faster-whisper's get_speech_timestamps
+    """
+    frame = int(sampling_rate * vad_frame_ms / 1000)
+    frames = len(audio) // frame
+    if frames == 0:
+        return []
+    rms = np.sqrt(np.mean(np.square(audio[:frames * frame].reshape(frames, frame)), axis=1) + 1e-10)
+    voiced = 20 * np.log10(rms) > vad_energy_threshold_db
+
+    min_silence = int(sampling_rate * vad_min_silence_ms / 1000)
+    spans = []
+    for idx in np.flatnonzero(voiced):
+        start, end = int(idx) * frame, (int(idx) + 1) * frame
+        if spans and start - spans[-1]["end"] < min_silence:
+            spans[-1]["end"] = end
+        else:
+            spans.append({"start": start, "end": end})
+    min_speech = int(sampling_rate * vad_min_speech_ms / 1000)
+    return [span for span in spans if span["end"] - span["start"] >= min_speech]
+
+
+def speech_spans(audio):
+    """
+    :return: Padded speech regions of the chunk as {"start", "end"} sample offsets, without overlaps
+    """
+    if transcribe_vad == "silero":
+        timestamps = get_speech_timestamps(audio)
+    else:
+        timestamps = energy_speech_timestamps(audio)
+
+    padding = int(sampling_rate * vad_padding_ms / 1000)
+    spans = []
+    for timestamp in timestamps:
+        start, end = max(timestamp["start"] - padding, 0), min(timestamp["end"] + padding, len(audio))
+        if spans and start <= spans[-1]["end"]:
+            spans[-1]["end"] = max(spans[-1]["end"], end)
+        else:
+            spans.append({"start": start, "end": end})
+    return spans
+
+
+def restore_timestamps(voice_file, outputs, chunk_spans):
+    """
+    Maps segment timestamps of a chunk decoded without its non-speech regions back to the original chunk.
+
+    :param chunk_spans: Speech regions kept by the VAD by chunk file, the entry of voice_file is removed
+    :return: (voice_file, outputs) with corrected segments
+    """
+    spans = chunk_spans.pop(voice_file, None)
+    if not spans:
+        return voice_file, outputs
+
+    # Start of every kept region in the filtered audio, in seconds
+    kept_starts = []
+    kept = 0
+    for span in spans:
+        kept_starts.append(kept / sampling_rate)
+        kept += span["end"] - span["start"]
+
+    def original_time(seconds):
+        idx = max(bisect.bisect_right(kept_starts, seconds) - 1, 0)
+        return spans[idx]["start"] / sampling_rate + seconds - kept_starts[idx]
+
+    restored = []
+    for text, segments in outputs:
+        restored.append((text, [
+            timed_segment(original_time(segment["start"]), original_time(segment["end"]), segment["text"])
+            for segment in segments
+        ]))
+    return voice_file, restored
+
+
 def upload_file_to_s3(file_path, s3_uri):
     # Parse the S3 URI to extract the bucket name and the key (filename)
     parsed_uri = urlparse(s3_uri)
@@ -134,41 +610,82 @@ def upload_file_to_s3(file_path, s3_uri):
     # Use the local file's name as the key (filename) in S3
     key = os.path.join(key, os.path.basename(file_path))
 
-    # Initialize a Boto3 S3 client with AWS credentials
-    s3 = boto3.client('s3')
-
     try:
         # Upload the file to S3
-        s3.upload_file(file_path, bucket_name, key)
+        s3_client.upload_file(file_path, bucket_name, key)
         print(f"Uploaded {file_path} to {s3_uri}")
     except Exception as e:
         print(f"Error: {e}")
 
 
-def download_s3_bucket_from_uri(s3_uri, local_folder):
+def list_s3_objects(bucket_name, key_prefix):
+    # list_objects_v2 returns at most 1000 keys per call, so page through all of them
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=key_prefix):
+        for obj in page.get('Contents', []):
+            yield obj
+
+
+def download_s3_object(bucket_name, key, local_file_path, stats=None):
+    download_start = time.time()
+    s3_client.download_file(bucket_name, key, local_file_path, Config=single_request_transfer)
+    print(f"Downloaded: {key} to {local_file_path}")
+    if stats:
+        stats.add(busy=time.time() - download_start, items=1)
+    return local_file_path
+
+
+def download_s3_bucket_from_uri(s3_uri, local_folder, stats=None):
+    """
+    Downloads every object under the S3 prefix with a bounded pool of S3_DOWNLOAD_WORKERS threads. The prefix is
+    listed on a thread of its own, so downloads start with the first page and finished files are yielded while
+    the remaining pages are still listed.
+
+    :param stats: Optional StageStats that download times are added to
+    :return: Generator of local file paths, in the order the downloads complete
+    """
     # Parse the S3 URI to extract the bucket name and key prefix
     parsed_uri = urlparse(s3_uri)
     bucket_name = parsed_uri.netloc
     key_prefix = parsed_uri.path.lstrip('/')
 
-    # Initialize a Boto3 S3 client
-    s3 = boto3.client('s3')
-
-    # List objects in the S3 bucket with the specified key prefix
-    objects = s3.list_objects_v2(Bucket=bucket_name, Prefix=key_prefix)
-
     # Check if the local folder exists, if not, create it
     if not os.path.exists(local_folder):
         os.makedirs(local_folder)
 
-    # Download each object from the S3 bucket to the local folder
-    for obj in objects.get('Contents', []):
-        # Construct the local file path by removing the key prefix
-        local_file_path = os.path.join(local_folder, obj['Key'].replace(key_prefix, '', 1))
-
-        # Download the file from S3
-        s3.download_file(bucket_name, obj['Key'], local_file_path)
-        print(f"Downloaded: {obj['Key']} to {local_file_path}")
+    # Completed downloads, followed by None once the listing is over
+    finished = queue.Queue()
+    listing = {"submitted": 0, "error": None}
+
+    with ThreadPoolExecutor(max_workers=s3_download_workers) as executor:
+        def submit_downloads():
+            try:
+                for obj in list_s3_objects(bucket_name, key_prefix):
+                    if obj['Key'].endswith('/'):
+                        continue
+                    # Construct the local file path by removing the key prefix
+                    local_file_path = os.path.join(local_folder, obj['Key'].replace(key_prefix, '', 1))
+                    future = executor.submit(download_s3_object, bucket_name, obj['Key'], local_file_path, stats)
+                    listing["submitted"] += 1
+                    future.add_done_callback(finished.put)
+            except Exception as e:
+                listing["error"] = e
+            finally:
+                print(f"Listed {listing['submitted']} objects from {s3_uri}")
+                finished.put(None)
+
+        threading.Thread(target=submit_downloads, daemon=True).start()
+        listed = False
+        downloaded = 0
+        while not listed or downloaded < listing["submitted"]:
+            future = finished.get()
+            if future is None:
+                listed = True
+                if listing["error"]:
+                    raise listing["error"]
+                continue
+            downloaded += 1
+            yield future.result()
 
 
 def list_files_in_directory(directory):
@@ -191,11 +708,14 @@ def transcribe():
     input_location = data['input_location']
     task = data['task']
     output_location = data['output_location']
+    output_format = data.get('output_format', 'txt')
     print(f"Input chunks location: {input_location}")
 
     chunk_folder_path = nfs_path+generate_random_string(20)
-    download_s3_bucket_from_uri(input_location, chunk_folder_path)
-    res = TranslateService.transcribe(chunk_folder_path, task, output_location)    
-    print(f"Completed {task} for {input_location}")
-    return flask.Response(response=res, status=200, mimetype="text/plain")
+    # Chunks are decoded as soon as they are downloaded and text files uploaded while decoding continues
+    pipeline = TranscriptionPipeline(input_location, output_location, chunk_folder_path)
+    res, stats = pipeline.run(task, output_format)
+    print(f"Completed {task} for {input_location}: {json.dumps(stats)}")
+    return flask.Response(response=json.dumps({"status": res, "stats": stats}), status=200,
+                          mimetype="application/json")
 
@@ -0,0 +1,145 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  SPDX-License-Identifier: MIT-0
+
+# Benchmark for combining the per chunk transcripts, against an in-memory S3 with a fixed latency per request, e.g.
+#
+#   python3 server/benchmarks/combine_benchmark.py --chunks 2000 --latency-ms 20 --workers 8,32,64
+#
+# The serial baseline downloads every chunk transcript to a local file one after the other, the way the combine
+# function did before fetching them concurrently. Both must write the same transcript. Kept outside server/lambdas
+# so it is not deployed with the functions.
+
+import argparse
+import json
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "lambdas"))
+
+import combine_transcription_files
+import segment_index
+import server_constants
+
+
+class Body:
+    def __init__(self, data):
+        self.data = data
+
+    def read(self):
+        return self.data
+
+    def iter_lines(self):
+        return iter(self.data.splitlines())
+
+
+class MockS3:
+    """
+    Holds objects in a dictionary and sleeps latency seconds per request, like the time to first byte of S3.
+    """
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.objects = dict()
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def request(self):
+        with self.lock:
+            self.requests += 1
+        time.sleep(self.latency)
+
+    def get_object(self, Bucket, Key, **kwargs):
+        self.request()
+        return {"Body": Body(self.objects[(Bucket, Key)])}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.request()
+        self.objects[(Bucket, Key)] = Body if isinstance(Body, bytes) else Body.encode("utf-8")
+        return {}
+
+    def download_file(self, Bucket, Key, Filename, **kwargs):
+        self.request()
+        with open(Filename, "wb") as f:
+            f.write(self.objects[(Bucket, Key)])
+
+    def upload_file(self, Filename, Bucket, Key, **kwargs):
+        self.request()
+        with open(Filename, "rb") as f:
+            self.objects[(Bucket, Key)] = f.read()
+
+
+def populate(s3, bucket, output_s3_key, txt_chunks_s3_key, chunks):
+    # One turn per chunk, alternating speakers, with one or two caption lines each
+    index = {
+        "version": segment_index.SEGMENT_INDEX_VERSION,
+        "speakers": ["SPEAKER_00", "SPEAKER_01"],
+        "turns": {
+            "start_ms": [gidx * 5000 for gidx in range(chunks)],
+            "end_ms": [gidx * 5000 + 4000 for gidx in range(chunks)],
+            "speaker": [gidx % 2 for gidx in range(chunks)],
+        },
+        "chunks": {"start_ms": [], "end_ms": [], "turns": []},
+    }
+    s3.objects[(bucket, f"{output_s3_key}/segment_index.json")] = json.dumps(index).encode("utf-8")
+    for gidx in range(chunks):
+        text = f" Chunk {gidx} says hello, and asks about order {gidx * 7}."
+        if gidx % 3 == 0:
+            text += "\n Then continues on a second line."
+        s3.objects[(bucket, f"{txt_chunks_s3_key}{gidx}.original.txt")] = text.encode("utf-8")
+
+
+def serial_combine(s3, file_name, index_file, txt_chunks_s3_key, bucket, output_s3_key, tmp_dir):
+    index = segment_index.read_segment_index(s3, bucket, f"{output_s3_key}/{index_file}")
+    local_transcription_file = os.path.join(tmp_dir, file_name)
+    with open(local_transcription_file, "w") as text_file:
+        for gidx, turn in enumerate(segment_index.turns(index)):
+            tmp_chunk_path = os.path.join(tmp_dir, f"{gidx}.original.txt")
+            s3.download_file(bucket, f"{txt_chunks_s3_key}{gidx}.original.txt", tmp_chunk_path)
+            with open(tmp_chunk_path, "r") as chunk_file:
+                captions = chunk_file.readlines()
+            speaker_str = re.sub("[!^:(),']", "", str(server_constants.SPEAKERS[turn["speaker"]]))
+            for c in captions:
+                text_file.write(re.sub(r"[!\n]", "", speaker_str + ":" + str(c)) + "\n")
+    s3.upload_file(local_transcription_file, bucket, f"{output_s3_key}/{file_name}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Transcript combine benchmark")
+    parser.add_argument("--chunks", type=int, default=2000, help="Number of chunk transcripts")
+    parser.add_argument("--latency-ms", type=float, default=20, help="Latency of every S3 request")
+    parser.add_argument("--workers", default="8,32,64", help="Comma separated fetch pool sizes")
+    args = parser.parse_args()
+
+    bucket, output_s3_key, txt_chunks_s3_key = "bucket", "output/call", "output/call/txt_chunks/"
+    file_name = "call.original.txt"
+    s3 = MockS3(args.latency_ms / 1000)
+    populate(s3, bucket, output_s3_key, txt_chunks_s3_key, args.chunks)
+    output = (bucket, f"{output_s3_key}/{file_name}")
+    print(f"{args.chunks} chunks, {args.latency_ms:.0f} ms per request")
+    print(f"{'mode':>12} {'seconds':>10} {'requests':>10}")
+
+    s3.requests = 0
+    start = time.time()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        serial_combine(s3, file_name, "segment_index.json", txt_chunks_s3_key, bucket, output_s3_key, tmp_dir)
+    print(f"{'serial':>12} {time.time() - start:>10.2f} {s3.requests:>10}")
+    expected = s3.objects.pop(output)
+
+    combine_transcription_files.s3_client = s3
+    for workers in args.workers.split(","):
+        combine_transcription_files.fetch_workers = int(workers)
+        s3.requests = 0
+        start = time.time()
+        combine_transcription_files.combine_txt_transcriptions(file_name, "segment_index.json", txt_chunks_s3_key,
+                                                               "original", bucket, output_s3_key)
+        print(f"{workers + ' workers':>12} {time.time() - start:>10.2f} {s3.requests:>10}")
+        if s3.objects.pop(output) != expected:
+            raise RuntimeError(f"Transcript with {workers} workers differs from the serial one")
+
+
+if __name__ == "__main__":
+    main()
@@ -135,6 +135,19 @@ class PromptsStack:
             "<br>Assistant:",
         )
 
+        combined_insights_prompt = ssm.StringParameter(
+            cdk_scope,
+            "combined_insights_prompt",
+            parameter_name=cfg.SSM_LLM_COMBINED_PROMPT,
+            description="Prompt template for generating all insights as a single JSON object",
+            string_value="<br><br>Human: Answer the questions below, defined in <question></question> based on the "
+            "transcript defined in <transcript></transcript>. Each line in <question></question> is a JSON key "
+            "followed by the question to answer for that key. If you cannot answer a question, use 'n/a' as "
+            "the answer. Use gender neutral pronouns. Reply only with a single JSON object that has exactly "
+            "these keys and a string value for each key. Do not use XML tags in the answer.<br><br>"
+            "<question>{question}</question><br><br><transcript><br>{transcript}<br></transcript><br><br>Assistant:",
+        )
+
         self.model_id_param = model_id_param
         self.summarization_prompt = summarization_prompt
         self.topic_prompt = topic_prompt
@@ -145,3 +158,4 @@ class PromptsStack:
         self.actions_prompt = actions_prompt
         self.agent_feedback_prompt = agent_feedback_prompt
         self.customer_feedback_prompt = customer_feedback_prompt
+        self.combined_insights_prompt = combined_insights_prompt
@@ -17,6 +17,11 @@ from aws_cdk import (
     BundlingOptions,
     aws_ssm as ssm,
     aws_dynamodb as dynamodb,
+    aws_sqs as sqs,
+    aws_sns as sns,
+    aws_sns_subscriptions as sns_subscriptions,
+    aws_events as events,
+    aws_events_targets as events_targets,
     Fn,
     Size,
     CfnOutput
@@ -78,6 +83,8 @@ class ServerStack(Stack):
                         "comprehend:DetectKeyPhrases",
                         "comprehend:DetectPiiEntities",
                         "comprehend:DetectSentiment",
+                        "comprehend:BatchDetectSentiment",
+                        "comprehend:BatchDetectEntities",
                         "comprehend:StartDominantLanguageDetectionJob",
                         "comprehend:StartSentimentDetectionJob",
                         "comprehend:StartEntitiesDetectionJob",
@@ -175,6 +182,7 @@ class ServerStack(Stack):
                 image=ecs.ContainerImage.from_asset("./server/containers/mp3towav"),
                 memory=Size.mebibytes(4096),
                 cpu=2,
+                environment={"NORMALIZE_AUDIO": str(cfg.NORMALIZE_AUDIO).lower()},
                 execution_role=task_execution_role,
                 job_role=batch_job_role,
             ),
@@ -204,12 +212,51 @@ class ServerStack(Stack):
                 image=ecs.ContainerImage.from_asset("./server/containers/chunking"),
                 memory=Size.mebibytes(8 * 1024),
                 cpu=4,
+                environment={
+                    "CHUNK_MIN_SECONDS": str(cfg.CHUNK_MIN_SECONDS),
+                    "CHUNK_MAX_SECONDS": str(cfg.CHUNK_MAX_SECONDS),
+                    "CHUNK_MAX_GAP_SECONDS": str(cfg.CHUNK_MAX_GAP_SECONDS),
+                },
                 execution_role=task_execution_role,
                 job_role=batch_job_role,
             ),
             retry_attempts=1,
         )
 
+        # Short calls are converted and chunked in Lambda with the same container images, which avoids the Batch
+        # queue and Fargate task start up. The check input function picks the path from the file size and duration
+        self.convert_to_wav_fn = _lambda.DockerImageFunction(
+            self,
+            id="convert_to_wav_fn",
+            code=_lambda.DockerImageCode.from_image_asset(
+                "./server/containers/mp3towav",
+                entrypoint=["python3", "-m", "awslambdaric"],
+                cmd=["convert_to_wav.handler"],
+            ),
+            memory_size=cfg.LAMBDA_PROCESSING_MEMORY_MB,
+            ephemeral_storage_size=Size.gibibytes(2),
+            timeout=Duration.minutes(15),
+            environment={"NORMALIZE_AUDIO": str(cfg.NORMALIZE_AUDIO).lower()},
+        )
+
+        self.chunking_fn = _lambda.DockerImageFunction(
+            self,
+            id="chunking_fn",
+            code=_lambda.DockerImageCode.from_image_asset(
+                "./server/containers/chunking",
+                entrypoint=["python3", "-m", "awslambdaric"],
+                cmd=["chunking.handler"],
+            ),
+            memory_size=cfg.LAMBDA_PROCESSING_MEMORY_MB,
+            ephemeral_storage_size=Size.gibibytes(2),
+            timeout=Duration.minutes(15),
+            environment={
+                "CHUNK_MIN_SECONDS": str(cfg.CHUNK_MIN_SECONDS),
+                "CHUNK_MAX_SECONDS": str(cfg.CHUNK_MAX_SECONDS),
+                "CHUNK_MAX_GAP_SECONDS": str(cfg.CHUNK_MAX_GAP_SECONDS),
+            },
+        )
+
         # Lambda Stack
         self.check_input_file_type_fn = _lambda.Function(
             self,
@@ -217,6 +264,12 @@ class ServerStack(Stack):
             runtime=ci_lambda_runtime,
             handler="check_input_file_type.handler",
             timeout=Duration.minutes(3),
+            environment={
+                "TRANSCRIPT_FORMAT": cfg.TRANSCRIPT_FORMAT,
+                "DIARIZATION_FORMAT": cfg.DIARIZATION_FORMAT,
+                "LAMBDA_MAX_CONTENT_LENGTH_MB": str(cfg.LAMBDA_MAX_CONTENT_LENGTH_MB),
+                "LAMBDA_MAX_DURATION_SECONDS": str(cfg.LAMBDA_MAX_DURATION_SECONDS),
+            },
             code=_lambda.Code.from_asset(
                 "server/lambdas",
                 bundling=BundlingOptions(
@@ -255,6 +308,50 @@ class ServerStack(Stack):
             timeout=Duration.minutes(3),
         )
 
+        # Processing time observed per stage, sets the wait between two checks of a result
+        polling_stats_table = dynamodb.Table(
+            self,
+            "polling_stats_ddb",
+            partition_key=dynamodb.Attribute(
+                name="stage", type=dynamodb.AttributeType.STRING,
+            ),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+        )
+
+        # Task tokens of executions waiting for an async inference, resumed by the endpoint notifications
+        async_inference_waits_table = dynamodb.Table(
+            self,
+            "async_inference_waits_ddb",
+            partition_key=dynamodb.Attribute(
+                name="inferenceId", type=dynamodb.AttributeType.STRING,
+            ),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            time_to_live_attribute="expiresAt",
+        )
+
+        self.async_inference_register_fn = _lambda.Function(
+            self,
+            id="async_inference_register_fn",
+            runtime=ci_lambda_runtime,
+            handler="async_inference_waits.register",
+            code=_lambda.Code.from_asset("server/lambdas"),
+            environment={"WAITS_TABLE": async_inference_waits_table.table_name},
+        )
+
+        self.async_inference_notify_fn = _lambda.Function(
+            self,
+            id="async_inference_notify_fn",
+            runtime=ci_lambda_runtime,
+            handler="async_inference_waits.notify",
+            code=_lambda.Code.from_asset("server/lambdas"),
+            environment={"WAITS_TABLE": async_inference_waits_table.table_name},
+        )
+
+        for topic_id, export_name in [("async_success_topic", "ml-async-success-topic"),
+                                      ("async_error_topic", "ml-async-error-topic")]:
+            topic = sns.Topic.from_topic_arn(self, topic_id, Fn.import_value(export_name))
+            topic.add_subscription(sns_subscriptions.LambdaSubscription(self.async_inference_notify_fn))
+
         transcription_model_endpoint = ssm.StringParameter.from_string_parameter_name(
             self,
             "transcription_model_endpoint",
@@ -307,7 +404,13 @@ class ServerStack(Stack):
             runtime=ci_lambda_runtime,
             handler="start_comprehension.handler",
             code=_lambda.Code.from_asset("server/lambdas"),
-            environment={"comprehend_job_role": comprehend_job_role.role_arn},
+            timeout=Duration.minutes(3),
+            environment={
+                "comprehend_job_role": comprehend_job_role.role_arn,
+                "COMPREHEND_SYNC_MAX_LINES": str(cfg.COMPREHEND_SYNC_MAX_LINES),
+                "COMPREHEND_SYNC_MAX_BYTES": str(cfg.COMPREHEND_SYNC_MAX_BYTES),
+                "COMPREHEND_AGGREGATION": str(cfg.COMPREHEND_AGGREGATION).lower(),
+            },
         )
 
         self.check_sentiment_job_fn = _lambda.Function(
@@ -326,6 +429,40 @@ class ServerStack(Stack):
             code=_lambda.Code.from_asset("server/lambdas"),
         )
 
+        # Conversations waiting for their Comprehend jobs to run together with others, see comprehend_aggregator.py
+        self.comprehend_batch_queue = sqs.Queue(
+            self,
+            "comprehend_batch_queue",
+            visibility_timeout=Duration.minutes(20),
+            retention_period=Duration.days(1),
+        )
+
+        self.comprehend_aggregator_fn = _lambda.Function(
+            self,
+            id="comprehend_aggregator_fn",
+            runtime=ci_lambda_runtime,
+            handler="comprehend_aggregator.handler",
+            code=_lambda.Code.from_asset("server/lambdas"),
+            timeout=Duration.minutes(15),
+            memory_size=1024,
+            # Runs never overlap, a batch is submitted and completed once
+            reserved_concurrent_executions=1,
+            environment={
+                "QUEUE_URL": self.comprehend_batch_queue.queue_url,
+                "BUCKET": transcripts_input_bucket.bucket_name,
+                "comprehend_job_role": comprehend_job_role.role_arn,
+                "COMPREHEND_AGGREGATION_MAX_CONVERSATIONS": str(cfg.COMPREHEND_AGGREGATION_MAX_CONVERSATIONS),
+            },
+        )
+
+        events.Rule(
+            self,
+            "comprehend_aggregator_schedule",
+            enabled=cfg.COMPREHEND_AGGREGATION,
+            schedule=events.Schedule.rate(Duration.minutes(cfg.COMPREHEND_AGGREGATION_WINDOW_MINUTES)),
+            targets=[events_targets.LambdaFunction(self.comprehend_aggregator_fn)],
+        )
+
         # Summarization stack to process output json file
         summarize_fn_policy = iam.Policy(
             self,
@@ -357,6 +494,12 @@ class ServerStack(Stack):
                     ],
                 ),
             ),
+            environment={
+                "BEDROCK_MAX_WORKERS": str(cfg.BEDROCK_MAX_WORKERS),
+                "BEDROCK_REQUESTS_PER_MINUTE": str(cfg.BEDROCK_REQUESTS_PER_MINUTE),
+                "BEDROCK_TOKENS_PER_MINUTE": str(cfg.BEDROCK_TOKENS_PER_MINUTE),
+                "SUMMARIZE_MODE": cfg.SUMMARIZE_MODE,
+            },
         )
 
         self.post_processing_fn = _lambda.Function(
@@ -401,9 +544,25 @@ class ServerStack(Stack):
         transcripts_input_bucket.grant_read_write(self.transcription_output_fn.role)
         transcripts_input_bucket.grant_read_write(self.combine_file_output_fn.role)
         transcripts_input_bucket.grant_read_write(self.check_diarization_output_fn.role)
+        transcripts_input_bucket.grant_read_write(self.convert_to_wav_fn.role)
+        transcripts_input_bucket.grant_read_write(self.chunking_fn.role)
+        transcripts_input_bucket.grant_read_write(self.start_comprehension_fn.role)
+        transcripts_input_bucket.grant_read_write(self.comprehend_aggregator_fn.role)
+        self.comprehend_batch_queue.grant_consume_messages(self.comprehend_aggregator_fn)
 
         uploads_table.grant_read_write_data(self.post_processing_fn.role)
         uploads_table.grant_read_write_data(s3_trigger_lambda.role)
+        async_inference_waits_table.grant_read_write_data(self.async_inference_register_fn)
+        async_inference_waits_table.grant_read_write_data(self.async_inference_notify_fn)
+
+        for polling_fn in [self.diarization_fn, self.check_diarization_output_fn, self.transcription_fn,
+                           self.transcription_output_fn, self.start_comprehension_fn, self.check_sentiment_job_fn,
+                           self.check_entities_job_fn]:
+            polling_fn.add_environment("POLLING_STATS_TABLE", polling_stats_table.table_name)
+            polling_fn.add_environment("POLLING_MIN_WAIT_SECONDS", str(cfg.POLLING_MIN_WAIT_SECONDS))
+            polling_fn.add_environment("POLLING_MAX_WAIT_SECONDS", str(cfg.POLLING_MAX_WAIT_SECONDS))
+            polling_fn.add_environment("POLLING_MAX_ELAPSED_SECONDS", str(cfg.POLLING_MAX_ELAPSED_SECONDS))
+            polling_stats_table.grant_read_write_data(polling_fn)
 
         ml_stack_output_bucket.grant_read(self.diarization_fn)
         ml_stack_output_bucket.grant_read_write(self.transcription_fn)
@@ -420,11 +579,13 @@ class ServerStack(Stack):
         prompts.politeness_prompt.grant_read(self.summarize_fn.role)
         prompts.agent_feedback_prompt.grant_read(self.summarize_fn.role)
         prompts.customer_feedback_prompt.grant_read(self.summarize_fn.role)
+        prompts.combined_insights_prompt.grant_read(self.summarize_fn.role)
 
         self.start_comprehension_fn.role.attach_inline_policy(comprehend_job_policy)
         self.detect_language_fn.role.attach_inline_policy(comprehend_job_policy)
         self.check_sentiment_job_fn.role.attach_inline_policy(comprehend_job_policy)
         self.check_entities_job_fn.role.attach_inline_policy(comprehend_job_policy)
+        self.comprehend_aggregator_fn.role.attach_inline_policy(comprehend_job_policy)
 
         self.summarize_fn.role.attach_inline_policy(summarize_fn_policy)
 
@@ -438,6 +599,23 @@ class ServerStack(Stack):
         step_function_stack = StepFunctionStack(cdk_scope=self)
         ci_step = step_function_stack.ci_step
         ci_step.grant_start_execution(s3_trigger_lambda)
+        ci_step.grant_task_response(self.comprehend_aggregator_fn)
+
+        # Not granted on the state machine, which invokes the register function, to keep the function from
+        # depending on it
+        task_response_policy = iam.Policy(
+            self,
+            "async_inference_task_response_policy",
+            statements=[
+                iam.PolicyStatement(
+                    effect=iam.Effect.ALLOW,
+                    resources=["*"],
+                    actions=["states:SendTaskSuccess", "states:SendTaskFailure", "states:SendTaskHeartbeat"],
+                )
+            ],
+        )
+        self.async_inference_register_fn.role.attach_inline_policy(task_response_policy)
+        self.async_inference_notify_fn.role.attach_inline_policy(task_response_policy)
 
         # Adding ARN of State Machine to Lambda
         s3_trigger_lambda.add_environment("ci_workflow", ci_step.state_machine_arn)
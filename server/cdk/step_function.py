@@ -34,7 +34,10 @@ class StepFunctionStack:
                 "output_file": _aws_stepfunctions.JsonPath.string_at(
                     "$.event.output_file"
                 ),
-                "groups": _aws_stepfunctions.JsonPath.string_at("$.event.groups"),
+                "segment_index": _aws_stepfunctions.JsonPath.string_at("$.event.segment_index"),
+                "transcript_format": _aws_stepfunctions.JsonPath.string_at(
+                    "$.event.transcript_format"
+                ),
                 "txt_chunks_s3_key": _aws_stepfunctions.JsonPath.string_at(
                     "$.event.txt_chunks_s3_key"
                 ),
@@ -71,6 +74,15 @@ class StepFunctionStack:
             result_path=JsonPath.DISCARD,
         )
 
+        # Same container code run in Lambda for short calls. The result is discarded like for the Batch jobs so the
+        # state passed on is the same on both paths
+        convert_to_wav_fn_step = _aws_stepfunctions_tasks.LambdaInvoke(
+            cdk_scope,
+            id="ConvertToWAVInLambda",
+            lambda_function=cdk_scope.convert_to_wav_fn,
+            result_path=JsonPath.DISCARD,
+        )
+
         diarization_fn_step = _aws_stepfunctions_tasks.LambdaInvoke(
             cdk_scope,
             id="Diarization",
@@ -78,6 +90,55 @@ class StepFunctionStack:
             output_path="$.Payload",
         )
 
+        # Wait for the completion notification of the async endpoints, see async_inference_waits.py. The step only
+        # records the notification, the check that follows picks up the result. When no notification comes within
+        # a multiple of the expected processing time of the call the workflow falls back to polling, a failed
+        # inference fails the workflow
+        wait_for_diarization_result_step = _aws_stepfunctions_tasks.LambdaInvoke(
+            cdk_scope,
+            id="WaitForDiarizationResult",
+            lambda_function=cdk_scope.async_inference_register_fn,
+            integration_pattern=_aws_stepfunctions.IntegrationPattern.WAIT_FOR_TASK_TOKEN,
+            payload=_aws_stepfunctions.TaskInput.from_object(
+                {
+                    "task_token": JsonPath.task_token,
+                    "inference_id": JsonPath.string_at("$.event.diarization_inference_id"),
+                }
+            ),
+            result_path="$.async_notification",
+            task_timeout=_aws_stepfunctions.Timeout.at("$.event.diarization_notification_timeout_seconds"),
+        )
+
+        wait_for_transcription_result_step = _aws_stepfunctions_tasks.LambdaInvoke(
+            cdk_scope,
+            id="WaitForTranscriptionResult",
+            lambda_function=cdk_scope.async_inference_register_fn,
+            integration_pattern=_aws_stepfunctions.IntegrationPattern.WAIT_FOR_TASK_TOKEN,
+            payload=_aws_stepfunctions.TaskInput.from_object(
+                {
+                    "task_token": JsonPath.task_token,
+                    "inference_id": JsonPath.string_at("$.event.transcription_inference_id"),
+                }
+            ),
+            result_path="$.async_notification",
+            task_timeout=_aws_stepfunctions.Timeout.at("$.event.transcription_notification_timeout_seconds"),
+        )
+
+        wait_for_translation_result_step = _aws_stepfunctions_tasks.LambdaInvoke(
+            cdk_scope,
+            id="WaitForTranslationResult",
+            lambda_function=cdk_scope.async_inference_register_fn,
+            integration_pattern=_aws_stepfunctions.IntegrationPattern.WAIT_FOR_TASK_TOKEN,
+            payload=_aws_stepfunctions.TaskInput.from_object(
+                {
+                    "task_token": JsonPath.task_token,
+                    "inference_id": JsonPath.string_at("$.event.transcription_inference_id"),
+                }
+            ),
+            result_path="$.async_notification",
+            task_timeout=_aws_stepfunctions.Timeout.at("$.event.transcription_notification_timeout_seconds"),
+        )
+
         check_diarization_output_fn_step = _aws_stepfunctions_tasks.LambdaInvoke(
             cdk_scope,
             id="CheckDiarizationOutput",
@@ -137,6 +198,13 @@ class StepFunctionStack:
             result_path=JsonPath.DISCARD,
         )
 
+        chunking_fn_step = _aws_stepfunctions_tasks.LambdaInvoke(
+            cdk_scope,
+            id="ChunkingInLambda",
+            lambda_function=cdk_scope.chunking_fn,
+            result_path=JsonPath.DISCARD,
+        )
+
         detect_language_step = _aws_stepfunctions_tasks.LambdaInvoke(
             cdk_scope,
             id="DetectLanguage",
@@ -179,23 +247,24 @@ class StepFunctionStack:
             output_path="$.Payload",
         )
 
-        # Operational Steps for waiting, success and failure
+        # Operational Steps for waiting, success and failure. The check functions set the wait before their next
+        # check from the length of the call, the observed processing time and the retries so far
         wait_for_sentiment_job = _aws_stepfunctions.Wait(
             cdk_scope,
             "WaitForSentimentJob",
-            time=_aws_stepfunctions.WaitTime.duration(Duration.seconds(60)),
+            time=_aws_stepfunctions.WaitTime.seconds_path("$.event.sentiment_wait_seconds"),
         )
 
         wait_for_entities_job = _aws_stepfunctions.Wait(
             cdk_scope,
             "WaitForEntitiesJob",
-            time=_aws_stepfunctions.WaitTime.duration(Duration.seconds(30)),
+            time=_aws_stepfunctions.WaitTime.seconds_path("$.event.entities_wait_seconds"),
         )
 
         wait_for_diarization_job = _aws_stepfunctions.Wait(
             cdk_scope,
             "WaitForDiarizationJob",
-            time=_aws_stepfunctions.WaitTime.duration(Duration.seconds(30)),
+            time=_aws_stepfunctions.WaitTime.seconds_path("$.event.diarization_wait_seconds"),
         )
 
         fail_job = _aws_stepfunctions.Fail(
@@ -233,27 +302,50 @@ class StepFunctionStack:
             "$.content_type", "*wav"
         )
 
+        if_processed_in_lambda = _aws_stepfunctions.Condition.string_equals(
+            "$.event.processing_mode", "lambda"
+        )
+
         wait_for_transcription_job = _aws_stepfunctions.Wait(
             cdk_scope,
             "WaitForTranscriptionJob",
-            time=_aws_stepfunctions.WaitTime.duration(Duration.seconds(120)),
+            time=_aws_stepfunctions.WaitTime.seconds_path("$.event.transcription_wait_seconds"),
         )
 
         wait_for_translation_job = _aws_stepfunctions.Wait(
             cdk_scope,
             "WaitForTranslationJob",
-            time=_aws_stepfunctions.WaitTime.duration(Duration.seconds(120)),
+            time=_aws_stepfunctions.WaitTime.seconds_path("$.event.transcription_wait_seconds"),
+        )
+
+        if_comprehend_ran_sync = _aws_stepfunctions.Condition.string_equals(
+            "$.event.comprehend_mode", "sync"
+        )
+
+        if_comprehend_is_aggregated = _aws_stepfunctions.Condition.string_equals(
+            "$.event.comprehend_mode", "aggregate"
+        )
+
+        # Queues the conversation for the comprehend aggregator, which resumes the execution with the event holding
+        # the sentiment and entities output once the jobs of its batch are complete
+        wait_for_comprehend_batch_step = _aws_stepfunctions_tasks.SqsSendMessage(
+            cdk_scope,
+            "WaitForComprehendBatch",
+            queue=cdk_scope.comprehend_batch_queue,
+            integration_pattern=_aws_stepfunctions.IntegrationPattern.WAIT_FOR_TASK_TOKEN,
+            message_body=_aws_stepfunctions.TaskInput.from_object(
+                {
+                    "task_token": JsonPath.task_token,
+                    "event": JsonPath.object_at("$.event"),
+                }
+            ),
+            timeout=Duration.hours(12),
         )
 
         # Step Function Chain Defintions
-        post_transcription_chain = start_comprehension_step.add_retry(
-            backoff_rate=2,
-            max_attempts=10,
-            errors=[
-                "TooManyRequestsException"
-            ],
-            interval=Duration.minutes(10),
-        ).next(
+        summarize_chain = summarize_step.next(post_processing_step.next(succeed_job))
+
+        check_comprehend_jobs = (
             _aws_stepfunctions.Parallel(cdk_scope, "CheckComprehendJobStatus")
             .branch(
                 wait_for_sentiment_job.next(
@@ -288,7 +380,22 @@ class StepFunctionStack:
                     )
                 )
             )
-            .next(summarize_step.next(post_processing_step.next(succeed_job)))
+            .next(summarize_chain)
+        )
+
+        post_transcription_chain = start_comprehension_step.add_retry(
+            backoff_rate=2,
+            max_attempts=10,
+            errors=[
+                "TooManyRequestsException"
+            ],
+            interval=Duration.minutes(10),
+        ).next(
+            # Short transcripts are analyzed synchronously and have no jobs to wait for
+            _aws_stepfunctions.Choice(cdk_scope, "ComprehendJobsStarted?")
+            .when(if_comprehend_ran_sync, summarize_chain)
+            .when(if_comprehend_is_aggregated, wait_for_comprehend_batch_step.next(summarize_step))
+            .otherwise(check_comprehend_jobs)
         )
 
         translation_chain = combine_file_output_fn_step.next(
@@ -303,7 +410,11 @@ class StepFunctionStack:
                         if_file_type_is_wav.not_(if_lang_code_is_english)
                     ),
                     translation_fn_step.next(
-                        wait_for_translation_job.next(
+                        wait_for_translation_result_step.add_catch(
+                            fail_job, errors=["AsyncInferenceFailed"]
+                        ).add_catch(
+                            wait_for_translation_job, result_path=JsonPath.DISCARD
+                        ).next(
                             translation_output_fn_step.next(
                                 _aws_stepfunctions.Choice(
                                     cdk_scope,
@@ -311,7 +422,7 @@ class StepFunctionStack:
                                 )
                                 .when(
                                     should_retry_transcription_check,
-                                    wait_for_translation_job,
+                                    wait_for_translation_job.next(translation_output_fn_step),
                                 )
                                 .otherwise(
                                     combine_translation_file_output_fn_step.next(
@@ -329,13 +440,20 @@ class StepFunctionStack:
         )
 
         transcription_chain = transcription_fn_step.next(
-            wait_for_transcription_job.next(
+            wait_for_transcription_result_step.add_catch(
+                fail_job, errors=["AsyncInferenceFailed"]
+            ).add_catch(
+                wait_for_transcription_job, result_path=JsonPath.DISCARD
+            ).next(
                 transcription_output_fn_step.next(
                     _aws_stepfunctions.Choice(
                         cdk_scope,
                         "WereChunksTranscribed?",
                     )
-                    .when(should_retry_transcription_check, wait_for_transcription_job)
+                    .when(
+                        should_retry_transcription_check,
+                        wait_for_transcription_job.next(transcription_output_fn_step),
+                    )
                     .otherwise(
                         translation_chain
                     )
@@ -347,7 +465,12 @@ class StepFunctionStack:
             _aws_stepfunctions.Choice(cdk_scope, "FileType?")
             .when(
                 if_file_type_is_mp3,
-                convert_to_wav_step.next(diarization_fn_step),
+                _aws_stepfunctions.Choice(cdk_scope, "ConvertInLambda?")
+                .when(
+                    if_processed_in_lambda,
+                    convert_to_wav_fn_step.next(diarization_fn_step),
+                )
+                .otherwise(convert_to_wav_step.next(diarization_fn_step)),
             )
             .when(
                 if_file_type_is_text,
@@ -356,17 +479,28 @@ class StepFunctionStack:
             .when(
                 if_file_type_is_wav,
                 diarization_fn_step.add_catch(fail_job).next(
-                    # Add State to Wait 30 Seconds before checking next
-                    wait_for_diarization_job.next(
-                        _aws_stepfunctions.Choice(cdk_scope, "DiarizationFileDownloaded?")
-                        .when(
-                            should_retry_diarization_check,
-                            check_diarization_output_fn_step.next(
-                                wait_for_diarization_job
-                            ),
-                        )
-                        .otherwise(
-                            chunking_step.add_catch(fail_job).next(transcription_chain)
+                    wait_for_diarization_result_step.add_catch(
+                        fail_job, errors=["AsyncInferenceFailed"]
+                    ).add_catch(
+                        wait_for_diarization_job, result_path=JsonPath.DISCARD
+                    ).next(
+                        check_diarization_output_fn_step.next(
+                            _aws_stepfunctions.Choice(cdk_scope, "DiarizationFileDownloaded?")
+                            .when(
+                                should_retry_diarization_check,
+                                # Wait diarization_wait_seconds, set by the polling backoff, before checking again
+                                wait_for_diarization_job.next(check_diarization_output_fn_step),
+                            )
+                            .otherwise(
+                                _aws_stepfunctions.Choice(cdk_scope, "ChunkInLambda?")
+                                .when(
+                                    if_processed_in_lambda,
+                                    chunking_fn_step.add_catch(fail_job).next(transcription_chain),
+                                )
+                                .otherwise(
+                                    chunking_step.add_catch(fail_job).next(transcription_chain)
+                                )
+                            )
                         )
                     )
                 ),
@@ -0,0 +1,88 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  SPDX-License-Identifier: MIT-0
+
+# Benchmark for the chunk planner, e.g.
+#
+#   python3 benchmark.py --minutes 30 --min-seconds 0,4,8,15
+#   python3 benchmark.py --diarization-file call.diarization.txt
+#
+# Without --diarization-file a synthetic call is generated, with many short back-channel turns and a few long
+# monologues. Decoder calls are counted the way the transcription endpoint makes them: chunks that fit a Whisper
+# window are decoded in batches of --batch-size, longer chunks one 30 second window at a time.
+
+import argparse
+import math
+import random
+
+import chunk_planner
+
+
+def format_time(ms):
+    return f"{ms // 3600000:02d}:{ms // 60000 % 60:02d}:{ms // 1000 % 60:02d}.{ms % 1000:03d}"
+
+
+def generate_diarization(minutes, seed=7):
+    """
+    :return: Diarization lines of a synthetic two speaker call in pyannote's text format
+    """
+    rng = random.Random(seed)
+    lines = []
+    position = 500
+    speaker = 0
+    while position < minutes * 60000:
+        kind = rng.random()
+        if kind < 0.35:
+            # Back-channel, "yeah", "ok"
+            durations = [rng.randint(250, 1500)]
+        elif kind < 0.92:
+            durations = [rng.randint(1500, 9000) for _ in range(rng.randint(1, 3))]
+        else:
+            durations = [rng.randint(8000, 40000) for _ in range(rng.randint(2, 6))]
+        for duration in durations:
+            lines.append(f"[ {format_time(position)} -->  {format_time(position + duration)}] A SPEAKER_0{speaker}")
+            position += duration + rng.randint(50, 600)
+        position += rng.randint(100, 2500)
+        speaker = 1 - speaker
+    return lines
+
+
+def decoder_calls(spans, batch_size, window_ms=30000):
+    batched = sum(1 for start, end in spans if end - start <= window_ms)
+    windows = sum(math.ceil((end - start) / window_ms) for start, end in spans if end - start > window_ms)
+    return math.ceil(batched / batch_size) + windows, batched, windows
+
+
+def report(name, spans, batch_size):
+    calls, batched, windows = decoder_calls(spans, batch_size)
+    seconds = sum(end - start for start, end in spans) / 1000
+    print(f"{name:>16} {len(spans):>8} {batched:>8} {windows:>8} {calls:>8} {seconds:>10.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chunk planner benchmark")
+    parser.add_argument("--diarization-file", help="Diarization text or JSON output, a synthetic call is used if omitted")
+    parser.add_argument("--minutes", type=float, default=30, help="Length of the synthetic call")
+    parser.add_argument("--min-seconds", default="0,4,8,15", help="Comma separated minimum chunk durations")
+    parser.add_argument("--max-seconds", type=float, default=chunk_planner.chunk_max_seconds)
+    parser.add_argument("--max-gap-seconds", type=float, default=chunk_planner.chunk_max_gap_seconds)
+    parser.add_argument("--batch-size", type=int, default=8, help="Batch size of the transcription endpoint")
+    args = parser.parse_args()
+
+    if args.diarization_file:
+        content = open(args.diarization_file).read()
+    else:
+        content = "\n".join(generate_diarization(args.minutes))
+    lines = chunk_planner.parse_diarization(content)
+    turns = chunk_planner.group_turns(lines)
+    short_turns = sum(1 for turn in turns if chunk_planner.turn_span(turn)[1] - chunk_planner.turn_span(turn)[0] < 2000)
+    print(f"{len(lines)} diarization lines, {len(turns)} turns, {short_turns} shorter than 2s")
+    print(f"{'plan':>16} {'chunks':>8} {'batched':>8} {'windows':>8} {'calls':>8} {'audio s':>10}")
+
+    report("one per turn", [chunk_planner.turn_span(turn) for turn in turns], args.batch_size)
+    for min_seconds in args.min_seconds.split(","):
+        chunks = chunk_planner.plan_chunks(turns, float(min_seconds), args.max_seconds, args.max_gap_seconds)
+        report(f"min {min_seconds}s", [(chunk["start"], chunk["end"]) for chunk in chunks], args.batch_size)
+
+
+if __name__ == "__main__":
+    main()
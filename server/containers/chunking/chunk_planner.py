@@ -0,0 +1,207 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  SPDX-License-Identifier: MIT-0
+
+# Turns diarization output into speaker turns and plans the audio chunks sent to the transcription endpoint.
+# A turn is a run of diarization lines of one speaker and stays one line of the final transcript. A chunk either
+# covers several consecutive short turns or a piece of one long turn, and records where every turn starts and
+# ends so the transcript can be attributed back to its speaker.
+
+import json
+import math
+import os
+import re
+
+# Short turns are merged until the chunk is at least this long
+chunk_min_seconds = float(os.environ.get("CHUNK_MIN_SECONDS", 8))
+# Whisper decodes 30 second windows, longer turns are split at diarization line boundaries
+chunk_max_seconds = float(os.environ.get("CHUNK_MAX_SECONDS", 30))
+# Turns further apart than this are never merged, so long silences are not sent to the decoder
+chunk_max_gap_seconds = float(os.environ.get("CHUNK_MAX_GAP_SECONDS", 1.5))
+
+time_pattern = '[0-9]+:[0-9]+:[0-9]+\\.[0-9]+'
+
+
+# Utility function to change text to millisec. Rounded, so 00:00:01.477 is 1477 and not 1476
+def millisec(time_str):
+    spl = time_str.split(":")
+    s = round((int(spl[0]) * 60 * 60 + int(spl[1]) * 60 + float(spl[2])) * 1000)
+    return s
+
+
+def parse_diarization(content):
+    """
+    Reads the diarization endpoint output, either its JSON document with float second timings or pyannote's
+    text output with lines like [ 00:00:00.497 -->  00:00:01.477] A SPEAKER_00.
+
+    :return: List of diarization lines as (start_ms, end_ms, speaker) tuples
+    """
+    if content.lstrip().startswith("{"):
+        return [
+            (round(segment["start"] * 1000), round(segment["end"] * 1000), segment["speaker"])
+            for segment in json.loads(content)["segments"]
+        ]
+
+    lines = []
+    for d in content.splitlines():
+        times = re.findall(time_pattern, string=d)
+        if len(times) >= 2:
+            lines.append((millisec(times[0]), millisec(times[1]), d.split()[-1]))
+    return lines
+
+
+def group_turns(diarization_lines):
+    """
+    :param diarization_lines: Diarization lines from parse_diarization
+    :return: List of turns, every turn being the list of its diarization lines
+    """
+    groups_array = []
+    g = []
+    last_end = 0
+
+    for d in diarization_lines:
+        if g and (g[0][2] != d[2]):
+            groups_array.append(g)
+            g = []
+
+        g.append(d)
+
+        end = d[1]
+
+        # Segment engulfed by a previous segment
+        if last_end > end:
+            groups_array.append(g)
+            g = []
+        else:
+            last_end = end
+    if g:
+        groups_array.append(g)
+    return groups_array
+
+
+def line_span(line):
+    return line[0], line[1]
+
+
+def turn_span(turn):
+    # A turn runs from the start of its first line to the end of its last line
+    return line_span(turn[0])[0], line_span(turn[-1])[1]
+
+
+def split_turn(turn, max_ms):
+    """
+    Cuts a turn into pieces of at most max_ms, preferably where one of its diarization lines starts. A single line
+    longer than max_ms is cut into equal pieces. Pauses that would leave a piece without speech are left out.
+
+    :return: List of (start, end) milliseconds covering the speech of the turn
+    """
+    turn_start, turn_end = turn_span(turn)
+    cuts = [turn_start]
+    previous_end = turn_start
+    for line in turn:
+        line_start, line_end = line_span(line)
+        line_end = min(line_end, turn_end)
+        if line_end - cuts[-1] <= max_ms:
+            previous_end = max(previous_end, line_end)
+            continue
+        # Cut where the line starts, or where the previous one ended when the pause would overfill the piece
+        cut = line_start if line_start - cuts[-1] <= max_ms else previous_end
+        if cut > cuts[-1]:
+            cuts.append(cut)
+        if line_start > cuts[-1]:
+            # The pause before the line becomes a piece of its own, which is dropped below
+            cuts.append(line_start)
+        previous_end = max(previous_end, line_end)
+        remaining = line_end - cuts[-1]
+        if remaining > max_ms:
+            pieces = math.ceil(remaining / max_ms)
+            piece_start = cuts[-1]
+            cuts.extend(piece_start + remaining * k // pieces for k in range(1, pieces))
+    if turn_end > cuts[-1]:
+        cuts.append(turn_end)
+    pieces = list(zip(cuts, cuts[1:])) or [(turn_start, turn_end)]
+    # Whisper makes up text for silence, so pieces without any speech are not decoded
+    return [(start, end) for start, end in pieces
+            if any(line_span(line)[0] < end and line_span(line)[1] > start for line in turn)]
+
+
+def plan_chunks(turns, min_seconds=None, max_seconds=None, max_gap_seconds=None):
+    """
+    Merges consecutive short turns into one chunk and splits turns longer than max_seconds. A turn is merged into
+    the previous chunk while either of them is shorter than min_seconds, the chunk stays within max_seconds and
+    the silence between them is at most max_gap_seconds. min_seconds 0 disables merging.
+
+    :param turns: Turns from group_turns
+    :return: List of chunks, each a dict with start and end milliseconds and turns, the list of
+        [turn index, start, end] it covers
+    """
+    min_ms = 1000 * (chunk_min_seconds if min_seconds is None else min_seconds)
+    max_ms = 1000 * (chunk_max_seconds if max_seconds is None else max_seconds)
+    max_gap_ms = 1000 * (chunk_max_gap_seconds if max_gap_seconds is None else max_gap_seconds)
+
+    chunks = []
+    # Chunk that the next turn may still be merged into, pieces of a split turn are never merged
+    open_chunk = None
+    for tidx, turn in enumerate(turns):
+        start, end = turn_span(turn)
+        if end - start > max_ms:
+            for piece_start, piece_end in split_turn(turn, max_ms):
+                chunks.append({"start": piece_start, "end": piece_end, "turns": [[tidx, piece_start, piece_end]]})
+            open_chunk = None
+            continue
+
+        if open_chunk and start >= open_chunk["start"] \
+                and start - open_chunk["end"] <= max_gap_ms \
+                and max(end, open_chunk["end"]) - open_chunk["start"] <= max_ms \
+                and (open_chunk["end"] - open_chunk["start"] < min_ms or end - start < min_ms):
+            open_chunk["end"] = max(end, open_chunk["end"])
+            open_chunk["turns"].append([tidx, start, end])
+            continue
+
+        open_chunk = {"start": start, "end": end, "turns": [[tidx, start, end]]}
+        chunks.append(open_chunk)
+    return chunks
+
+
+def turn_speaker(turn):
+    # Diarization label, e.g. SPEAKER_00
+    return turn[0][2]
+
+
+def segment_index(turns, chunks):
+    """
+    Builds the segment index read by the combine and post processing steps instead of the diarization text.
+    Columns hold one value per turn and per chunk, speakers are stored once and referenced by position.
+
+    :return: {"version": 1, "speakers": [labels], "turns": {"start_ms", "end_ms", "speaker"},
+        "chunks": {"start_ms", "end_ms", "turns"}}, every chunk turn being [turn index, start_ms, end_ms]
+    """
+    speakers = []
+    columns = {"start_ms": [], "end_ms": [], "speaker": []}
+    for turn in turns:
+        start, end = turn_span(turn)
+        speaker = turn_speaker(turn)
+        if speaker not in speakers:
+            speakers.append(speaker)
+        columns["start_ms"].append(start)
+        columns["end_ms"].append(end)
+        columns["speaker"].append(speakers.index(speaker))
+
+    return {
+        "version": 1,
+        "speakers": speakers,
+        "turns": columns,
+        "chunks": {
+            "start_ms": [chunk["start"] for chunk in chunks],
+            "end_ms": [chunk["end"] for chunk in chunks],
+            "turns": [chunk["turns"] for chunk in chunks],
+        },
+    }
+
+
+def single_turn_chunks(turns):
+    # One chunk per turn, the layout used when the transcript has no segment timings to attribute merged turns
+    chunks = []
+    for tidx, turn in enumerate(turns):
+        start, end = turn_span(turn)
+        chunks.append({"start": start, "end": end, "turns": [[tidx, start, end]]})
+    return chunks
@@ -3,16 +3,25 @@
 #  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 #  SPDX-License-Identifier: MIT-0
 
+import json
 import logging
+import mmap
 import os
-import re
+import shutil
+import struct
 import sys
+import tempfile
 import time
-import pickle
+import wave
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from pydub import AudioSegment
 
+import chunk_planner
+
 # Getting S3 File attributes from previous step
 BUCKET = os.environ.get("BUCKET", "")
 KEY = os.environ.get("KEY", "")
@@ -20,7 +29,10 @@ output_s3_key = os.environ.get("output_s3_key", "")
 audio_wav_file = os.environ.get("audio_wav_file", "")
 audio_chunks_s3_key = os.environ.get("audio_chunks_s3_key", "")
 diarization_file = os.environ.get("diarization_file", "")
-groups = os.environ.get("groups", "")
+segment_index = os.environ.get("segment_index", "")
+transcript_format = os.environ.get("transcript_format", "txt")
+# Chunks uploaded in parallel while the rest are still being written, sharing one client and its connection pool
+upload_workers = int(os.environ.get("UPLOAD_WORKERS", 16))
 
 
 # Configuring Logger to DEBUG
@@ -28,22 +40,92 @@ logging.basicConfig(stream=sys.stdout, level=logging.INFO)
 logger = logging.getLogger()
 logger.info(f"Chunking of {audio_wav_file} from {output_s3_key}...")
 
-s3_client = boto3.client("s3")
-
-
-# Utility function to change text to millisec
-def millisec(time_str):
-    spl = time_str.split(":")
-    s = (int)((int(spl[0]) * 60 * 60 + int(spl[1]) * 60 + float(spl[2])) * 1000)
-    return s
-
-
-def upload_directory(path):
-    for root, dirs, files in os.walk(path):
-        for file in files:
-            file_path = os.path.join(root, file)
-            head, file_name = os.path.split(file_path)
-            s3_client.upload_file(file_path, BUCKET, f"{audio_chunks_s3_key}{file_name}")
+s3_client = boto3.client("s3", config=Config(max_pool_connections=max(upload_workers, 10)))
+# The pool bounds the concurrency, every upload stays on its pool thread
+single_thread_transfer = TransferConfig(use_threads=False)
+
+
+def upload_chunk(file_path):
+    head, file_name = os.path.split(file_path)
+    s3_client.upload_file(file_path, BUCKET, f"{audio_chunks_s3_key}{file_name}", Config=single_thread_transfer)
+    return os.path.getsize(file_path)
+
+
+def parse_wav_header(wav_file):
+    """
+    Walks the RIFF chunks of a WAV file to find its format and where the sample data starts.
+
+    :return: Dict with channels, sample_rate, sample_width, block_align, data_offset and data_size, or None when
+        the file is not uncompressed PCM
+    """
+    file_size = os.path.getsize(wav_file)
+    layout = None
+    with open(wav_file, "rb") as f:
+        riff, _, wave_id = struct.unpack("<4sI4s", f.read(12))
+        if riff != b"RIFF" or wave_id != b"WAVE":
+            return None
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                return None
+            chunk_id, chunk_size = struct.unpack("<4sI", header)
+            if chunk_id == b"fmt ":
+                fmt = f.read(chunk_size)
+                audio_format, channels, sample_rate, _, block_align, bits = struct.unpack("<HHIIHH", fmt[:16])
+                # WAVE_FORMAT_EXTENSIBLE keeps the actual format in the first two bytes of the sub format GUID
+                if audio_format == 0xFFFE and len(fmt) >= 26:
+                    audio_format = struct.unpack("<H", fmt[24:26])[0]
+                if audio_format != 1:
+                    return None
+                layout = {
+                    "channels": channels,
+                    "sample_rate": sample_rate,
+                    "sample_width": bits // 8,
+                    "block_align": block_align,
+                }
+                f.seek(chunk_size % 2, os.SEEK_CUR)
+            elif chunk_id == b"data":
+                if not layout:
+                    return None
+                layout["data_offset"] = f.tell()
+                # Streamed WAVs may carry a placeholder size, trust the file length instead
+                layout["data_size"] = min(chunk_size, file_size - f.tell())
+                return layout
+            else:
+                f.seek(chunk_size + chunk_size % 2, os.SEEK_CUR)
+
+
+def write_wav_chunks(wav_file, layout, spans, chunk_dir, on_chunk):
+    """
+    Writes every span of the WAV file to its own chunk by copying the PCM frames out of a memory map, so memory
+    use does not grow with the length of the call.
+
+    :param spans: List of (start, end) times in milliseconds, chunk i is written to {chunk_dir}{i}.wav
+    :param on_chunk: Called with the path of every chunk once it is complete
+    """
+    rate = layout["sample_rate"]
+    block_align = layout["block_align"]
+    frames = layout["data_size"] // block_align
+    with open(wav_file, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        for gidx, (start, end) in enumerate(spans):
+            # Same frame arithmetic as slicing a pydub AudioSegment by milliseconds
+            start_frame = min(int(start * rate / 1000.0), frames)
+            end_frame = max(min(int(end * rate / 1000.0), frames), start_frame)
+            offset = layout["data_offset"] + start_frame * block_align
+            with wave.open(chunk_dir + str(gidx) + '.wav', 'wb') as chunk:
+                chunk.setnchannels(layout["channels"])
+                chunk.setsampwidth(layout["sample_width"])
+                chunk.setframerate(rate)
+                chunk.writeframes(memoryview(data)[offset:offset + (end_frame - start_frame) * block_align])
+            on_chunk(chunk_dir + str(gidx) + '.wav')
+
+
+def write_pydub_chunks(wav_file, spans, chunk_dir, on_chunk):
+    # Fallback for WAVs that are not plain PCM, decodes the whole file into memory
+    audio = AudioSegment.from_wav(wav_file)
+    for gidx, (start, end) in enumerate(spans):
+        audio[start:end].export(chunk_dir + str(gidx) + '.wav', format='wav')
+        on_chunk(chunk_dir + str(gidx) + '.wav')
 
 
 def chunk_wav_files():
@@ -55,61 +137,77 @@ def chunk_wav_files():
     s3_client.download_file(BUCKET, f"{output_s3_key}/{diarization_file}", diarization_file)
     logger.info(f"Downloaded {diarization_file}...")
 
-    dzs = open(diarization_file).read().splitlines()
-    groups_array = []
-    g = []
-    last_end = 0
-
-    for d in dzs:
-        if g and (g[0].split()[-1] != d.split()[-1]):
-            groups_array.append(g)
-            g = []
-
-        g.append(d)
-
-        end = re.findall('[0-9]+:[0-9]+:[0-9]+\.[0-9]+', string=d)[1]
-        end = millisec(end)
-
-        # Segment engulfed by a previous segment
-        if last_end > end:
-            groups_array.append(g)
-            g = []
-        else:
-            last_end = end
-    if g:
-        groups_array.append(g)
-
-    # Chunk wav files in to chunks based on diarization data
-    audio = AudioSegment.from_wav(audio_wav_file)
-    gidx = -1
+    dzs = chunk_planner.parse_diarization(open(diarization_file).read())
+    groups_array = chunk_planner.group_turns(dzs)
 
     # create chunk directory
     does_exist = os.path.exists(audio_chunks_s3_key)
     if not does_exist:
         os.makedirs(audio_chunks_s3_key)
 
-    for g in groups_array:
-        start = re.findall('[0-9]+:[0-9]+:[0-9]+\.[0-9]+', string=g[0])[0]
-        end = re.findall('[0-9]+:[0-9]+:[0-9]+\.[0-9]+', string=g[-1])[1]
-        start = millisec(start)
-        end = millisec(end)
-        # print(start, end)
-        gidx += 1
-        audio[start:end].export(audio_chunks_s3_key + str(gidx) + '.wav', format='wav')
-
-    # print(*groups, sep='\n')
-    upload_directory(audio_chunks_s3_key)
+    # Merging turns needs the segment timings of the packed transcript to attribute the text to each speaker
+    if transcript_format == "jsonl":
+        chunks = chunk_planner.plan_chunks(groups_array)
+    else:
+        chunks = chunk_planner.single_turn_chunks(groups_array)
+    spans = [(chunk["start"], chunk["end"]) for chunk in chunks]
+    gidx = len(spans) - 1
+    merged = sum(1 for chunk in chunks if len(chunk["turns"]) > 1)
+    logger.info(f"Planned {len(chunks)} chunks for {len(groups_array)} turns, {merged} chunks merge several turns")
+
+    # Chunk wav files in to chunks based on diarization data, every chunk is uploaded as soon as it is written
+    upload_start = time.time()
+    with ThreadPoolExecutor(max_workers=upload_workers) as executor:
+        uploads = []
+        on_chunk = lambda chunk_file: uploads.append(executor.submit(upload_chunk, chunk_file))
+        layout = parse_wav_header(audio_wav_file)
+        if layout:
+            write_wav_chunks(audio_wav_file, layout, spans, audio_chunks_s3_key, on_chunk)
+        else:
+            logger.info(f"{audio_wav_file} is not PCM, chunking it with pydub...")
+            write_pydub_chunks(audio_wav_file, spans, audio_chunks_s3_key, on_chunk)
+        uploaded_bytes = sum(upload.result() for upload in uploads)
+    upload_seconds = max(time.time() - upload_start, 1e-6)
+    logger.info(f"Uploaded {len(uploads)} chunks, {uploaded_bytes / 1e6:.1f} MB in {upload_seconds:.2f}s "
+                f"({len(uploads) / upload_seconds:.1f} chunks/s, {uploaded_bytes / 1e6 / upload_seconds:.1f} MB/s) "
+                f"with {upload_workers} workers")
     print('Time taken for Chunking WAV is : ' + str(time.time() - fn_start))
 
     fn_start = time.time()
-    with open(groups, 'wb') as f:
-        pickle.dump(groups_array, f, protocol=pickle.HIGHEST_PROTOCOL)
-        f.close()
-
-    s3_client.upload_file(groups, BUCKET, f"{output_s3_key}/{groups}")
-    # Returning Chunk Indexes, Chunk Groups and WAV Chunk Folder Path
-    print('Time taken for Uploading Group File is : ' + str(time.time() - fn_start))
-    return gidx, groups, audio_chunks_s3_key
-
-
-chunk_wav_files()
+    # Turn timings, speakers and the chunk plan, chunk i being {i}.wav
+    with open(segment_index, 'w') as f:
+        json.dump(chunk_planner.segment_index(groups_array, chunks), f, separators=(",", ":"))
+
+    s3_client.upload_file(segment_index, BUCKET, f"{output_s3_key}/{segment_index}")
+    # Returning Chunk Indexes, Segment Index and WAV Chunk Folder Path
+    print('Time taken for Uploading Segment Index is : ' + str(time.time() - fn_start))
+    return gidx, segment_index, audio_chunks_s3_key
+
+
+def handler(e, context):
+    # Lambda entry point used for short calls, the Batch job runs this file as a script with the same settings
+    global BUCKET, KEY, output_s3_key, audio_wav_file, audio_chunks_s3_key, diarization_file, segment_index
+    global transcript_format
+    event = e["event"]
+    BUCKET = event["bucket"]
+    KEY = event["key"]
+    output_s3_key = event["output_s3_key"]
+    audio_wav_file = event["audio_wav_file"]
+    audio_chunks_s3_key = event["audio_chunks_s3_key"]
+    diarization_file = event["diarization_file"]
+    segment_index = event["segment_index"]
+    transcript_format = event.get("transcript_format", "txt")
+
+    # Only /tmp is writable in Lambda, use a fresh folder so warm containers do not accumulate files
+    work_dir = tempfile.mkdtemp(dir="/tmp")
+    os.chdir(work_dir)
+    try:
+        chunk_wav_files()
+    finally:
+        os.chdir("/tmp")
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return {"event": event, "status": "SUCCEEDED"}
+
+
+if __name__ == "__main__":
+    chunk_wav_files()
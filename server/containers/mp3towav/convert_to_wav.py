@@ -5,10 +5,18 @@
 
 from pydub import AudioSegment
 
+import json
 import logging
 import os
+import shutil
+import struct
+import subprocess
 import sys
+import tempfile
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+
 import boto3
 
 # Getting S3 File attributes from previous step
@@ -16,6 +24,10 @@ BUCKET = os.environ.get("BUCKET", "")
 KEY = os.environ.get("KEY", "")
 output_s3_key = os.environ.get("output_s3_key", "")
 audio_wav_file = os.environ.get("audio_wav_file", "")
+# stream pipes the MP3 through ffmpeg straight from and to S3, pydub converts a local copy in memory
+transcode_mode = os.environ.get("TRANSCODE_MODE", "stream")
+# Writes 16 kHz mono WAVs, the format diarization and transcription work with, instead of keeping the source format
+normalize_audio = os.environ.get("NORMALIZE_AUDIO", "false").lower() == "true"
 
 # Configuring Logger to DEBUG
 logging.basicConfig(stream=sys.stdout, level=logging.INFO)
@@ -26,14 +38,155 @@ s3_client = boto3.client("s3")
 
 # Constants required for entire workflow
 spacer_milli = 2000
+# pydub's silent spacer is 11025 Hz mono, appending it never lowers the sample rate or channels below these
+min_frame_rate = 11025
+sample_width = 2
+normalized_frame_rate = 16000
 
+# Multipart upload of the streamed WAV. The first part is held back until the size is known so its header can
+# be written, S3 wants every part but the last to be at least 5 MB
+min_part_size = 5 * 1024 * 1024
+part_size = int(os.environ.get("PART_SIZE_MB", 8)) * 1024 * 1024
+upload_workers = int(os.environ.get("UPLOAD_WORKERS", 4))
+read_size = 1024 * 1024
 
-# Convert mp3 file to wav format. We are returning WAV file path
-def convert_mp3_to_wav(s3_bucket, key):
-    fn_start = time.time()
-    head, mp3_file_name = os.path.split(key)
-    # Download file from S3 bucket locally to convert to wav
 
+def wav_header(channels, frame_rate, data_size):
+    # Sizes above 4 GB do not fit the header, readers then go by the file length
+    data_size = min(data_size, 0xFFFFFFFF - 36)
+    return struct.pack(
+        "<4sI4s4sIHHIIHH4sI",
+        b"RIFF", 36 + data_size, b"WAVE",
+        b"fmt ", 16, 1, channels, frame_rate, frame_rate * channels * sample_width, channels * sample_width,
+        8 * sample_width,
+        b"data", data_size,
+    )
+
+
+def probe_audio(s3_bucket, key):
+    """
+    Reads the stream parameters with ffprobe through a presigned URL, which only fetches the start of the file.
+
+    :return: (channels, frame_rate) of the WAV to write, matching what pydub produced after adding the spacer
+    """
+    url = s3_client.generate_presigned_url("get_object", Params={"Bucket": s3_bucket, "Key": key}, ExpiresIn=900)
+    result = subprocess.run(
+        ["ffprobe", "-v", "error", "-select_streams", "a:0", "-show_entries", "stream=sample_rate,channels",
+         "-of", "json", url],
+        capture_output=True, check=True,
+    )
+    stream = json.loads(result.stdout)["streams"][0]
+    return max(int(stream["channels"]), 1), max(int(stream["sample_rate"]), min_frame_rate)
+
+
+def feed_process(body, process, errors):
+    try:
+        for chunk in body.iter_chunks(read_size):
+            process.stdin.write(chunk)
+    except BrokenPipeError:
+        # ffmpeg stopped reading, its exit code tells why
+        pass
+    except Exception as e:
+        errors.append(e)
+    finally:
+        try:
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+
+
+def upload_part(s3_bucket, key, upload_id, part_number, data):
+    response = s3_client.upload_part(Bucket=s3_bucket, Key=key, UploadId=upload_id, PartNumber=part_number,
+                                      Body=data)
+    return {"PartNumber": part_number, "ETag": response["ETag"]}
+
+
+def stream_mp3_to_wav(s3_bucket, key, wav_key):
+    """
+    Decodes the MP3 with ffmpeg while it is read from S3 and multipart uploads the PCM as it is produced, so memory
+    and disk use do not depend on the length of the call. The spacer is written as silent frames in the first part,
+    which is uploaded last together with the WAV header once the data size is known.
+
+    :return: Number of bytes of the WAV
+    """
+    if normalize_audio:
+        channels, frame_rate = 1, normalized_frame_rate
+    else:
+        channels, frame_rate = probe_audio(s3_bucket, key)
+    logging.info(f"Streaming {key} as {channels} channel {frame_rate} Hz WAV...")
+    spacer = bytes(int(frame_rate * spacer_milli / 1000) * channels * sample_width)
+
+    body = s3_client.get_object(Bucket=s3_bucket, Key=key)["Body"]
+    process = subprocess.Popen(
+        ["ffmpeg", "-hide_banner", "-loglevel", "error", "-i", "pipe:0",
+         "-f", "s16le", "-acodec", "pcm_s16le", "-ac", str(channels), "-ar", str(frame_rate), "pipe:1"],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+    )
+    feed_errors = []
+    feeder = threading.Thread(target=feed_process, args=(body, process, feed_errors), daemon=True)
+    feeder.start()
+
+    upload_id = None
+    first_part = bytearray(spacer)
+    buffer = bytearray()
+    data_size = len(spacer)
+    parts = []
+    try:
+        with ThreadPoolExecutor(max_workers=upload_workers) as executor:
+            while True:
+                chunk = process.stdout.read(read_size)
+                if not chunk:
+                    break
+                data_size += len(chunk)
+                if len(first_part) < min_part_size:
+                    first_part += chunk
+                    continue
+                buffer += chunk
+                if len(buffer) < part_size:
+                    continue
+
+                if upload_id is None:
+                    upload_id = s3_client.create_multipart_upload(Bucket=s3_bucket, Key=wav_key,
+                                                                  ContentType="audio/wav")["UploadId"]
+                # Bound the parts held in memory to the ones being uploaded
+                in_flight = [part for part in parts if not part.done()]
+                if len(in_flight) >= upload_workers:
+                    in_flight[0].result()
+                parts.append(executor.submit(upload_part, s3_bucket, wav_key, upload_id, len(parts) + 2,
+                                             bytes(buffer)))
+                buffer = bytearray()
+
+            if process.wait() != 0:
+                raise RuntimeError(f"ffmpeg failed to decode {key} with exit code {process.returncode}")
+            feeder.join()
+            if feed_errors:
+                raise feed_errors[0]
+
+            header = wav_header(channels, frame_rate, data_size)
+            if upload_id is None:
+                # Short calls fit in a single request
+                s3_client.put_object(Bucket=s3_bucket, Key=wav_key, Body=header + bytes(first_part) + bytes(buffer),
+                                     ContentType="audio/wav")
+                return len(header) + data_size
+
+            if buffer:
+                parts.append(executor.submit(upload_part, s3_bucket, wav_key, upload_id, len(parts) + 2,
+                                             bytes(buffer)))
+            parts.append(executor.submit(upload_part, s3_bucket, wav_key, upload_id, 1, header + bytes(first_part)))
+            completed = sorted((part.result() for part in parts), key=lambda part: part["PartNumber"])
+
+        s3_client.complete_multipart_upload(Bucket=s3_bucket, Key=wav_key, UploadId=upload_id,
+                                            MultipartUpload={"Parts": completed})
+        return len(header) + data_size
+    except Exception:
+        process.kill()
+        if upload_id is not None:
+            s3_client.abort_multipart_upload(Bucket=s3_bucket, Key=wav_key, UploadId=upload_id)
+        raise
+
+
+def convert_mp3_to_wav_with_pydub(s3_bucket, key, mp3_file_name):
+    # Download file from S3 bucket locally to convert to wav
     s3_client.download_file(s3_bucket, key, mp3_file_name)
     logging.info(f"Downloaded {KEY} from {BUCKET}...")
 
@@ -41,17 +194,51 @@ def convert_mp3_to_wav(s3_bucket, key):
     spacer = AudioSegment.silent(duration=spacer_milli)
     audio = AudioSegment.from_mp3(mp3_file_name)
     audio = spacer.append(audio, crossfade=0)
+    if normalize_audio:
+        audio = audio.set_frame_rate(normalized_frame_rate).set_channels(1).set_sample_width(sample_width)
     logging.info(f"Creating WAV file {audio_wav_file}")
     audio.export(audio_wav_file, format="wav")
+    s3_client.upload_file(audio_wav_file, s3_bucket, f"{output_s3_key}/{audio_wav_file}")
+
 
+# Convert mp3 file to wav format. We are returning WAV file path
+def convert_mp3_to_wav(s3_bucket, key):
+    fn_start = time.time()
+    head, mp3_file_name = os.path.split(key)
+
+    if transcode_mode == "pydub":
+        convert_mp3_to_wav_with_pydub(s3_bucket, key, mp3_file_name)
+    else:
+        wav_size = stream_mp3_to_wav(s3_bucket, key, f"{output_s3_key}/{audio_wav_file}")
+        logging.info(f"Streamed {wav_size / 1e6:.1f} MB of WAV")
     logging.info("Time taken for converting to WAV is : " + str(time.time() - fn_start))
 
-    # Copying original file to output dir
-    s3_client.upload_file(mp3_file_name, s3_bucket, f"{output_s3_key}/{mp3_file_name}")
-    s3_client.upload_file(audio_wav_file, s3_bucket, f"{output_s3_key}/{audio_wav_file}")
+    # Copying original file to output dir, within S3 without passing through the container
+    s3_client.copy({"Bucket": s3_bucket, "Key": key}, s3_bucket, f"{output_s3_key}/{mp3_file_name}")
     logging.info(f"Uploaded {audio_wav_file} from {BUCKET}...")
     os.environ['audio_wav_file'] = audio_wav_file
     return audio_wav_file
 
 
-wav_file = convert_mp3_to_wav(BUCKET, KEY)
+def handler(e, context):
+    # Lambda entry point used for short calls, the Batch job runs this file as a script with the same settings
+    global BUCKET, KEY, output_s3_key, audio_wav_file
+    event = e["event"]
+    BUCKET = event["bucket"]
+    KEY = event["key"]
+    output_s3_key = event["output_s3_key"]
+    audio_wav_file = event["audio_wav_file"]
+
+    # Only /tmp is writable in Lambda, use a fresh folder so warm containers do not accumulate files
+    work_dir = tempfile.mkdtemp(dir="/tmp")
+    os.chdir(work_dir)
+    try:
+        convert_mp3_to_wav(BUCKET, KEY)
+    finally:
+        os.chdir("/tmp")
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return {"event": event, "status": "SUCCEEDED"}
+
+
+if __name__ == "__main__":
+    wav_file = convert_mp3_to_wav(BUCKET, KEY)
@@ -0,0 +1,86 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  SPDX-License-Identifier: MIT-0
+
+# Resumes the workflow when a SageMaker async inference completes, instead of waiting for the next poll. The
+# workflow registers the task token of its waiting step under the inference id, and the SNS notification of the
+# endpoint records the result under the same id. Both write to one DynamoDB item and whichever comes second
+# resumes the execution, so it does not matter which arrives first.
+
+import json
+import os
+import time
+from datetime import datetime, timezone
+
+import boto3
+from botocore.exceptions import ClientError
+
+print("Loading Async Inference Waits...")
+step_function_client = boto3.client("stepfunctions")
+table = boto3.resource("dynamodb").Table(os.environ.get("WAITS_TABLE", ""))
+# Items of notifications nobody waits for expire
+item_ttl_seconds = 2 * 24 * 3600
+
+
+def update_item(inference_id, values):
+    expression = "SET " + ", ".join(f"{name} = :{name}" for name in values)
+    response = table.update_item(
+        Key={"inferenceId": inference_id},
+        UpdateExpression=expression,
+        ExpressionAttributeValues={f":{name}": value for name, value in values.items()},
+        ReturnValues="ALL_NEW",
+    )
+    return response["Attributes"]
+
+
+def resume(item):
+    inference_id = item["inferenceId"]
+    ready_seconds = time.time() - datetime.fromisoformat(item["eventTime"].replace("Z", "+00:00")).timestamp()
+    print(f"Resuming {inference_id} {item['invocationStatus']} {ready_seconds:.1f}s after the result was ready")
+    try:
+        if item["invocationStatus"] == "Completed":
+            step_function_client.send_task_success(
+                taskToken=item["taskToken"],
+                output=json.dumps({"inference_id": inference_id, "event_time": item["eventTime"]}),
+            )
+        else:
+            step_function_client.send_task_failure(
+                taskToken=item["taskToken"],
+                error="AsyncInferenceFailed",
+                cause=str(item.get("failureReason", ""))[:32768],
+            )
+    except ClientError as e:
+        # The wait timed out meanwhile and the execution went on polling
+        print(f"Could not resume {inference_id}: {e}")
+
+
+def register(e, context):
+    """
+    Invoked by the waiting step of the workflow with its task token.
+    """
+    item = update_item(e["inference_id"], {
+        "taskToken": e["task_token"],
+        "expiresAt": int(time.time()) + item_ttl_seconds,
+    })
+    if "invocationStatus" in item:
+        # The result was ready before the workflow started waiting
+        resume(item)
+    return {"inference_id": e["inference_id"]}
+
+
+def notify(e, context):
+    """
+    Subscribed to the success and error topics of the async endpoints.
+    """
+    for record in e["Records"]:
+        message = json.loads(record["Sns"]["Message"])
+        inference_id = message.get("inferenceId")
+        if not inference_id:
+            continue
+        item = update_item(inference_id, {
+            "invocationStatus": message.get("invocationStatus", "Failed"),
+            "eventTime": message.get("eventTime") or datetime.now(timezone.utc).isoformat(),
+            "failureReason": message.get("failureReason", ""),
+            "expiresAt": int(time.time()) + item_ttl_seconds,
+        })
+        if "taskToken" in item:
+            resume(item)
@@ -1,10 +1,13 @@
 #  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 #  SPDX-License-Identifier: MIT-0
 
+import time
 import urllib
 
 import boto3
 from botocore.exceptions import ClientError
+import polling_backoff
+import result_timing
 import server_constants as cfg
 
 print("Loading Check Diarization Files...")
@@ -29,13 +32,29 @@ def handler(e, context):
         download_key = output_url.path[1:]
         upload_file_key = f"{output_key}/{diarization_file}"
         try:
-            s3_client.download_file(download_bucket, download_key, tmp_diarization_file)
-            s3_client.upload_file(tmp_diarization_file, s3_bucket, upload_file_key)
+            head = s3_client.head_object(Bucket=download_bucket, Key=download_key)
+            # Copied within S3, the function never holds the diarization
+            s3_client.copy({"Bucket": download_bucket, "Key": download_key}, s3_bucket, upload_file_key)
             event["diarization_complete"] = True
+
+            ready_time = head["LastModified"]
+            result_timing.log_result_ready_delay("diarize", "notification" if "async_notification" in e else "polling",
+                                                 ready_time)
+            if "diarization_started_at" in event:
+                polling_backoff.record_completion("diarize", event.get("audio_duration_seconds", 0),
+                                                  ready_time.timestamp() - event["diarization_started_at"])
         except ClientError as e:
-            if retry_count > max_retry_attempt:
+            started_at = event.get("diarization_started_at")
+            if started_at:
+                overdue = polling_backoff.gave_up("diarize", event.get("audio_duration_seconds", 0), started_at)
+            else:
+                overdue = retry_count > max_retry_attempt
+            if overdue:
                 with open(tmp_diarization_file, "w") as empty_file:
-                    empty_file.write("-")
+                    if event.get("diarization_format") == "json":
+                        empty_file.write('{"version": 1, "segments": [], "text": "-"}')
+                    else:
+                        empty_file.write("-")
                 empty_file.close()
                 s3_client.upload_file(tmp_diarization_file, s3_bucket, upload_file_key)
                 event["diarization_complete"] = True
@@ -44,6 +63,10 @@ def handler(e, context):
                     "event": event,
                     "status": "SUCCEEDED",
                 }
+            event["diarization_wait_seconds"] = polling_backoff.next_wait_seconds(
+                "diarize", event.get("audio_duration_seconds", 0), event.get("diarization_started_at", time.time()),
+                retry_count
+            )
             print(f"Diarization file not ready {output_key}{diarization_file}.txt")
         return {
             "event": event,
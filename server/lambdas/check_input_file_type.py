@@ -2,11 +2,100 @@
 #  SPDX-License-Identifier: MIT-0
 
 import os
+import struct
+
 import boto3
 import fleep
 
 print("Loading Check Input Function...")
 s3_client = boto3.client("s3")
+# txt writes one transcript object per chunk, jsonl a single packed transcript per conversation
+TRANSCRIPT_FORMAT = os.environ.get("TRANSCRIPT_FORMAT", "txt")
+# txt keeps pyannote's text output, json has the diarization endpoint return segments with float second timings
+DIARIZATION_FORMAT = os.environ.get("DIARIZATION_FORMAT", "txt")
+# Calls up to both limits are converted and chunked in Lambda, larger ones in AWS Batch. 0 always uses Batch
+LAMBDA_MAX_CONTENT_LENGTH = float(os.environ.get("LAMBDA_MAX_CONTENT_LENGTH_MB", 0)) * 1024 * 1024
+LAMBDA_MAX_DURATION_SECONDS = float(os.environ.get("LAMBDA_MAX_DURATION_SECONDS", 0))
+
+# MPEG audio layer III bitrates in kbps by the bitrate index of the frame header
+mpeg1_bitrates = [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320]
+mpeg2_bitrates = [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160]
+# Used when no frame header is found, low enough to overestimate the duration of a call
+fallback_kbps = 32
+# Only the start of the upload is fetched, enough for fleep, the WAV header and the first MP3 frame
+header_scan_bytes = 64 * 1024
+
+
+def read_range(s3_bucket, key, start, length):
+    response = s3_client.get_object(Bucket=s3_bucket, Key=key, Range=f"bytes={start}-{start + length - 1}")
+    return response["Body"].read()
+
+
+def mp3_byte_rate(s3_bucket, key, header):
+    """
+    Reads the bitrate of the first MPEG frame after the ID3v2 tag. For VBR files this is the rate of the first frame,
+    good enough to pick the processing path.
+
+    :param header: First bytes of the object, another range is fetched when the ID3 tag is longer
+    :return: Bytes per second of audio
+    """
+    position = 0
+    if len(header) >= 10 and header[:3] == b"ID3":
+        # Tag size is a 28 bit synchsafe integer and excludes the 10 byte tag header
+        size = header[6:10]
+        position = 10 + ((size[0] & 0x7F) << 21 | (size[1] & 0x7F) << 14 | (size[2] & 0x7F) << 7 | size[3] & 0x7F)
+    if position + 4 <= len(header):
+        data = header[position:]
+    else:
+        # Embedded cover art can make the tag larger than the header
+        data = read_range(s3_bucket, key, position, header_scan_bytes)
+    for i in range(len(data) - 2):
+        if data[i] != 0xFF or data[i + 1] & 0xE0 != 0xE0:
+            continue
+        version = (data[i + 1] >> 3) & 3
+        layer = (data[i + 1] >> 1) & 3
+        index = data[i + 2] >> 4
+        # Version 1 is reserved, layer 1 is layer III
+        if version == 1 or layer != 1 or index in (0, 15):
+            continue
+        kbps = (mpeg1_bitrates if version == 3 else mpeg2_bitrates)[index]
+        return kbps * 1000 / 8
+    return fallback_kbps * 1000 / 8
+
+
+def wav_byte_rate(header):
+    if len(header) < 36 or header[:4] != b"RIFF" or header[8:12] != b"WAVE" or header[12:16] != b"fmt ":
+        return None
+    return struct.unpack_from("<I", header, 28)[0] or None
+
+
+def audio_duration(s3_bucket, key, content_type, content_length, header):
+    """
+    :return: Estimated duration of the call in seconds, or None when the header could not be read
+    """
+    if content_type in ("mp3", "audio/mp3"):
+        byte_rate = mp3_byte_rate(s3_bucket, key, header)
+    else:
+        byte_rate = wav_byte_rate(header)
+    if not byte_rate:
+        return None
+    duration = content_length / byte_rate
+    print(f"Estimated duration {duration:.0f}s for {content_length / 1e6:.1f} MB")
+    return duration
+
+
+def processing_mode(content_length, duration):
+    """
+    Picks where the WAV conversion and chunking run. Both paths run the same container code and write the same
+    files, Lambda avoids waiting for the Batch queue and a Fargate task for short calls.
+
+    :return: "lambda" or "batch"
+    """
+    if not LAMBDA_MAX_CONTENT_LENGTH or not LAMBDA_MAX_DURATION_SECONDS or content_length > LAMBDA_MAX_CONTENT_LENGTH:
+        return "batch"
+    if duration is None:
+        return "batch"
+    return "lambda" if duration <= LAMBDA_MAX_DURATION_SECONDS else "batch"
 
 
 def handler(event, context):
@@ -14,8 +103,9 @@ def handler(event, context):
     s3_bucket = event["bucket"]
     key = event["key"]
     try:
-        response = s3_client.get_object(Bucket=s3_bucket, Key=key)
+        response = s3_client.head_object(Bucket=s3_bucket, Key=key)
         content_type = response["ContentType"]
+        content_length = response["ContentLength"]
         # Create all input variables that are required
         head, file_name = os.path.split(key)
 
@@ -25,16 +115,9 @@ def handler(event, context):
         output_key = 'output/' + job_id
         chat_transcript_file_path = file_name_without_extn + ".original.txt"
 
-        # Download original transcript file
-        temp_file_path = "/tmp/" + file_name_without_extn
-        s3_client.download_file(
-            s3_bucket,
-            key,
-            temp_file_path,
-        )
-
-        with open(temp_file_path, "rb") as file:
-            info = fleep.get(file.read(128))
+        # Only the header is read to detect the type, copies to the output folder are made within S3
+        header = read_range(s3_bucket, key, 0, header_scan_bytes) if content_length else b""
+        info = fleep.get(header[:128])
 
         print("File Type as detected by Fleep")
         print(info.type)
@@ -44,18 +127,24 @@ def handler(event, context):
         if info.extension:
             content_type = info.extension[0]
 
+        mode = "batch"
+        duration = None
         if content_type == 'mp3' or content_type == "audio/mp3":
             wav_file_name = file_name_without_extn + ".wav"
             event['audio_wav_file'] = wav_file_name
+            duration = audio_duration(s3_bucket, key, content_type, content_length, header)
+            mode = processing_mode(content_length, duration)
 
         elif content_type == 'wav' or content_type == "audio/wav":
             # Copying WAV File to output folder
             wav_file_name = file_name_without_extn + ".wav"
-            s3_client.upload_file(temp_file_path, s3_bucket, f"{output_key}/{wav_file_name}")
+            s3_client.copy({"Bucket": s3_bucket, "Key": key}, s3_bucket, f"{output_key}/{wav_file_name}")
             event['audio_wav_file'] = wav_file_name
+            duration = audio_duration(s3_bucket, key, content_type, content_length, header)
+            mode = processing_mode(content_length, duration)
 
         elif content_type == 'text/plain':
-            s3_client.upload_file(temp_file_path, s3_bucket, f"{output_key}/{chat_transcript_file_path}")
+            s3_client.copy({"Bucket": s3_bucket, "Key": key}, s3_bucket, f"{output_key}/{chat_transcript_file_path}")
 
         else:
             return {
@@ -69,16 +158,21 @@ def handler(event, context):
         event['output_s3_key'] = output_key
         event['audio_chunks_s3_key'] = output_key + "/chunks/"
         event['txt_chunks_s3_key'] = output_key + "/txt_chunks/"
-        event['diarization_file'] = file_name_without_extn + '.diarization.txt'
+        event['diarization_file'] = file_name_without_extn + '.diarization.' + DIARIZATION_FORMAT
         event['output_file'] = file_name_without_extn + ".json"
         event['original_transcription_file'] = chat_transcript_file_path
         event['dominant_language_code'] = 'original'
         event['dominant_language'] = 'original'
-        event['groups'] = 'groups'
+        event['segment_index'] = 'segment_index.json'
         event['diarization_complete'] = False
         event['diarization_retry_count'] = 0
         event['transcription_complete'] = False
         event['transcription_retries'] = 0
+        event['transcript_format'] = TRANSCRIPT_FORMAT
+        event['diarization_format'] = DIARIZATION_FORMAT
+        event['processing_mode'] = mode
+        # Sets how long the workflow waits between checks of the endpoint results
+        event['audio_duration_seconds'] = round(duration) if duration else 0
 
         return {
             "event": event,
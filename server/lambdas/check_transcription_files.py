@@ -1,17 +1,20 @@
 #  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 #  SPDX-License-Identifier: MIT-0
 
-import boto3
+import time
 import urllib
+
+import boto3
 from botocore.exceptions import ClientError
 
+import polling_backoff
+import result_timing
 import server_constants as cfg
 
 print("Loading Check Transcription Files...")
 s3_client = boto3.client("s3")
-tmp_prefix = "/tmp/"
 
-# This will allow the loop to wait for 40 loops * 30 seconds = 20 mins
+# Checks before giving up when the start time of the request is unknown, polling_backoff bounds the time otherwise
 max_retry_attempt = cfg.LAMBDA_MAX_RETRIES
 
 
@@ -27,20 +30,34 @@ def handler(e, context):
         retry_count = retry_count + 1
         try:
             task = "transcribe" if ((language == "original") or (language == "en")) else "translate"
-            input_param_file_path = f"{tmp_prefix}{task}.json"
 
             output_url = urllib.parse.urlparse(transcription_output_uri)
-            download_bucket = output_url.netloc
-            download_key = output_url.path[1:]
+            output_bucket = output_url.netloc
+            output_key = output_url.path[1:]
 
-            s3_client.download_file(download_bucket, download_key, input_param_file_path)
-            transcription_output = open(input_param_file_path, "r")
+            # The endpoint writes its response once all chunks are transcribed, only its presence matters
+            head = s3_client.head_object(Bucket=output_bucket, Key=output_key)
             print(f"Transcription completed at {transcription_output_uri}")
             event['transcription_complete'] = True
-            transcription_output.close()
+
+            ready_time = head["LastModified"]
+            result_timing.log_result_ready_delay(task, "notification" if "async_notification" in e else "polling",
+                                                 ready_time)
+            if "transcription_started_at" in event:
+                polling_backoff.record_completion(task, event.get("audio_duration_seconds", 0),
+                                                  ready_time.timestamp() - event["transcription_started_at"])
         except ClientError as e:
-            if retry_count > max_retry_attempt:
+            started_at = event.get("transcription_started_at")
+            if started_at:
+                overdue = polling_backoff.gave_up(task, event.get("audio_duration_seconds", 0), started_at)
+            else:
+                overdue = retry_count > max_retry_attempt
+            if overdue:
                 raise e
+            event["transcription_wait_seconds"] = polling_backoff.next_wait_seconds(
+                task, event.get("audio_duration_seconds", 0), event.get("transcription_started_at", time.time()),
+                retry_count
+            )
         return {"event": event, "status": "SUCCEEDED"}
     except Exception as e:
         print(e)
@@ -1,55 +1,121 @@
 #  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 #  SPDX-License-Identifier: MIT-0
 
-import pickle
+import io
+import json
+import os
 import re
 import time
+from concurrent.futures import ThreadPoolExecutor
+
 import boto3
+from botocore.config import Config
+
+import segment_index
 import server_constants
 
 print("Loading Combing Transcription Files...")
-s3_client = boto3.client("s3")
-tmp_prefix = '/tmp/'
+# Chunk transcripts fetched in parallel, sharing one client and its connection pool
+fetch_workers = int(os.environ.get("FETCH_WORKERS", 32))
+s3_client = boto3.client("s3", config=Config(max_pool_connections=max(fetch_workers, 10)))
+
+
+def read_packed_transcript(BUCKET, txt_chunks_s3_key, file_prefix):
+    """
+    Reads the packed transcript written by the transcription endpoint with a single GET.
+
+    :return: Dictionary of chunk index to its record, holding the text and the segment timings of the chunk
+    """
+    packed_key = txt_chunks_s3_key + server_constants.PACKED_TRANSCRIPT_FILE.format(file_prefix)
+    response = s3_client.get_object(Bucket=BUCKET, Key=packed_key)
+    records = dict()
+    for line in response["Body"].iter_lines():
+        if line:
+            record = json.loads(line)
+            records[int(record["gidx"])] = record
+    return records
+
+
+def read_chunk_captions(BUCKET, key):
+    response = s3_client.get_object(Bucket=BUCKET, Key=key)
+    # Same line splitting as reading a downloaded copy in text mode
+    return io.TextIOWrapper(io.BytesIO(response["Body"].read()), encoding="utf-8").readlines()
+
+
+def read_txt_transcripts(BUCKET, txt_chunks_s3_key, file_prefix, count):
+    """
+    Fetches the transcript of every chunk written one object per chunk, with a bounded number of requests in flight.
+
+    :return: List of caption lines per chunk, in chunk order
+    """
+    keys = [f"{txt_chunks_s3_key}{gidx}.{file_prefix}.txt" for gidx in range(count)]
+    with ThreadPoolExecutor(max_workers=fetch_workers) as executor:
+        return list(executor.map(lambda key: read_chunk_captions(BUCKET, key), keys))
+
+
+def find_turn(turns, time_ms):
+    # Turn holding the given time, or the closest one when the time falls in a gap between turns
+    for tidx, start, end in turns:
+        if start <= time_ms <= end:
+            return tidx
+    return min(turns, key=lambda turn: min(abs(turn[1] - time_ms), abs(turn[2] - time_ms)))[0]
+
+
+def packed_turn_captions(records, chunks):
+    """
+    Spreads the packed transcript of the planned chunks over the speaker turns. A chunk covering one turn, or a
+    piece of it, gives the turn its whole text. In a chunk merging several turns every segment goes to the turn
+    holding the middle of the segment.
+
+    :param records: Packed transcript records by chunk index
+    :param chunks: Chunks of the segment index
+    :return: Dictionary of turn index to its caption lines
+    """
+    texts = dict()
+    for cidx, chunk in enumerate(chunks):
+        record = records.get(cidx)
+        if record is None:
+            continue
+        turns = chunk["turns"]
+        if len(turns) == 1:
+            tidx = turns[0][0]
+            texts[tidx] = texts.get(tidx, "") + record["text"]
+            continue
+
+        turn_texts = {tidx: " " for tidx, _, _ in turns}
+        for segment in record["segments"]:
+            middle = chunk["start_ms"] + 1000 * (segment["start"] + segment["end"]) / 2
+            turn_texts[find_turn(turns, middle)] += segment["text"]
+        for tidx, text in turn_texts.items():
+            texts[tidx] = texts.get(tidx, "") + text
+    return {tidx: text.splitlines(True) for tidx, text in texts.items()}
+
+
+def combine_txt_transcriptions(TRANSCRIPTION_FILE_NAME, segment_index_file, txt_chunks_s3_key, language, BUCKET,
+                               output_s3_key, transcript_format="txt"):
+    fn_start = time.time()
 
-spacermilli = 2000
-def millisec(time_str):
-    spl = time_str.split(":")
-    s = int((int(spl[0]) * 60 * 60 + int(spl[1]) * 60 + float(spl[2])) * 1000)
-    return s
+    # Speaker turns and transcription chunks written by the chunking job
+    index = segment_index.read_segment_index(s3_client, BUCKET, f"{output_s3_key}/{segment_index_file}")
 
+    turns = segment_index.turns(index)
+    lines = []
 
-def combine_txt_transcriptions(TRANSCRIPTION_FILE_NAME, groups, txt_chunks_s3_key, language, BUCKET, output_s3_key):
-    fn_start = time.time()
-    gidx = -1
-
-    # Download Group
-    tmp_groups = tmp_prefix + groups
-    s3_client.download_file(BUCKET, f"{output_s3_key}/{groups}", tmp_groups)
-    group_file = open(tmp_groups, "rb")
-    groups = pickle.load(group_file)
-
-    local_transcription_file = tmp_prefix + TRANSCRIPTION_FILE_NAME
-    text_file = open(local_transcription_file, "w")
-
-    for g in groups:
-        shift = re.findall("[0-9]+:[0-9]+:[0-9]+\.[0-9]+", string=g[0])[0]
-        # Start time in the original video
-        shift = millisec(shift) - spacermilli
-        shift = max(shift, 0)
-        gidx += 1
-
-        file_prefix = language
-        if language != 'original' and language != 'en':
-            file_prefix = "translated"
-        # Download chunks locally to combine
-        download_file_path = f"{txt_chunks_s3_key}{gidx}.{file_prefix}.txt"
-        tmp_chunk_path = f"{tmp_prefix}{gidx}.{file_prefix}.txt"
-
-        s3_client.download_file(BUCKET, download_file_path, tmp_chunk_path)
-        captions = open(tmp_chunk_path, "r+")
+    file_prefix = language
+    if language != 'original' and language != 'en':
+        file_prefix = "translated"
+
+    if transcript_format == "jsonl":
+        packed_captions = packed_turn_captions(read_packed_transcript(BUCKET, txt_chunks_s3_key, file_prefix),
+                                               segment_index.chunks(index))
+        # Turns whose chunks were not decoded, e.g. without speech, have no record
+        turn_captions = [packed_captions.get(gidx, []) for gidx in range(len(turns))]
+    else:
+        turn_captions = read_txt_transcripts(BUCKET, txt_chunks_s3_key, file_prefix, len(turns))
 
+    for turn, captions in zip(turns, turn_captions):
         if captions:
-            speaker = g[0].split()[-1]
+            speaker = turn["speaker"]
             if speaker in server_constants.SPEAKERS:
                 speaker = server_constants.SPEAKERS[speaker]
                 # Removing speaker text with (), comma and other characters
@@ -57,16 +123,12 @@ def combine_txt_transcriptions(TRANSCRIPTION_FILE_NAME, groups, txt_chunks_s3_ke
                 for c in captions:
                     s = speaker_str + ":" + str(c)
                     res = re.sub(r"[!\n]", "", s)
-                    text_file.write(res + "\n")
-        captions.close()
-
-    group_file.close()
-    text_file.close()
+                    lines.append(res + "\n")
 
-    s3_client.upload_file(
-        local_transcription_file,
-        BUCKET,
-        f"{output_s3_key}/{TRANSCRIPTION_FILE_NAME}",
+    s3_client.put_object(
+        Bucket=BUCKET,
+        Key=f"{output_s3_key}/{TRANSCRIPTION_FILE_NAME}",
+        Body="".join(lines).encode("utf-8"),
     )
     print(
         "Time taken for combining all transcriptions : " + str(time.time() - fn_start)
@@ -83,17 +145,19 @@ def handler(e, context):
     event = e["event"]
     BUCKET = event["bucket"]
     output_s3_key = event["output_s3_key"]
-    groups = event["groups"]
+    segment_index_file = event["segment_index"]
     txt_chunks_s3_key = event["txt_chunks_s3_key"]
     TRANSCRIPTION_FILE_NAME = str(event["original_transcription_file"])
     language = event["dominant_language_code"]
+    transcript_format = event.get("transcript_format", "txt")
 
     if language != 'original' and language != 'en':
         TRANSCRIPTION_FILE_NAME = TRANSCRIPTION_FILE_NAME.replace('original', 'translated')
         TRANSCRIPTION_FILE_NAME = TRANSCRIPTION_FILE_NAME.replace('en', 'translated')
 
     try:
-        combine_txt_transcriptions(TRANSCRIPTION_FILE_NAME, groups, txt_chunks_s3_key, language, BUCKET, output_s3_key)
+        combine_txt_transcriptions(TRANSCRIPTION_FILE_NAME, segment_index_file, txt_chunks_s3_key, language, BUCKET,
+                                   output_s3_key, transcript_format)
         return {"event": event, "status": "SUCCEEDED"}
 
     except Exception as e:
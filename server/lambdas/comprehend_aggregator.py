@@ -0,0 +1,255 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  SPDX-License-Identifier: MIT-0
+
+# Runs the Comprehend sentiment and entities jobs of many conversations together, so the number of concurrent jobs
+# does not grow with the number of conversations. Workflow executions queue their event with a task token and wait.
+# Every run of this function, on a schedule, first checks the batches it submitted before: once both jobs are
+# complete their output is split back into the sentiment and entities output of each conversation and the
+# executions are resumed. It then combines the transcripts queued since the last run into one ONE_DOC_PER_LINE
+# file and starts one sentiment and one entities job over it. The manifest of a batch keeps the first line and
+# the line count of every conversation in the combined file:
+#
+#   {"batch_id": ..., "sentiment_job_id": ..., "entities_job_id": ...,
+#    "conversations": [{"task_token": ..., "event": {...}, "first_line": 0, "line_count": 42}, ...]}
+
+import bisect
+import io
+import json
+import os
+import tarfile
+import time
+import uuid
+from urllib.parse import urlparse
+
+import boto3
+from botocore.exceptions import ClientError
+
+import start_comprehension
+
+print("Loading Comprehend Aggregator...")
+sqs_client = boto3.client("sqs")
+s3_client = boto3.client("s3")
+comprehend_client = boto3.client(service_name="comprehend")
+step_function_client = boto3.client("stepfunctions")
+
+QUEUE_URL = os.environ.get("QUEUE_URL", "")
+BUCKET = os.environ.get("BUCKET", "")
+comprehend_job_role = os.environ.get("comprehend_job_role", "")
+# Conversations combined into one pair of jobs, the rest wait for the next run
+max_conversations = int(os.environ.get("COMPREHEND_AGGREGATION_MAX_CONVERSATIONS", 500))
+batch_prefix = "comprehend_batches/"
+manifest_file_name = "manifest.json"
+input_file_name = "transcripts.txt"
+
+
+def receive_requests():
+    """
+    :return: Queued requests, at most max_conversations, without the duplicates a standard queue can deliver
+    """
+    messages = dict()
+    while len(messages) < max_conversations:
+        response = sqs_client.receive_message(
+            QueueUrl=QUEUE_URL,
+            MaxNumberOfMessages=min(10, max_conversations - len(messages)),
+            WaitTimeSeconds=1,
+        )
+        received = response.get("Messages", [])
+        if not received:
+            break
+        for message in received:
+            body = json.loads(message["Body"])
+            if body["task_token"] in messages:
+                delete_messages([message])
+                continue
+            messages[body["task_token"]] = dict(message, request=body)
+    return list(messages.values())
+
+
+def delete_messages(messages):
+    for i in range(0, len(messages), 10):
+        sqs_client.delete_message_batch(
+            QueueUrl=QUEUE_URL,
+            Entries=[
+                {"Id": str(j), "ReceiptHandle": message["ReceiptHandle"]}
+                for j, message in enumerate(messages[i:i + 10])
+            ],
+        )
+
+
+def read_transcript_lines(event):
+    key = f"{event['output_s3_key']}/{event['original_transcription_file']}"
+    response = s3_client.get_object(Bucket=event["bucket"], Key=key)
+    # Same line splitting as post processing, which matches the job output back to the transcript by line number
+    lines = io.TextIOWrapper(io.BytesIO(response["Body"].read()), encoding="utf-8").readlines()
+    return [line.rstrip("\n") + "\n" for line in lines]
+
+
+def fail_conversation(task_token, error, cause):
+    try:
+        step_function_client.send_task_failure(taskToken=task_token, error=error, cause=cause[:32768])
+    except ClientError as e:
+        # The execution timed out or was stopped meanwhile
+        print(f"Could not fail task: {e}")
+
+
+def submit_batch(messages):
+    """
+    Combines the transcripts of the queued conversations into one file and starts the jobs over it.
+
+    :return: Batch id
+    """
+    batch_id = time.strftime("%Y%m%d%H%M%S") + "-" + uuid.uuid4().hex[:8]
+    batch_key = f"{batch_prefix}{batch_id}"
+    conversations = []
+    lines = []
+    for message in messages:
+        request = message["request"]
+        try:
+            transcript_lines = read_transcript_lines(request["event"])
+        except ClientError as e:
+            print(f"Could not read the transcript of {request['event'].get('output_s3_key')}: {e}")
+            fail_conversation(request["task_token"], "TranscriptNotFound", str(e))
+            continue
+        conversations.append({
+            "task_token": request["task_token"],
+            "event": request["event"],
+            "first_line": len(lines),
+            "line_count": len(transcript_lines),
+        })
+        lines.extend(transcript_lines)
+
+    if conversations and not lines:
+        # Nothing to analyze, Comprehend rejects an empty input
+        for conversation in conversations:
+            resume_conversation(conversation, [], [])
+    elif conversations:
+        s3_client.put_object(Bucket=BUCKET, Key=f"{batch_key}/input/{input_file_name}",
+                             Body="".join(lines).encode("utf-8"))
+        s3_uri = f"s3://{BUCKET}/{batch_key}/input/{input_file_name}"
+        # Language is hardcoded as in start_comprehension, the transcripts are in English
+        sentiment_response = start_comprehension.detect_sentiment("en", comprehend_job_role, s3_uri,
+                                                                  f"s3://{BUCKET}/{batch_key}/sentiment")
+        entities_response = start_comprehension.detect_entities("en", comprehend_job_role, s3_uri,
+                                                                f"s3://{BUCKET}/{batch_key}/entities")
+        manifest = {
+            "batch_id": batch_id,
+            "sentiment_job_id": sentiment_response["JobId"],
+            "entities_job_id": entities_response["JobId"],
+            "conversations": conversations,
+        }
+        s3_client.put_object(Bucket=BUCKET, Key=f"{batch_key}/{manifest_file_name}",
+                             Body=json.dumps(manifest).encode("utf-8"))
+        print(f"Submitted batch {batch_id} with {len(conversations)} conversations and {len(lines)} lines")
+
+    # The manifest now holds the task tokens
+    delete_messages(messages)
+    return batch_id
+
+
+def read_job_output(output_uri):
+    """
+    :return: Result records of a completed job, one per line of the combined input
+    """
+    output_url = urlparse(output_uri, allow_fragments=False)
+    response = s3_client.get_object(Bucket=output_url.netloc, Key=output_url.path[1:])
+    records = []
+    with tarfile.open(fileobj=io.BytesIO(response["Body"].read()), mode="r:gz") as tar:
+        for member in tar.getmembers():
+            f = tar.extractfile(member)
+            if f is not None:
+                records.extend(json.loads(line) for line in f.readlines() if line.strip())
+    return records
+
+
+def split_job_output(records, conversations):
+    """
+    Maps every record of the combined job output back to its conversation and the line within it.
+
+    :return: List of records per conversation, in the order of the manifest
+    """
+    first_lines = [conversation["first_line"] for conversation in conversations]
+    split = [[] for _ in conversations]
+    for record in records:
+        cidx = bisect.bisect_right(first_lines, record["Line"]) - 1
+        if cidx < 0 or record["Line"] >= first_lines[cidx] + conversations[cidx]["line_count"]:
+            continue
+        conversation = conversations[cidx]
+        record["Line"] -= conversation["first_line"]
+        record["File"] = conversation["event"]["original_transcription_file"]
+        split[cidx].append(record)
+    return split
+
+
+def resume_conversation(conversation, sentiment_records, entities_records):
+    event = conversation["event"]
+    # Same place and fields as the synchronous path
+    sentiment_output_file = f"{event['output_s3_key']}/sentiment/output.tar.gz"
+    entities_output_file = f"{event['output_s3_key']}/entities/output.tar.gz"
+    start_comprehension.write_job_output(event["bucket"], sentiment_output_file, sentiment_records)
+    start_comprehension.write_job_output(event["bucket"], entities_output_file, entities_records)
+    event["sentiment_job_output_file"] = sentiment_output_file
+    event["sentiment_job_status"] = True
+    event["entities_job_output_file"] = entities_output_file
+    event["entities_job_status"] = True
+    try:
+        step_function_client.send_task_success(
+            taskToken=conversation["task_token"],
+            output=json.dumps({"event": event, "status": "SUCCEEDED"}),
+        )
+    except ClientError as e:
+        print(f"Could not resume {event['output_s3_key']}: {e}")
+
+
+def complete_batch(manifest, sentiment_output_uri, entities_output_uri):
+    conversations = manifest["conversations"]
+    sentiment = split_job_output(read_job_output(sentiment_output_uri), conversations)
+    entities = split_job_output(read_job_output(entities_output_uri), conversations)
+    for conversation, sentiment_records, entities_records in zip(conversations, sentiment, entities):
+        resume_conversation(conversation, sentiment_records, entities_records)
+
+
+def check_batches():
+    """
+    Completes or fails the submitted batches whose jobs have finished.
+
+    :return: Number of batches still running
+    """
+    running = 0
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=BUCKET, Prefix=batch_prefix):
+        for item in page.get("Contents", []):
+            if not item["Key"].endswith("/" + manifest_file_name):
+                continue
+            manifest = json.loads(s3_client.get_object(Bucket=BUCKET, Key=item["Key"])["Body"].read())
+            sentiment_job = comprehend_client.describe_sentiment_detection_job(
+                JobId=manifest["sentiment_job_id"]
+            )["SentimentDetectionJobProperties"]
+            entities_job = comprehend_client.describe_entities_detection_job(
+                JobId=manifest["entities_job_id"]
+            )["EntitiesDetectionJobProperties"]
+            statuses = {sentiment_job["JobStatus"], entities_job["JobStatus"]}
+
+            if statuses & {"FAILED", "STOPPED", "STOP_REQUESTED"}:
+                cause = sentiment_job.get("Message") or entities_job.get("Message") or "Comprehend job failed"
+                for conversation in manifest["conversations"]:
+                    fail_conversation(conversation["task_token"], "ComprehendJobFailed", cause)
+            elif statuses == {"COMPLETED"}:
+                complete_batch(manifest, sentiment_job["OutputDataConfig"]["S3Uri"],
+                               entities_job["OutputDataConfig"]["S3Uri"])
+            else:
+                running += 1
+                continue
+            print(f"Batch {manifest['batch_id']} is {', '.join(sorted(statuses))}")
+            s3_client.delete_object(Bucket=BUCKET, Key=item["Key"])
+    return running
+
+
+def handler(e, context):
+    running = check_batches()
+    messages = receive_requests()
+    batch_id = submit_batch(messages) if messages else None
+    return {
+        "running_batches": running,
+        "submitted_batch": batch_id,
+        "conversations": len(messages),
+    }
@@ -1,9 +1,13 @@
 #  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 #  SPDX-License-Identifier: MIT-0
 
-import boto3
+import time
 from urllib.parse import urlparse
 
+import boto3
+
+import polling_backoff
+
 print("Checking if sentiment job is complete...")
 s3_client = boto3.client("s3")
 comprehend_client = boto3.client(service_name="comprehend")
@@ -28,6 +32,15 @@ def handler(e, context):
 
     print(f"Entities Detection Job {entities_job_id} is {check_entities_job_status}!!")
     event['entities_job_status'] = check_entities_job_status
+    if check_entities_job_status:
+        job = describe_job_response["EntitiesDetectionJobProperties"]
+        polling_backoff.record_completion("entities", 1, (job["EndTime"] - job["SubmitTime"]).total_seconds())
+    else:
+        retry_count = int(event.get("entities_retries", 0)) + 1
+        event["entities_retries"] = retry_count
+        event["entities_wait_seconds"] = polling_backoff.next_wait_seconds(
+            "entities", 1, event.get("comprehend_started_at", time.time()), retry_count
+        )
 
     return {
         "event": event,
@@ -1,9 +1,13 @@
 #  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 #  SPDX-License-Identifier: MIT-0
 
-import boto3
+import time
 from urllib.parse import urlparse
 
+import boto3
+
+import polling_backoff
+
 print("Checking if sentiment job is complete...")
 s3_client = boto3.client("s3")
 comprehend_client = boto3.client(service_name="comprehend")
@@ -33,6 +37,15 @@ def handler(e, context):
 
     print(f"Sentiment Detection Job {sentiment_job_id} is {check_sentiment_job_status}!!")
     event['sentiment_job_status'] = check_sentiment_job_status
+    if check_sentiment_job_status:
+        job = describe_job_response["SentimentDetectionJobProperties"]
+        polling_backoff.record_completion("sentiment", 1, (job["EndTime"] - job["SubmitTime"]).total_seconds())
+    else:
+        retry_count = int(event.get("sentiment_retries", 0)) + 1
+        event["sentiment_retries"] = retry_count
+        event["sentiment_wait_seconds"] = polling_backoff.next_wait_seconds(
+            "sentiment", 1, event.get("comprehend_started_at", time.time()), retry_count
+        )
 
     return {
         "event": event,
@@ -2,9 +2,12 @@
 #  SPDX-License-Identifier: MIT-0
 
 import os
+import time
 import boto3
 import json
 
+import polling_backoff
+
 print("Loading Diarization Function...")
 s3_client = boto3.client("s3")
 sagemaker_client = boto3.client("sagemaker")
@@ -23,7 +26,8 @@ def handler(e, context):
     try:
         param_data = {
             "input_location": f"s3://{s3_bucket}/{output_key}/{wav_file}",
-            "task": "Diarize"
+            "task": "Diarize",
+            "output_format": event.get("diarization_format", "txt"),
         }
         diarization_file_suffix = "diarization_parameter.json"
         input_param_file_path = "/tmp/" + diarization_file_suffix
@@ -36,6 +40,7 @@ def handler(e, context):
             input_param_file_path, s3_bucket, diarization_param_s3_key
         )
 
+        started_at = time.time()
         response = sagemaker_runtime.invoke_endpoint_async(
             EndpointName=model_endpoint,
             InputLocation=f"s3://{s3_bucket}/{diarization_param_s3_key}",
@@ -44,6 +49,15 @@ def handler(e, context):
 
         output_location = response["OutputLocation"]
         event["diarization_out_path"] = output_location
+        # Identifies the completion notification of the endpoint
+        event["diarization_inference_id"] = response["InferenceId"]
+        event["diarization_started_at"] = started_at
+        event["diarization_wait_seconds"] = polling_backoff.next_wait_seconds(
+            "diarize", event.get("audio_duration_seconds", 0), started_at, 0
+        )
+        event["diarization_notification_timeout_seconds"] = polling_backoff.notification_timeout_seconds(
+            "diarize", event.get("audio_duration_seconds", 0)
+        )
         print(f"Diarization Output Location: {output_location}")
         return {"event": event, "status": "SUCCEEDED"}
     except Exception as e:
@@ -0,0 +1,116 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  SPDX-License-Identifier: MIT-0
+
+# Wait between two checks of a result the workflow polls for. Until the expected processing time has passed the
+# next check is due when the result should be ready, afterwards the wait grows with the retries. The expected time
+# comes from the processing seconds per unit observed over the last completions of the stage, the units are seconds
+# of audio for the endpoints and jobs for Comprehend.
+
+import os
+import time
+from decimal import Decimal
+
+import boto3
+from botocore.exceptions import ClientError
+
+POLLING_STATS_TABLE = os.environ.get("POLLING_STATS_TABLE", "")
+min_wait_seconds = int(os.environ.get("POLLING_MIN_WAIT_SECONDS", 10))
+max_wait_seconds = int(os.environ.get("POLLING_MAX_WAIT_SECONDS", 600))
+# Checks of an endpoint result stop this long after the request, or after give_up_factor times the expected
+# processing time when that is longer
+max_elapsed_seconds = int(os.environ.get("POLLING_MAX_ELAPSED_SECONDS", 3600))
+give_up_factor = 3
+backoff_rate = 1.5
+# Queueing and start up that does not depend on the length of the call
+overhead_seconds = 15
+# Used until a completion of the stage has been observed
+default_seconds_per_unit = {
+    "diarize": 0.1,
+    "transcribe": 0.15,
+    "translate": 0.15,
+    "sentiment": 420,
+    "entities": 420,
+}
+# Weight of the latest completion in the running average
+smoothing = 0.2
+# The wait for the completion notification of an endpoint ends after this many times the expected processing time,
+# within the bounds below, and the workflow falls back to polling
+notification_timeout_factor = 2
+notification_min_timeout_seconds = 120
+notification_max_timeout_seconds = 3600
+
+stats_table = boto3.resource("dynamodb").Table(POLLING_STATS_TABLE) if POLLING_STATS_TABLE else None
+
+
+def seconds_per_unit(stage):
+    if stats_table is not None:
+        try:
+            item = stats_table.get_item(Key={"stage": stage}).get("Item")
+            if item:
+                return float(item["secondsPerUnit"])
+        except ClientError as e:
+            print(f"Could not read the polling stats of {stage}: {e}")
+    return default_seconds_per_unit[stage]
+
+
+def record_completion(stage, units, processing_seconds):
+    """
+    Adds a completion to the running average of the stage.
+
+    :param units: Seconds of audio processed, or 1 for a job
+    :param processing_seconds: Time from the request to the result being written
+    """
+    if stats_table is None or units <= 0 or processing_seconds <= 0:
+        return
+    average = (1 - smoothing) * seconds_per_unit(stage) + smoothing * processing_seconds / units
+    try:
+        stats_table.put_item(Item={
+            "stage": stage,
+            "secondsPerUnit": Decimal(f"{average:.6f}"),
+            "updatedAt": int(time.time()),
+        })
+    except ClientError as e:
+        print(f"Could not write the polling stats of {stage}: {e}")
+
+
+def expected_seconds(stage, units):
+    return overhead_seconds + units * seconds_per_unit(stage)
+
+
+def max_polling_seconds(stage, units):
+    return max(max_elapsed_seconds, give_up_factor * expected_seconds(stage, units))
+
+
+def gave_up(stage, units, started_at):
+    """
+    :return: True once the result is overdue and the checks should stop
+    """
+    return time.time() - started_at > max_polling_seconds(stage, units)
+
+
+def notification_timeout_seconds(stage, units):
+    """
+    :param units: Seconds of audio to process, 0 when unknown
+    :return: Whole seconds to wait for the completion notification, for a task timeout with a path
+    """
+    timeout = notification_timeout_factor * expected_seconds(stage, units)
+    return int(min(max(timeout, notification_min_timeout_seconds), notification_max_timeout_seconds))
+
+
+def next_wait_seconds(stage, units, started_at, retry_count):
+    """
+    :param units: Seconds of audio to process, or 1 for a job. 0 when unknown, the wait then only grows with the
+        retries
+    :param started_at: Epoch seconds of the request
+    :param retry_count: Checks made so far
+    :return: Whole seconds to wait before the next check, for a Wait state with seconds_path
+    """
+    elapsed = time.time() - started_at
+    remaining = expected_seconds(stage, units) - elapsed
+    if remaining > min_wait_seconds:
+        wait = remaining
+    else:
+        wait = min_wait_seconds * backoff_rate ** min(retry_count, 20)
+    # The last check falls on the give up time instead of up to max_wait_seconds after it
+    wait = min(wait, max_polling_seconds(stage, units) - elapsed)
+    return int(min(max(wait, min_wait_seconds), max_wait_seconds))
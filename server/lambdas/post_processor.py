@@ -2,15 +2,17 @@
 #  SPDX-License-Identifier: MIT-0
 
 import decimal
+import io
 import json
 import math
 import os
 import tarfile
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from decimal import Context
 import re
+import segment_index
 import server_constants
-import pickle
 
 import boto3
 
@@ -28,12 +30,46 @@ class DecimalEncoder(json.JSONEncoder):
         return super().default(o)
 
 
-def calc_seconds(full_time_str):
-    micro_second_split = full_time_str.split(".")
-    time_str = str(micro_second_split[0])
-    time_split = time_str.split(":")
-    total_sec = int(time_split[0]) * 3600 + int(time_split[1]) * 60 + int(time_split[2])
-    return str(total_sec) + "." + micro_second_split[1]
+def read_lines(s3_bucket, key):
+    response = s3_client.get_object(Bucket=s3_bucket, Key=key)
+    return io.TextIOWrapper(io.BytesIO(response["Body"].read()), encoding="utf-8").readlines()
+
+
+def read_job_records(body):
+    """
+    Reads a Comprehend output tarball as it is downloaded, one record at a time.
+
+    :param body: Streaming body of the .tar.gz
+    :return: Generator of the records of every member, in file order
+    """
+    with tarfile.open(fileobj=body, mode="r|gz") as tar:
+        for member in tar:
+            f = tar.extractfile(member)
+            if f is None:
+                continue
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+class LineRecords:
+    """
+    Looks up job output records by transcript line, reading the stream only as far as the line asked for. Records
+    of other lines read on the way are kept until asked for, so none is lost whatever the order of the output.
+    Output in line order, as the synchronous path and the aggregator write it, only keeps a record or two.
+    """
+
+    def __init__(self, records):
+        self.records = records
+        self.ahead = dict()
+
+    def get(self, line):
+        while line not in self.ahead:
+            record = next(self.records, None)
+            if record is None:
+                break
+            self.ahead[record["Line"]] = record
+        return self.ahead.pop(line, {})
 
 
 def handler(e, context):
@@ -43,7 +79,7 @@ def handler(e, context):
     content_type = event['content_type']
     output_key = event["output_s3_key"]
     input_file = event["input_file"]
-    groups_file = event["groups"]
+    segment_index_file = event["segment_index"]
     diarization_file = event["diarization_file"]
     original_transcription_file = event["original_transcription_file"]
     sentiment_job_output_file = event["sentiment_job_output_file"]
@@ -63,85 +99,40 @@ def handler(e, context):
     customer_duration = 0.0
     agent_duration = 0.0
 
-    # Download original transcript file
-    temp_transcription_file_path = "/tmp/" + original_transcription_file
-    s3_client.download_file(
-        s3_bucket,
-        f"{output_key}/{original_transcription_file}",
-        temp_transcription_file_path,
-    )
-    temp_transcription_file = open(temp_transcription_file_path, "r")
-    temp_transcription_file_lines = temp_transcription_file.readlines()
-    temp_transcription_file.close()
-    translated_conversation_dict = dict()
-    temp_translation_file_lines = None
-
-    # Download original transcript file
     translated_file_name = original_transcription_file
     if language != "original" and language != "en":
         translated_file_name = original_transcription_file.replace(
             "original", "translated"
         ).replace("en", "translated")
 
-        temp_translated_file_path = "/tmp/" + translated_file_name
-        s3_client.download_file(
-            s3_bucket,
-            f"{output_key}/{translated_file_name}",
-            temp_translated_file_path,
-        )
-        temp_translation_file = open(temp_translated_file_path, "r")
-        temp_translation_file_lines = temp_translation_file.readlines()
-        temp_translation_file.close()
-
-        for i, text in enumerate(temp_translation_file_lines):
-            translated_conversation_dict[i] = text
-
-    # Download and process Sentiment data
-    head, file_name = os.path.split(sentiment_job_output_file)
-    temp_sentiment_file_path = "/tmp/sentiment-" + file_name
-    s3_client.download_file(
-        s3_bucket, f"{sentiment_job_output_file}", temp_sentiment_file_path
-    )
-
-    # Process Sentiment Output File
-    tar = tarfile.open(temp_sentiment_file_path, "r:gz")
-    sentiment_object = dict()
-    for member in tar.getmembers():
-        f = tar.extractfile(member)
-        if f is not None:
-            line_by_line_sentiment = f.readlines()
-            if line_by_line_sentiment:
-                for i, text in enumerate(line_by_line_sentiment):
-                    json_object = json.loads(text)
-                    sentiment_object[json_object["Line"]] = json_object
-    tar.close()
-
-    # Download and process Sentiment data
-    entities_head, entities_file_name = os.path.split(entities_job_output_file)
-    temp_entities_file_path = "/tmp/entities-" + entities_file_name
-    s3_client.download_file(
-        s3_bucket, f"{entities_job_output_file}", temp_entities_file_path
-    )
-
-    # Process Sentiment Output File
-    entities_tar = tarfile.open(temp_entities_file_path, "r:gz")
-    entities_object = dict()
-    for member in entities_tar.getmembers():
-        f = entities_tar.extractfile(member)
-        if f is not None:
-            line_by_line_entities = f.readlines()
-            if line_by_line_entities:
-                for i, text in enumerate(line_by_line_entities):
-                    json_object = json.loads(text)
-                    entities_object[json_object["Line"]] = json_object
-    entities_tar.close()
-
-    # Download Group
-    tmp_groups_path = "/tmp/" + groups_file
-    s3_client.download_file(s3_bucket, f"{output_key}/{groups_file}", tmp_groups_path)
-    group_file = open(tmp_groups_path, "rb")
-    groups = pickle.load(group_file)
-    group_file.close()
+    # Request everything at once, the job outputs are then read while walking the transcript
+    with ThreadPoolExecutor(max_workers=5) as executor:
+        transcription_future = executor.submit(read_lines, s3_bucket, f"{output_key}/{original_transcription_file}")
+        translation_future = None
+        if language != "original" and language != "en":
+            translation_future = executor.submit(read_lines, s3_bucket, f"{output_key}/{translated_file_name}")
+        turns_future = None
+        if content_type != "text/plain":
+            turns_future = executor.submit(segment_index.read_segment_index, s3_client, s3_bucket,
+                                           f"{output_key}/{segment_index_file}")
+        sentiment_future = executor.submit(s3_client.get_object, Bucket=s3_bucket, Key=sentiment_job_output_file)
+        entities_future = executor.submit(s3_client.get_object, Bucket=s3_bucket, Key=entities_job_output_file)
+
+        temp_transcription_file_lines = transcription_future.result()
+        translated_conversation_dict = dict()
+        temp_translation_file_lines = None
+        if translation_future is not None:
+            temp_translation_file_lines = translation_future.result()
+            for i, text in enumerate(temp_translation_file_lines):
+                translated_conversation_dict[i] = text
+
+        # Speaker turns written by the chunking job, chat transcripts have none
+        turns = []
+        if turns_future is not None:
+            turns = segment_index.turns(turns_future.result())
+
+        sentiment_object = LineRecords(read_job_records(sentiment_future.result()["Body"]))
+        entities_object = LineRecords(read_job_records(entities_future.result()["Body"]))
 
     transcript_speech_segments = []
     sentiment_list = []
@@ -160,40 +151,39 @@ def handler(e, context):
         }
 
         if content_type != "text/plain":
-            g = groups[i]
-            speaker = g[0].split('[', 1)[1].split(']')[1].split(" ")[2].strip()
-            speaker = server_constants.SPEAKERS[speaker]
+            turn = turns[i]
+            speaker = server_constants.SPEAKERS[turn["speaker"]]
             speaker_str = re.sub("[!^:(),']", "", str(speaker))
-            start_time = re.findall("[0-9]+:[0-9]+:[0-9]+\.[0-9]+", string=g[0])[0].strip()
-            end_time = re.findall("[0-9]+:[0-9]+:[0-9]+\.[0-9]+", string=g[-1])[1].strip()
-            segment_duration = float(calc_seconds(end_time)) - float(calc_seconds(start_time))
-            transcript_segment_object["SegmentStartTimeText"] = start_time
-            transcript_segment_object["SegmentEndTimeText"] = end_time
-            transcript_segment_object["SegmentStartTime"] = calc_seconds(start_time)
-            transcript_segment_object["SegmentEndTime"] = calc_seconds(end_time)
+            start_time = segment_index.seconds_text(turn["start_ms"])
+            end_time = segment_index.seconds_text(turn["end_ms"])
+            segment_duration = float(end_time) - float(start_time)
+            transcript_segment_object["SegmentStartTimeText"] = segment_index.time_text(turn["start_ms"])
+            transcript_segment_object["SegmentEndTimeText"] = segment_index.time_text(turn["end_ms"])
+            transcript_segment_object["SegmentStartTime"] = start_time
+            transcript_segment_object["SegmentEndTime"] = end_time
             transcript_segment_object["SegmentDuration"] = segment_duration
-            total_duration = float(calc_seconds(end_time))
+            total_duration = float(end_time)
             if speaker_str == "Customer":
                 customer_duration += segment_duration
             else:
                 agent_duration += segment_duration
 
-        sentiment = sentiment_object.get(i, {})
-        if "Sentiment" in sentiment:
-            sentiment = sentiment_object[i]["Sentiment"]
-            sentiment_list.append(sentiment_object[i])
+        sentiment_record = sentiment_object.get(i)
+        if "Sentiment" in sentiment_record:
+            sentiment = sentiment_record["Sentiment"]
+            sentiment_list.append(sentiment_record)
             transcript_segment_object["BaseSentiment"] = sentiment
-            transcript_segment_object["BaseSentimentScores"] = sentiment_object[i][
+            transcript_segment_object["BaseSentimentScores"] = sentiment_record[
                 "SentimentScore"
             ]
         else:
             transcript_segment_object["BaseSentiment"] = None
             transcript_segment_object["BaseSentimentScores"] = []
 
-        entities = entities_object.get(i, {})
-        if "Entities" in entities and (len(entities) > 0):
-            entities = entities_object[i]["Entities"]
-            entities_list.append(entities_object[i])
+        entities_record = entities_object.get(i)
+        if "Entities" in entities_record and (len(entities_record) > 0):
+            entities = entities_record["Entities"]
+            entities_list.append(entities_record)
             transcript_segment_object["EntitiesDetected"] = entities
         else:
             transcript_segment_object["EntitiesDetected"] = []
@@ -327,23 +317,16 @@ def handler(e, context):
     output_file = f"{output_key}/{input_file}.json"
     sentiment_output_file = f"{output_key}/sentiment.json"
     entities_output_file = f"{output_key}/entities.json"
-    entities_local = "/tmp/entities.json"
-    sentiment_local = "/tmp/sentiment.json"
 
     payload["outputFile"] = output_file
-    json_file_name = "/tmp/" + input_file + ".json"
-
-    with open(sentiment_local, "w", encoding="utf-8") as f:
-        json.dump(sentiment_list, f, ensure_ascii=False, indent=4)
-    s3_client.upload_file(sentiment_local, s3_bucket, sentiment_output_file)
-
-    with open(entities_local, "w", encoding="utf-8") as f:
-        json.dump(entities_list, f, ensure_ascii=False, indent=4)
-    s3_client.upload_file(entities_local, s3_bucket, entities_output_file)
 
-    with open(json_file_name, "w", encoding="utf-8") as f:
-        json.dump(transcript_json, f, ensure_ascii=False, indent=4, cls=DecimalEncoder)
-    s3_client.upload_file(json_file_name, s3_bucket, output_file)
+    s3_client.put_object(Bucket=s3_bucket, Key=sentiment_output_file,
+                         Body=json.dumps(sentiment_list, ensure_ascii=False, indent=4).encode("utf-8"))
+    s3_client.put_object(Bucket=s3_bucket, Key=entities_output_file,
+                         Body=json.dumps(entities_list, ensure_ascii=False, indent=4).encode("utf-8"))
+    s3_client.put_object(Bucket=s3_bucket, Key=output_file,
+                         Body=json.dumps(transcript_json, ensure_ascii=False, indent=4,
+                                         cls=DecimalEncoder).encode("utf-8"))
 
     if "Item" in object_from_table:
         table.put_item(Item=payload)
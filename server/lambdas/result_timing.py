@@ -0,0 +1,33 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  SPDX-License-Identifier: MIT-0
+
+import json
+import time
+from datetime import datetime, timezone
+
+metrics_namespace = "ConversationIntelligence"
+
+
+def log_result_ready_delay(stage, path, ready_time):
+    """
+    Logs the time between an endpoint result being written and the workflow picking it up as a CloudWatch
+    embedded metric, by stage and by whether the workflow was resumed by the notification or found it polling.
+
+    :param ready_time: LastModified of the result object
+    :return: Delay in seconds
+    """
+    delay = (datetime.now(timezone.utc) - ready_time).total_seconds()
+    print(json.dumps({
+        "_aws": {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [{
+                "Namespace": metrics_namespace,
+                "Dimensions": [["Stage", "Path"]],
+                "Metrics": [{"Name": "ResultReadyDelay", "Unit": "Seconds"}],
+            }],
+        },
+        "Stage": stage,
+        "Path": path,
+        "ResultReadyDelay": delay,
+    }))
+    return delay
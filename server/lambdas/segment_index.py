@@ -0,0 +1,55 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  SPDX-License-Identifier: MIT-0
+
+# Reader for the segment index written by the chunking job. The index is columnar JSON holding the start and
+# end of every speaker turn in milliseconds, the speaker of every turn as a position in the speakers list, and
+# the turns covered by every transcription chunk:
+#
+#   {"version": 1, "speakers": ["SPEAKER_00", "SPEAKER_01"],
+#    "turns": {"start_ms": [...], "end_ms": [...], "speaker": [...]},
+#    "chunks": {"start_ms": [...], "end_ms": [...], "turns": [[[turn, start_ms, end_ms], ...], ...]}}
+
+import json
+
+SEGMENT_INDEX_VERSION = 1
+
+
+def read_segment_index(s3_client, bucket, key):
+    response = s3_client.get_object(Bucket=bucket, Key=key)
+    index = json.loads(response["Body"].read())
+    if index.get("version") != SEGMENT_INDEX_VERSION:
+        raise ValueError(f"Unsupported segment index version {index.get('version')} in {key}")
+    return index
+
+
+def turns(index):
+    """
+    :return: List of turns as dicts with start_ms, end_ms and speaker, the diarization label e.g. SPEAKER_00
+    """
+    columns = index["turns"]
+    speakers = index["speakers"]
+    return [
+        {"start_ms": start, "end_ms": end, "speaker": speakers[speaker]}
+        for start, end, speaker in zip(columns["start_ms"], columns["end_ms"], columns["speaker"])
+    ]
+
+
+def chunks(index):
+    """
+    :return: List of chunks as dicts with start_ms, end_ms and turns, the [turn, start_ms, end_ms] it covers
+    """
+    columns = index["chunks"]
+    return [
+        {"start_ms": start, "end_ms": end, "turns": chunk_turns}
+        for start, end, chunk_turns in zip(columns["start_ms"], columns["end_ms"], columns["turns"])
+    ]
+
+
+def time_text(ms):
+    # Same HH:MM:SS.mmm layout as the diarization output
+    return f"{ms // 3600000:02d}:{ms // 60000 % 60:02d}:{ms // 1000 % 60:02d}.{ms % 1000:03d}"
+
+
+def seconds_text(ms):
+    # Seconds with millisecond decimals, e.g. 75.120
+    return f"{ms // 1000}.{ms % 1000:03d}"
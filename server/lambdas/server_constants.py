@@ -6,3 +6,5 @@
 CI_STEPS = "ci_workflow"
 LAMBDA_MAX_RETRIES = 240
 SPEAKERS = {"SPEAKER_00": ("Agent",), "SPEAKER_01": ("Customer",)}
+# Single transcript artifact the transcription endpoint writes per conversation when transcript_format is jsonl
+PACKED_TRANSCRIPT_FILE = "chunks.{}.jsonl"
@@ -1,13 +1,36 @@
 #  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 #  SPDX-License-Identifier: MIT-0
 
+import io
+import json
 import os
+import tarfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ClientError
 
+import polling_backoff
+
 print("Loading Start Comprehend Jobs...")
-comprehend_client = boto3.client(service_name="comprehend")
+# Transcripts up to both limits are analyzed with the synchronous batch APIs instead of asynchronous jobs, which
+# spend minutes queueing. 0 always starts jobs
+COMPREHEND_SYNC_MAX_LINES = int(os.environ.get("COMPREHEND_SYNC_MAX_LINES", 0))
+COMPREHEND_SYNC_MAX_BYTES = int(os.environ.get("COMPREHEND_SYNC_MAX_BYTES", 0))
+sync_workers = int(os.environ.get("COMPREHEND_SYNC_WORKERS", 4))
+# Longer transcripts wait for the comprehend aggregator to run their jobs together with other conversations
+COMPREHEND_AGGREGATION = os.environ.get("COMPREHEND_AGGREGATION", "false").lower() == "true"
+# Limits of BatchDetectSentiment and BatchDetectEntities
+batch_size = 25
+max_document_bytes = 5000
+
+comprehend_client = boto3.client(
+    service_name="comprehend",
+    config=Config(max_pool_connections=max(sync_workers, 10), retries={"mode": "adaptive", "max_attempts": 10}),
+)
+s3_client = boto3.client("s3")
 
 
 def detect_sentiment(dominant_language_code, comprehend_job_role, s3_uri, s3_output_uri):
@@ -70,6 +93,88 @@ def detect_entities(dominant_language_code, comprehend_job_role, s3_uri, s3_outp
         return response
 
 
+def read_documents(s3_bucket, key):
+    """
+    :return: Lines of the transcript by line number as the asynchronous jobs number them, or None when the
+        transcript is over the limits of the synchronous path
+    """
+    if not COMPREHEND_SYNC_MAX_LINES or not COMPREHEND_SYNC_MAX_BYTES:
+        return None
+    response = s3_client.head_object(Bucket=s3_bucket, Key=key)
+    if response["ContentLength"] > COMPREHEND_SYNC_MAX_BYTES:
+        return None
+
+    response = s3_client.get_object(Bucket=s3_bucket, Key=key)
+    lines = io.TextIOWrapper(io.BytesIO(response["Body"].read()), encoding="utf-8").readlines()
+    if len(lines) > COMPREHEND_SYNC_MAX_LINES:
+        return None
+    documents = {line: text.strip() for line, text in enumerate(lines) if text.strip()}
+    if any(len(text.encode("utf-8")) > max_document_bytes for text in documents.values()):
+        return None
+    return documents
+
+
+def batch_detect(detect, language, file_name, lines, documents):
+    """
+    Runs one batch API call and returns its results as the lines the asynchronous jobs write to their output.
+
+    :param detect: comprehend_client.batch_detect_sentiment or comprehend_client.batch_detect_entities
+    :param lines: Line numbers of the documents
+    """
+    response = detect(TextList=documents, LanguageCode=language)
+    records = []
+    for result in response["ResultList"]:
+        record = {"File": file_name, "Line": lines[result.pop("Index")]}
+        record.update(result)
+        records.append(record)
+    for error in response["ErrorList"]:
+        records.append({"File": file_name, "Line": lines[error["Index"]], "ErrorCode": error["ErrorCode"],
+                        "ErrorMessage": error["ErrorMessage"]})
+    return records
+
+
+def write_job_output(s3_bucket, key, records):
+    # Same layout as the output of the asynchronous jobs, a tarball with one JSON result per line
+    data = "".join(json.dumps(record) + "\n" for record in sorted(records, key=lambda record: record["Line"]))
+    data = data.encode("utf-8")
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w:gz") as tar:
+        member = tarfile.TarInfo("output")
+        member.size = len(data)
+        tar.addfile(member, io.BytesIO(data))
+    s3_client.put_object(Bucket=s3_bucket, Key=key, Body=buffer.getvalue())
+
+
+def detect_sync(language, s3_bucket, output_key, file_name, documents):
+    """
+    Detects sentiment and entities of every line with the batch APIs, 25 lines per call with the calls running
+    concurrently, and writes the results where post processing reads the job output.
+
+    :return: Keys of the sentiment and entities output
+    """
+    lines = sorted(documents)
+    batches = [lines[i:i + batch_size] for i in range(0, len(lines), batch_size)]
+    with ThreadPoolExecutor(max_workers=sync_workers) as executor:
+        sentiment = [
+            executor.submit(batch_detect, comprehend_client.batch_detect_sentiment, language, file_name, batch,
+                            [documents[line] for line in batch])
+            for batch in batches
+        ]
+        entities = [
+            executor.submit(batch_detect, comprehend_client.batch_detect_entities, language, file_name, batch,
+                            [documents[line] for line in batch])
+            for batch in batches
+        ]
+        sentiment_records = [record for future in sentiment for record in future.result()]
+        entities_records = [record for future in entities for record in future.result()]
+
+    sentiment_output_file = f"{output_key}/sentiment/output.tar.gz"
+    entities_output_file = f"{output_key}/entities/output.tar.gz"
+    write_job_output(s3_bucket, sentiment_output_file, sentiment_records)
+    write_job_output(s3_bucket, entities_output_file, entities_records)
+    return sentiment_output_file, entities_output_file
+
+
 def handler(e, context):
 
     event = e["event"]
@@ -85,6 +190,30 @@ def handler(e, context):
     # Hardcoding this language as we are using translated transcript
     language = "en"
 
+    documents = read_documents(s3_bucket, f"{output_key}/{original_transcription_file}")
+    if documents is not None:
+        print(f"Detecting sentiment and entities of {len(documents)} lines synchronously")
+        sentiment_output_file, entities_output_file = detect_sync(
+            language, s3_bucket, output_key, original_transcription_file, documents
+        )
+        # Same fields the job status checks set once the jobs are complete
+        event["comprehend_mode"] = "sync"
+        event["sentiment_job_output_file"] = sentiment_output_file
+        event["sentiment_job_status"] = True
+        event["entities_job_output_file"] = entities_output_file
+        event["entities_job_status"] = True
+        return {
+            "event": event,
+            "status": "SUCCEEDED",
+        }
+
+    if COMPREHEND_AGGREGATION:
+        event["comprehend_mode"] = "aggregate"
+        return {
+            "event": event,
+            "status": "SUCCEEDED",
+        }
+
     s3_uri = f"s3://{s3_bucket}/{output_key}/{original_transcription_file}"
     s3_sentiment_output_uri = f"s3://{s3_bucket}/{output_key}/{sentiment_file_name}"
     s3_entities_output_uri = f"s3://{s3_bucket}/{output_key}/{entities_file_name}"
@@ -98,6 +227,13 @@ def handler(e, context):
         language, comprehend_job_role, s3_uri, s3_entities_output_uri
     )
     event["entities_job_id"] = entities_response['JobId']
+    event["comprehend_mode"] = "job"
+    started_at = time.time()
+    event["comprehend_started_at"] = started_at
+    event["sentiment_retries"] = 0
+    event["entities_retries"] = 0
+    event["sentiment_wait_seconds"] = polling_backoff.next_wait_seconds("sentiment", 1, started_at, 0)
+    event["entities_wait_seconds"] = polling_backoff.next_wait_seconds("entities", 1, started_at, 0)
 
     return {
         "event": event,
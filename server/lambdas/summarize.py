@@ -3,8 +3,14 @@
 
 import json
 import os
+import random
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
 
 print("Loading Summarization Fn...")
 s3_client = boto3.client("s3")
@@ -26,7 +32,23 @@ DEFAULT_MAX_TOKENS = 1024
 SUCCESS = "SUCCESS"
 FAILED = "FAILED"
 
+# Concurrency and rate limits for the analysis prompts. The limits are per Lambda container, so set them
+# to a share of the account level Bedrock quota that matches the expected Lambda concurrency.
+BEDROCK_MAX_WORKERS = int(os.getenv("BEDROCK_MAX_WORKERS", "3"))
+BEDROCK_REQUESTS_PER_MINUTE = int(os.getenv("BEDROCK_REQUESTS_PER_MINUTE", "20"))
+BEDROCK_TOKENS_PER_MINUTE = int(os.getenv("BEDROCK_TOKENS_PER_MINUTE", "200000"))
+BEDROCK_MAX_RETRIES = int(os.getenv("BEDROCK_MAX_RETRIES", "6"))
+BEDROCK_BACKOFF_BASE_SECONDS = float(os.getenv("BEDROCK_BACKOFF_BASE_SECONDS", "2"))
+BEDROCK_BACKOFF_MAX_SECONDS = float(os.getenv("BEDROCK_BACKOFF_MAX_SECONDS", "60"))
+BEDROCK_THROTTLING_ERRORS = ("ThrottlingException", "TooManyRequestsException")
+
+# "per_prompt" sends one request per analysis prompt, "combined" asks for all insights as one JSON object
+SUMMARIZE_MODE = os.getenv("SUMMARIZE_MODE", "per_prompt")
+COMBINED_MAX_TOKENS = int(os.getenv("COMBINED_MAX_TOKENS", "2048"))
+COMBINED_MAX_REPAIRS = int(os.getenv("COMBINED_MAX_REPAIRS", "2"))
+
 bedrock_client = None
+bedrock_client_lock = threading.Lock()
 
 SSM_LLM_SUMMARIZATION_NAME = "ci_summarization_prompt"
 SSM_LLM_ACTION_PROMPT = "ci_action_prompt"
@@ -37,6 +59,75 @@ SSM_LLM_CALLBACK_PROMPT = "ci_callback_prompt"
 SSM_LLM_POLITE_PROMPT = "ci_politeness_prompt"
 SSM_LLM_AGENT_SENTIMENT_PROMPT = "ci_agent_sentiment_prompt"
 SSM_LLM_CUSTOMER_SENTIMENT_PROMPT = "ci_customer_sentiment_prompt"
+SSM_LLM_COMBINED_PROMPT = "ci_combined_insights_prompt"
+
+
+class TokenBucket(object):
+    """
+    Thread safe token bucket that refills continuously at rate_per_minute. Requests larger than the bucket
+    are capped to its capacity so that a single large prompt can never block forever.
+
+    :param rate_per_minute: Bucket capacity and refill rate. Zero or less disables the limit.
+    """
+
+    def __init__(self, rate_per_minute):
+        self.capacity = float(rate_per_minute)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, amount=1):
+        if self.capacity <= 0:
+            return
+        amount = min(float(amount), self.capacity)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.capacity / 60.0)
+                self.updated_at = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                wait_seconds = (amount - self.tokens) * 60.0 / self.capacity
+            time.sleep(wait_seconds)
+
+
+request_limiter = TokenBucket(BEDROCK_REQUESTS_PER_MINUTE)
+token_limiter = TokenBucket(BEDROCK_TOKENS_PER_MINUTE)
+
+
+def first_label(response):
+    return str(response).split(',', 1)[0]
+
+
+# SSM prompt name, event field the answer is stored in and optional formatter for the answer
+ANALYSIS_PROMPTS = [
+    (SSM_LLM_SUMMARIZATION_NAME, "Summarization", None),
+    (SSM_LLM_ACTION_PROMPT, "ActionItems", None),
+    (SSM_LLM_TOPIC_PROMPT, "Topic", None),
+    (SSM_LLM_POLITE_PROMPT, "Politeness", None),
+    (SSM_LLM_CALLBACK_PROMPT, "Callback", None),
+    (SSM_LLM_PRODUCT_PROMPT, "Product", None),
+    (SSM_LLM_RESOLVED_PROMPT, "Resolution", None),
+    (SSM_LLM_AGENT_SENTIMENT_PROMPT, "AgentSentiment", first_label),
+    (SSM_LLM_CUSTOMER_SENTIMENT_PROMPT, "CustomerSentiment", first_label),
+]
+
+# Description of each event field, substituted as {question} in the combined insights prompt
+INSIGHT_DESCRIPTIONS = {
+    "Summarization": "A summary of the transcript.",
+    "ActionItems": "The actions the Agent took.",
+    "Topic": "The topic of the call, for example iphone issue, billing issue, cancellation. Only the topic.",
+    "Politeness": "Was the agent polite and professional? Only yes or no.",
+    "Callback": "Was this a callback? Only yes or no.",
+    "Product": "The product the customer called about, for example internet, broadband, mobile phone, "
+               "mobile plans. Only the product.",
+    "Resolution": "Did the agent resolve the customer's questions? Only yes or no.",
+    "AgentSentiment": "Sentiment of the Agent, one of Positive, Negative or Neutral.",
+    "CustomerSentiment": "Sentiment of the Customer, one of Positive, Negative or Neutral.",
+}
+SENTIMENT_FIELDS = ("AgentSentiment", "CustomerSentiment")
+SENTIMENT_LABELS = ("positive", "negative", "neutral")
 
 def get_request_body(modelId, parameters, prompt):
     provider = modelId.split(".")[0]
@@ -77,14 +168,41 @@ def get_generate_text(modelId, response):
 
 
 def get_bedrock_client():
+    # Retries are handled by call_bedrock so that only throttling is retried, with jitter
     client = boto3.client(
         service_name="bedrock-runtime",
         region_name=AWS_REGION,
         endpoint_url=ENDPOINT_URL,
+        config=Config(
+            retries={"total_max_attempts": 1},
+            max_pool_connections=max(BEDROCK_MAX_WORKERS, 10),
+        ),
     )
     return client
 
 
+def get_shared_bedrock_client():
+    global bedrock_client
+    with bedrock_client_lock:
+        if bedrock_client is None:
+            bedrock_client = get_bedrock_client()
+    return bedrock_client
+
+
+def estimate_tokens(prompt, max_tokens=MAX_TOKENS):
+    # Rough estimate of ~4 characters per token plus the completion budget
+    return len(prompt) // 4 + max_tokens
+
+
+def is_throttling_error(err):
+    return isinstance(err, ClientError) and err.response.get("Error", {}).get("Code") in BEDROCK_THROTTLING_ERRORS
+
+
+def get_backoff_seconds(attempt):
+    # Full jitter exponential backoff
+    return random.uniform(0, min(BEDROCK_BACKOFF_MAX_SECONDS, BEDROCK_BACKOFF_BASE_SECONDS * (2 ** attempt)))
+
+
 def call_llm(parameters, prompt):
     modelId = MODEL_ID
     body = get_request_body(modelId, parameters, prompt)
@@ -103,17 +221,17 @@ def call_llm(parameters, prompt):
     return generated_text
 
 
-def get_bedrock_request_body(modelId, parameters, prompt):
+def get_bedrock_request_body(modelId, parameters, prompt, max_tokens=MAX_TOKENS):
     provider = modelId.split(".")[0]
     request_body = None
     if provider == "anthropic":
-        request_body = { "messages": [{"role": "user","content": [{"type": "text","text": prompt}]}],"anthropic_version": "bedrock-2023-05-31","max_tokens": MAX_TOKENS}
+        request_body = { "messages": [{"role": "user","content": [{"type": "text","text": prompt}]}],"anthropic_version": "bedrock-2023-05-31","max_tokens": max_tokens}
         request_body.update(parameters)
     elif provider == "ai21":
-        request_body = {"prompt": prompt, "maxTokens": MAX_TOKENS}
+        request_body = {"prompt": prompt, "maxTokens": max_tokens}
         request_body.update(parameters)
     elif provider == "amazon":
-        textGenerationConfig = {"maxTokenCount": MAX_TOKENS}
+        textGenerationConfig = {"maxTokenCount": max_tokens}
         textGenerationConfig.update(parameters)
         request_body = {
             "inputText": prompt,
@@ -142,33 +260,163 @@ def get_bedrock_generate_text(modelId, response):
     return generated_text
 
 
-def call_bedrock(parameters, prompt):
-    global bedrock_client
+def call_bedrock(parameters, prompt, max_tokens=MAX_TOKENS):
     modelId = MODEL_ID
-    body = get_bedrock_request_body(modelId, parameters, prompt)
-    if bedrock_client is None:
-        bedrock_client = get_bedrock_client()
-    response = bedrock_client.invoke_model(
-        body=json.dumps(body),
-        modelId=modelId,
-        accept="application/json",
-        contentType="application/json",
-    )
-    generated_text = get_bedrock_generate_text(modelId, response)
-    return generated_text
-
-
-def generate_bedrock_query(prompt, transcript, question):
+    body = get_bedrock_request_body(modelId, parameters, prompt, max_tokens)
+    client = get_shared_bedrock_client()
+    attempt = 0
+    while True:
+        request_limiter.acquire(1)
+        token_limiter.acquire(estimate_tokens(prompt, max_tokens))
+        try:
+            response = client.invoke_model(
+                body=json.dumps(body),
+                modelId=modelId,
+                accept="application/json",
+                contentType="application/json",
+            )
+        except ClientError as err:
+            if not is_throttling_error(err) or attempt >= BEDROCK_MAX_RETRIES:
+                raise
+            backoff_seconds = get_backoff_seconds(attempt)
+            attempt += 1
+            print(f"Bedrock throttled the request, retry {attempt} in {backoff_seconds:.1f}s")
+            time.sleep(backoff_seconds)
+            continue
+        generated_text = get_bedrock_generate_text(modelId, response)
+        return generated_text
+
+
+def generate_bedrock_query(prompt, transcript, question, max_tokens=MAX_TOKENS):
     # first check to see if this is one prompt, or many prompts as a json
     prompt = prompt.replace("<br>", "\n")
     prompt = prompt.replace("{transcript}", transcript)
     if question != "":
         prompt = prompt.replace("{question}", question)
     parameters = {"temperature": 0}
-    generated_text = call_bedrock(parameters, prompt)
+    generated_text = call_bedrock(parameters, prompt, max_tokens)
     return generated_text
 
 
+def get_prompt_templates(prompt_names):
+    """
+    Fetches all prompt templates from SSM in a single call.
+
+    :param prompt_names: SSM parameter names, at most 10.
+    :return: Dictionary of parameter name to template. Missing parameters are left out.
+    """
+    response = ssm_client.get_parameters(Names=list(prompt_names))
+    if response.get("InvalidParameters"):
+        print(f"Prompts not found in SSM: {response['InvalidParameters']}")
+    return {parameter["Name"]: parameter["Value"] for parameter in response["Parameters"]}
+
+
+def run_analysis_prompts(transcript_data, analysis_prompts):
+    """
+    Runs the analysis prompts concurrently against Bedrock. Concurrency is bound by BEDROCK_MAX_WORKERS and
+    the request and token rate limiters shared by all calls from this container.
+
+    :param transcript_data: Transcript to substitute in the prompts.
+    :param analysis_prompts: List of (SSM prompt name, event field, formatter) tuples.
+    :return: Dictionary of event field to answer. Failed prompts are left out, as the event field was before.
+    """
+    templates = get_prompt_templates([prompt_name for prompt_name, _, _ in analysis_prompts])
+    results = dict()
+    with ThreadPoolExecutor(max_workers=BEDROCK_MAX_WORKERS) as executor:
+        futures = dict()
+        for prompt_name, field, formatter in analysis_prompts:
+            if prompt_name not in templates:
+                print(f"Error generating {field}: prompt {prompt_name} not found")
+                continue
+            future = executor.submit(generate_bedrock_query, templates[prompt_name], transcript_data, "")
+            futures[future] = (field, formatter)
+
+        for future in as_completed(futures):
+            field, formatter = futures[future]
+            try:
+                query_response = future.result()
+                results[field] = formatter(query_response) if formatter else query_response
+            except Exception as err:
+                print(f"Error generating {field}: {err}")
+    return results
+
+
+def build_insights_question(fields):
+    return "\n".join(f'"{field}": {INSIGHT_DESCRIPTIONS[field]}' for field in fields)
+
+
+def parse_insights(generated_text, fields):
+    """
+    Extracts the JSON object from the model answer and validates the requested fields.
+
+    :param generated_text: Text generated by the model.
+    :param fields: Event fields that were asked for.
+    :return: Dictionary with only the fields that are present and well formed.
+    """
+    start = generated_text.find("{")
+    end = generated_text.rfind("}")
+    if start == -1 or end <= start:
+        return {}
+    try:
+        answer = json.loads(generated_text[start:end + 1])
+    except ValueError:
+        return {}
+    if not isinstance(answer, dict):
+        return {}
+
+    insights = dict()
+    for field in fields:
+        value = answer.get(field)
+        if isinstance(value, list) and all(isinstance(item, str) for item in value):
+            value = "\n".join(value)
+        if not isinstance(value, str) or not value.strip():
+            continue
+        if field in SENTIMENT_FIELDS and first_label(value).strip().lower() not in SENTIMENT_LABELS:
+            continue
+        insights[field] = value
+    return insights
+
+
+def run_combined_prompt(transcript_data):
+    """
+    Asks for all insights in a single request that returns a JSON object. Fields that are missing or
+    malformed are asked for again, up to COMBINED_MAX_REPAIRS times, and anything still missing after that
+    falls back to the individual analysis prompts.
+
+    :param transcript_data: Transcript to substitute in the prompt.
+    :return: Dictionary of event field to answer, with the same fields as run_analysis_prompts.
+    """
+    formatters = {field: formatter for _, field, formatter in ANALYSIS_PROMPTS}
+    pending = [field for _, field, _ in ANALYSIS_PROMPTS]
+    results = dict()
+
+    template = get_prompt_templates([SSM_LLM_COMBINED_PROMPT]).get(SSM_LLM_COMBINED_PROMPT)
+    attempt = 0
+    while template and pending and attempt <= COMBINED_MAX_REPAIRS:
+        if attempt > 0:
+            print(f"Asking again for missing or malformed fields {pending}")
+        attempt += 1
+        try:
+            generated_text = generate_bedrock_query(
+                template, transcript_data, build_insights_question(pending), COMBINED_MAX_TOKENS
+            )
+        except Exception as err:
+            print(f"Error generating combined insights: {err}")
+            break
+        results.update(parse_insights(generated_text, pending))
+        pending = [field for field in pending if field not in results]
+
+    for field, value in results.items():
+        if formatters[field]:
+            results[field] = formatters[field](value)
+
+    if pending:
+        print(f"Falling back to individual prompts for {pending}")
+        fallback_prompts = [prompt for prompt in ANALYSIS_PROMPTS if prompt[1] in pending]
+        results.update(run_analysis_prompts(transcript_data, fallback_prompts))
+    return results
+
+
 def merge_json(original, addition):
     for k, v in addition.items():
         if k not in original:
@@ -185,8 +433,13 @@ def merge_json(original, addition):
 
 
 def handler(e, context):
-    merge_json(e[0], e[1])
-    merged_event = e[0]
+    if isinstance(e, list):
+        # Output of the parallel job status checks
+        merge_json(e[0], e[1])
+        merged_event = e[0]
+    else:
+        # Sentiment and entities detected synchronously
+        merged_event = e
     event = merged_event["event"]
     s3_bucket = event["bucket"]
     output_key = event["output_s3_key"]
@@ -212,81 +465,13 @@ def handler(e, context):
             transcript_data += line.strip() + "\n"
 
     try:
-        llm_summarization_prompt = ssm_client.get_parameter(
-            Name=SSM_LLM_SUMMARIZATION_NAME
-        )
-        prompt = llm_summarization_prompt["Parameter"]["Value"]
-        query_response = generate_bedrock_query(prompt, transcript_data, "")
-        event["Summarization"] = query_response
-        time.sleep(30)
-
-        llm_action_prompt = ssm_client.get_parameter(
-            Name=SSM_LLM_ACTION_PROMPT
-        )
-        prompt = llm_action_prompt["Parameter"]["Value"]
-        query_response = generate_bedrock_query(prompt, transcript_data, "")
-        event["ActionItems"] = query_response
-        time.sleep(30)
-
-        llm_topic_prompt = ssm_client.get_parameter(
-            Name=SSM_LLM_TOPIC_PROMPT
-        )
-        prompt = llm_topic_prompt["Parameter"]["Value"]
-        query_response = generate_bedrock_query(prompt, transcript_data, "")
-        event["Topic"] = query_response
-        time.sleep(30)
-
-        llm_polite_prompt = ssm_client.get_parameter(
-            Name=SSM_LLM_POLITE_PROMPT
-        )
-        prompt = llm_polite_prompt["Parameter"]["Value"]
-        query_response = generate_bedrock_query(prompt, transcript_data, "")
-        event["Politeness"] = query_response
-        time.sleep(30)
-
-        llm_callback_prompt = ssm_client.get_parameter(
-            Name=SSM_LLM_CALLBACK_PROMPT
-        )
-        prompt = llm_callback_prompt["Parameter"]["Value"]
-        query_response = generate_bedrock_query(prompt, transcript_data, "")
-        event["Callback"] = query_response
-        time.sleep(30)
-
-        llm_product_prompt = ssm_client.get_parameter(
-            Name=SSM_LLM_PRODUCT_PROMPT
-        )
-        prompt = llm_product_prompt["Parameter"]["Value"]
-        query_response = generate_bedrock_query(prompt, transcript_data, "")
-        event["Product"] = query_response
-        time.sleep(30)
-
-        llm_resolved_prompt = ssm_client.get_parameter(
-            Name=SSM_LLM_RESOLVED_PROMPT
-        )
-        prompt = llm_resolved_prompt["Parameter"]["Value"]
-        query_response = generate_bedrock_query(prompt, transcript_data, "")
-        event["Resolution"] = query_response
-        time.sleep(30)
-
-        llm_agent_sentiment_prompt = ssm_client.get_parameter(
-            Name=SSM_LLM_AGENT_SENTIMENT_PROMPT
-        )
-        prompt = llm_agent_sentiment_prompt["Parameter"]["Value"]
-        query_response = generate_bedrock_query(prompt, transcript_data, "")
-        event["AgentSentiment"] = str(query_response).split(',', 1)[0]
-        time.sleep(30)
-
-        llm_customer_sentiment_prompt = ssm_client.get_parameter(
-            Name=SSM_LLM_CUSTOMER_SENTIMENT_PROMPT
-        )
-        prompt = llm_customer_sentiment_prompt["Parameter"]["Value"]
-        query_response = generate_bedrock_query(prompt, transcript_data, "")
-        event["CustomerSentiment"] = str(query_response).split(',', 1)[0]
-        time.sleep(30)
-
-        print(f"Summarization compeleted for {output_key}")
+        fn_start = time.time()
+        if SUMMARIZE_MODE == "combined":
+            event.update(run_combined_prompt(transcript_data))
+        else:
+            event.update(run_analysis_prompts(transcript_data, ANALYSIS_PROMPTS))
+        print(f"Summarization compeleted for {output_key} in {time.time() - fn_start:.1f}s")
     except Exception as err:
-        query_response = "An error occurred generating Bedrock query response."
         print(err)
 
     return {
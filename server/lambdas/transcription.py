@@ -3,9 +3,12 @@
 
 import json
 import os
+import time
 
 import boto3
 
+import polling_backoff
+
 print("Loading Transcription Function...")
 s3_client = boto3.client("s3")
 sagemaker_client = boto3.client("sagemaker")
@@ -20,8 +23,7 @@ def invoke_sagemaker_endpoint(payload_location):
         InputLocation=payload_location,
         ContentType="application/json",
     )
-    output_location = response["OutputLocation"]
-    return output_location
+    return response["OutputLocation"], response["InferenceId"]
 
 
 def handler(e, context):
@@ -42,6 +44,7 @@ def handler(e, context):
             "input_location": audio_chunk_uri,
             "output_location": txt_chunk_uri,
             "task": task,
+            "output_format": event.get("transcript_format", "txt"),
         }
 
         input_param_file_path = f"{tmp_prefix}{task}.json"
@@ -53,10 +56,20 @@ def handler(e, context):
             input_param_file_path, s3_bucket, param_file_uri
         )
 
-        response_location = invoke_sagemaker_endpoint(f"s3://{s3_bucket}/{param_file_uri}")
+        started_at = time.time()
+        response_location, inference_id = invoke_sagemaker_endpoint(f"s3://{s3_bucket}/{param_file_uri}")
         event["transcription_output"] = response_location
+        # Identifies the completion notification of the endpoint
+        event["transcription_inference_id"] = inference_id
         event['transcription_complete'] = False
         event['transcription_retries'] = 0
+        event['transcription_started_at'] = started_at
+        event['transcription_wait_seconds'] = polling_backoff.next_wait_seconds(
+            task, event.get("audio_duration_seconds", 0), started_at, 0
+        )
+        event['transcription_notification_timeout_seconds'] = polling_backoff.notification_timeout_seconds(
+            task, event.get("audio_duration_seconds", 0)
+        )
         print(f"Started Transcription {key}")
 
         return {"event": event, "status": "SUCCEEDED"}
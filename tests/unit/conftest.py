@@ -0,0 +1,67 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  SPDX-License-Identifier: MIT-0
+
+import io
+import os
+import sys
+
+import pytest
+
+root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Lambda and container code imports its neighbours as top level modules, as it does once deployed
+for source_dir in ["server/lambdas", "server/containers/chunking", "ml_stack/transcription/src",
+                   "ml_stack/diarization/src"]:
+    sys.path.insert(0, os.path.join(root, source_dir))
+
+# Module level clients and settings read these when the modules are imported
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ.setdefault("AWS_REGION", "us-east-1")
+os.environ.setdefault("UploadsTable", "uploads")
+
+
+class FakeBody:
+    def __init__(self, data):
+        self.stream = io.BytesIO(data)
+
+    def read(self, amount=None):
+        return self.stream.read(amount)
+
+    def iter_lines(self):
+        return iter(self.stream.read().splitlines())
+
+
+class FakeS3:
+    """
+    In-memory stand in for the S3 client calls the Lambdas make, objects are keyed by bucket and key.
+    """
+
+    def __init__(self):
+        self.objects = dict()
+
+    def get_object(self, Bucket, Key, Range=None, **kwargs):
+        data = self.objects[(Bucket, Key)]
+        if Range:
+            start, end = Range[len("bytes="):].split("-")
+            data = data[int(start):int(end) + 1]
+        return {"Body": FakeBody(data), "ContentLength": len(data)}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.objects[(Bucket, Key)] = Body if isinstance(Body, bytes) else Body.encode("utf-8")
+        return {}
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        self.objects.pop((Bucket, Key), None)
+        return {}
+
+    def get_paginator(self, operation):
+        return self
+
+    def paginate(self, Bucket, Prefix=""):
+        keys = sorted(key for bucket, key in self.objects if bucket == Bucket and key.startswith(Prefix))
+        yield {"Contents": [{"Key": key} for key in keys]}
+
+
+@pytest.fixture
+def s3():
+    return FakeS3()
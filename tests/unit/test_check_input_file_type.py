@@ -0,0 +1,76 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  SPDX-License-Identifier: MIT-0
+
+import struct
+
+import pytest
+
+import check_input_file_type
+
+BUCKET = "bucket"
+KEY = "calls/call.mp3"
+# MPEG 1 layer III frame header at 128 kbps, 44.1 kHz
+MP3_FRAME = bytes([0xFF, 0xFB, 0x90, 0x64])
+
+
+@pytest.fixture
+def fake_s3(s3, monkeypatch):
+    monkeypatch.setattr(check_input_file_type, "s3_client", s3)
+    return s3
+
+
+def id3_tag(size):
+    synchsafe = bytes([(size >> 21) & 0x7F, (size >> 14) & 0x7F, (size >> 7) & 0x7F, size & 0x7F])
+    return b"ID3\x04\x00\x00" + synchsafe + bytes(size)
+
+
+def wav_header(channels, frame_rate):
+    return struct.pack("<4sI4s4sIHHIIHH4sI", b"RIFF", 36, b"WAVE", b"fmt ", 16, 1, channels, frame_rate,
+                       frame_rate * channels * 2, channels * 2, 16, b"data", 0)
+
+
+def test_wav_byte_rate():
+    assert check_input_file_type.wav_byte_rate(wav_header(1, 16000)) == 32000
+    assert check_input_file_type.wav_byte_rate(wav_header(2, 44100)) == 176400
+
+
+def test_wav_byte_rate_of_other_files():
+    assert check_input_file_type.wav_byte_rate(b"ID3" + bytes(64)) is None
+    assert check_input_file_type.wav_byte_rate(wav_header(1, 16000)[:20]) is None
+
+
+def test_mp3_byte_rate_without_tag(fake_s3):
+    assert check_input_file_type.mp3_byte_rate(BUCKET, KEY, MP3_FRAME + bytes(100)) == 16000
+
+
+def test_mp3_byte_rate_after_tag(fake_s3):
+    header = id3_tag(1000) + MP3_FRAME + bytes(100)
+    assert check_input_file_type.mp3_byte_rate(BUCKET, KEY, header) == 16000
+
+
+def test_mp3_byte_rate_after_tag_longer_than_header(fake_s3):
+    data = id3_tag(200 * 1024) + MP3_FRAME + bytes(100)
+    fake_s3.objects[(BUCKET, KEY)] = data
+    header = data[:check_input_file_type.header_scan_bytes]
+    assert check_input_file_type.mp3_byte_rate(BUCKET, KEY, header) == 16000
+
+
+def test_mp3_byte_rate_without_frame(fake_s3):
+    rate = check_input_file_type.mp3_byte_rate(BUCKET, KEY, bytes(1000))
+    assert rate == check_input_file_type.fallback_kbps * 1000 / 8
+
+
+def test_processing_mode(monkeypatch):
+    monkeypatch.setattr(check_input_file_type, "LAMBDA_MAX_CONTENT_LENGTH", 100 * 1024 * 1024)
+    monkeypatch.setattr(check_input_file_type, "LAMBDA_MAX_DURATION_SECONDS", 600)
+    assert check_input_file_type.processing_mode(10 * 1024 * 1024, 300) == "lambda"
+    assert check_input_file_type.processing_mode(10 * 1024 * 1024, 900) == "batch"
+    assert check_input_file_type.processing_mode(200 * 1024 * 1024, 300) == "batch"
+    assert check_input_file_type.processing_mode(10 * 1024 * 1024, None) == "batch"
+
+
+def test_processing_mode_disabled(monkeypatch):
+    # Lambda processing is off unless both limits are set
+    monkeypatch.setattr(check_input_file_type, "LAMBDA_MAX_CONTENT_LENGTH", 100 * 1024 * 1024)
+    monkeypatch.setattr(check_input_file_type, "LAMBDA_MAX_DURATION_SECONDS", 0)
+    assert check_input_file_type.processing_mode(1024, 10) == "batch"
@@ -0,0 +1,67 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  SPDX-License-Identifier: MIT-0
+
+import json
+
+import chunk_planner
+
+
+def test_parse_diarization_json_and_text():
+    document = json.dumps({"version": 1, "segments": [{"start": 0.497, "end": 1.4775, "speaker": "SPEAKER_00"}]})
+    text = "[ 00:00:00.497 -->  00:00:01.477] A SPEAKER_00\n"
+    assert chunk_planner.parse_diarization(document) == [(497, 1478, "SPEAKER_00")]
+    assert chunk_planner.parse_diarization(text) == [(497, 1477, "SPEAKER_00")]
+
+
+def test_group_turns_by_speaker():
+    lines = [(0, 1000, "A"), (1000, 2000, "A"), (2000, 3000, "B"), (3000, 4000, "A")]
+    assert chunk_planner.group_turns(lines) == [lines[:2], lines[2:3], lines[3:]]
+
+
+def test_short_turns_are_merged():
+    turns = [[(0, 2000, "A")], [(2500, 4000, "B")], [(4500, 6000, "A")]]
+    chunks = chunk_planner.plan_chunks(turns, min_seconds=8, max_seconds=30, max_gap_seconds=1.5)
+    assert chunks == [{"start": 0, "end": 6000, "turns": [[0, 0, 2000], [1, 2500, 4000], [2, 4500, 6000]]}]
+
+
+def test_turns_apart_are_not_merged():
+    turns = [[(0, 2000, "A")], [(10000, 12000, "B")]]
+    chunks = chunk_planner.plan_chunks(turns, min_seconds=8, max_seconds=30, max_gap_seconds=1.5)
+    assert [chunk["turns"] for chunk in chunks] == [[[0, 0, 2000]], [[1, 10000, 12000]]]
+
+
+def test_merging_disabled():
+    turns = [[(0, 2000, "A")], [(2500, 4000, "B")]]
+    chunks = chunk_planner.plan_chunks(turns, min_seconds=0, max_seconds=30, max_gap_seconds=1.5)
+    assert len(chunks) == 2
+
+
+def test_long_turn_is_split_at_line_starts():
+    turn = [(0, 20000, "A"), (21000, 40000, "A")]
+    assert chunk_planner.split_turn(turn, 30000) == [(0, 21000), (21000, 40000)]
+
+
+def test_long_line_is_split_into_equal_pieces():
+    assert chunk_planner.split_turn([(0, 90000, "A")], 30000) == [(0, 30000), (30000, 60000), (60000, 90000)]
+
+
+def test_split_turn_skips_pauses_without_speech():
+    turn = [(0, 10000, "A"), (50000, 60000, "A")]
+    assert chunk_planner.split_turn(turn, 30000) == [(0, 10000), (50000, 60000)]
+
+
+def test_split_pieces_all_hold_speech():
+    turn = [(0, 5000, "A"), (40000, 45000, "A"), (100000, 130000, "A")]
+    chunks = chunk_planner.plan_chunks([turn], min_seconds=8, max_seconds=30, max_gap_seconds=1.5)
+    for chunk in chunks:
+        assert any(start < chunk["end"] and end > chunk["start"] for start, end, _ in turn)
+    assert [(chunk["start"], chunk["end"]) for chunk in chunks] == [(0, 5000), (40000, 45000), (100000, 130000)]
+
+
+def test_segment_index_columns():
+    turns = [[(0, 2000, "SPEAKER_01")], [(2500, 4000, "SPEAKER_00")], [(4500, 6000, "SPEAKER_01")]]
+    chunks = chunk_planner.single_turn_chunks(turns)
+    index = chunk_planner.segment_index(turns, chunks)
+    assert index["speakers"] == ["SPEAKER_01", "SPEAKER_00"]
+    assert index["turns"] == {"start_ms": [0, 2500, 4500], "end_ms": [2000, 4000, 6000], "speaker": [0, 1, 0]}
+    assert index["chunks"]["turns"] == [[[0, 0, 2000]], [[1, 2500, 4000]], [[2, 4500, 6000]]]
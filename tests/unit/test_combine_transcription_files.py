@@ -0,0 +1,71 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  SPDX-License-Identifier: MIT-0
+
+import json
+
+import pytest
+
+import combine_transcription_files
+import segment_index
+
+BUCKET = "bucket"
+OUTPUT_KEY = "output/call"
+CHUNKS_KEY = "output/call/txt_chunks/"
+
+
+@pytest.fixture
+def fake_s3(s3, monkeypatch):
+    monkeypatch.setattr(combine_transcription_files, "s3_client", s3)
+    return s3
+
+
+def write_index(s3, turns, chunks):
+    index = {
+        "version": segment_index.SEGMENT_INDEX_VERSION,
+        "speakers": ["SPEAKER_00", "SPEAKER_01"],
+        "turns": {
+            "start_ms": [start for start, _, _ in turns],
+            "end_ms": [end for _, end, _ in turns],
+            "speaker": [speaker for _, _, speaker in turns],
+        },
+        "chunks": {
+            "start_ms": [chunk[0][1] for chunk in chunks],
+            "end_ms": [chunk[-1][2] for chunk in chunks],
+            "turns": chunks,
+        },
+    }
+    s3.objects[(BUCKET, f"{OUTPUT_KEY}/segment_index.json")] = json.dumps(index).encode("utf-8")
+
+
+def write_packed(s3, records):
+    body = "".join(json.dumps(record) + "\n" for record in records)
+    s3.objects[(BUCKET, f"{CHUNKS_KEY}chunks.original.jsonl")] = body.encode("utf-8")
+
+
+def combine(s3):
+    combine_transcription_files.combine_txt_transcriptions("call.original.txt", "segment_index.json", CHUNKS_KEY,
+                                                           "original", BUCKET, OUTPUT_KEY, "jsonl")
+    return s3.objects[(BUCKET, f"{OUTPUT_KEY}/call.original.txt")].decode("utf-8")
+
+
+def test_packed_transcript_without_record_for_a_turn(fake_s3):
+    write_index(fake_s3, [(0, 3000, 0), (4000, 8000, 1), (9000, 12000, 0)],
+                [[[0, 0, 3000]], [[1, 4000, 8000]], [[2, 9000, 12000]]])
+    # The second chunk had no speech and was not decoded
+    write_packed(fake_s3, [
+        {"gidx": 0, "text": " Hello.", "segments": [{"start": 0.0, "end": 2.5, "text": " Hello."}]},
+        {"gidx": 2, "text": " Bye.", "segments": [{"start": 0.0, "end": 2.0, "text": " Bye."}]},
+    ])
+    assert combine(fake_s3) == "Agent: Hello.\nAgent: Bye.\n"
+
+
+def test_merged_chunk_gives_text_to_both_turns(fake_s3):
+    write_index(fake_s3, [(0, 3000, 0), (3500, 7000, 1)], [[[0, 0, 3000], [1, 3500, 7000]]])
+    write_packed(fake_s3, [{
+        "gidx": 0,
+        "text": " How can I help? My order is late.",
+        "segments": [{"start": 0.1, "end": 2.8, "text": " How can I help?"},
+                     {"start": 3.6, "end": 6.9, "text": " My order is late."}],
+    }])
+    # Turn texts start with a space like the per chunk text files, whose Whisper text starts with one too
+    assert combine(fake_s3) == "Agent:  How can I help?\nCustomer:  My order is late.\n"
@@ -0,0 +1,134 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  SPDX-License-Identifier: MIT-0
+
+import io
+import json
+import tarfile
+
+import pytest
+
+import comprehend_aggregator
+import start_comprehension
+
+BUCKET = "bucket"
+
+
+class FakeSqs:
+    def __init__(self, bodies):
+        self.messages = [{"Body": json.dumps(body), "ReceiptHandle": str(i)} for i, body in enumerate(bodies)]
+        self.deleted = []
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages, **kwargs):
+        received, self.messages = self.messages[:MaxNumberOfMessages], self.messages[MaxNumberOfMessages:]
+        return {"Messages": received}
+
+    def delete_message_batch(self, QueueUrl, Entries):
+        self.deleted.extend(entry["ReceiptHandle"] for entry in Entries)
+
+
+class FakeStepFunctions:
+    def __init__(self):
+        self.succeeded = dict()
+        self.failed = dict()
+
+    def send_task_success(self, taskToken, output):
+        self.succeeded[taskToken] = json.loads(output)
+
+    def send_task_failure(self, taskToken, error, cause):
+        self.failed[taskToken] = error
+
+
+@pytest.fixture
+def aggregator(s3, monkeypatch):
+    step_functions = FakeStepFunctions()
+    monkeypatch.setattr(comprehend_aggregator, "s3_client", s3)
+    monkeypatch.setattr(start_comprehension, "s3_client", s3)
+    monkeypatch.setattr(comprehend_aggregator, "step_function_client", step_functions)
+    monkeypatch.setattr(comprehend_aggregator, "BUCKET", BUCKET)
+    started = []
+    for detect in ["detect_sentiment", "detect_entities"]:
+        monkeypatch.setattr(start_comprehension, detect,
+                            lambda language, role, s3_uri, output_uri, detect=detect:
+                            started.append((detect, s3_uri)) or {"JobId": f"{detect}-job"})
+    return step_functions, started
+
+
+def conversation_request(s3, name, lines):
+    event = {"bucket": BUCKET, "output_s3_key": f"output/{name}", "original_transcription_file": f"{name}.txt"}
+    s3.objects[(BUCKET, f"output/{name}/{name}.txt")] = "".join(line + "\n" for line in lines).encode("utf-8")
+    return {"task_token": f"token-{name}", "event": event}
+
+
+def read_output(s3, key):
+    with tarfile.open(fileobj=io.BytesIO(s3.objects[(BUCKET, key)]), mode="r:gz") as tar:
+        return [json.loads(line) for line in tar.extractfile("output")]
+
+
+def test_split_job_output():
+    conversations = [
+        {"first_line": 0, "line_count": 2, "event": {"original_transcription_file": "a.txt"}},
+        {"first_line": 2, "line_count": 3, "event": {"original_transcription_file": "b.txt"}},
+    ]
+    records = [{"Line": line} for line in [4, 0, 2, 1, 3, 7]]
+    split = comprehend_aggregator.split_job_output(records, conversations)
+    assert split == [
+        [{"Line": 0, "File": "a.txt"}, {"Line": 1, "File": "a.txt"}],
+        [{"Line": 2, "File": "b.txt"}, {"Line": 0, "File": "b.txt"}, {"Line": 1, "File": "b.txt"}],
+    ]
+
+
+def test_receive_requests_drops_duplicates(monkeypatch):
+    request = {"task_token": "token-a", "event": {}}
+    sqs = FakeSqs([request, request, {"task_token": "token-b", "event": {}}])
+    monkeypatch.setattr(comprehend_aggregator, "sqs_client", sqs)
+    messages = comprehend_aggregator.receive_requests()
+    assert [message["request"]["task_token"] for message in messages] == ["token-a", "token-b"]
+    assert sqs.deleted == ["1"]
+
+
+def test_batch_round_trip(s3, aggregator, monkeypatch):
+    step_functions, started = aggregator
+    sqs = FakeSqs([conversation_request(s3, "a", ["Agent: Hi", "Customer: Hello"]),
+                   conversation_request(s3, "b", ["Agent: Bye"])])
+    monkeypatch.setattr(comprehend_aggregator, "sqs_client", sqs)
+
+    batch_id = comprehend_aggregator.submit_batch(comprehend_aggregator.receive_requests())
+    batch_key = f"comprehend_batches/{batch_id}"
+    assert s3.objects[(BUCKET, f"{batch_key}/input/transcripts.txt")] == b"Agent: Hi\nCustomer: Hello\nAgent: Bye\n"
+    assert [detect for detect, _ in started] == ["detect_sentiment", "detect_entities"]
+    assert sorted(sqs.deleted) == ["0", "1"]
+
+    manifest = json.loads(s3.objects[(BUCKET, f"{batch_key}/manifest.json")])
+    assert [(c["first_line"], c["line_count"]) for c in manifest["conversations"]] == [(0, 2), (2, 1)]
+
+    # Output of both jobs over the combined file
+    start_comprehension.write_job_output(BUCKET, "jobs/sentiment.tar.gz",
+                                         [{"Line": line, "Sentiment": "NEUTRAL"} for line in range(3)])
+    start_comprehension.write_job_output(BUCKET, "jobs/entities.tar.gz",
+                                         [{"Line": line, "Entities": []} for line in range(3)])
+    comprehend_aggregator.complete_batch(manifest, f"s3://{BUCKET}/jobs/sentiment.tar.gz",
+                                         f"s3://{BUCKET}/jobs/entities.tar.gz")
+
+    assert set(step_functions.succeeded) == {"token-a", "token-b"}
+    event_b = step_functions.succeeded["token-b"]["event"]
+    assert event_b["sentiment_job_status"] and event_b["entities_job_status"]
+    assert read_output(s3, event_b["sentiment_job_output_file"]) == [
+        {"Line": 0, "Sentiment": "NEUTRAL", "File": "b.txt"}]
+    assert [record["Line"] for record in read_output(s3, "output/a/sentiment/output.tar.gz")] == [0, 1]
+
+
+def test_missing_transcript_fails_its_conversation(s3, aggregator, monkeypatch):
+    step_functions, started = aggregator
+    missing = {"task_token": "token-missing",
+               "event": {"bucket": BUCKET, "output_s3_key": "output/missing", "original_transcription_file": "m.txt"}}
+    sqs = FakeSqs([])
+    monkeypatch.setattr(comprehend_aggregator, "sqs_client", sqs)
+
+    def read_transcript_lines(event):
+        raise comprehend_aggregator.ClientError({"Error": {"Code": "NoSuchKey"}}, "GetObject")
+
+    monkeypatch.setattr(comprehend_aggregator, "read_transcript_lines", read_transcript_lines)
+    comprehend_aggregator.submit_batch([{"request": missing, "ReceiptHandle": "0"}])
+    assert step_functions.failed == {"token-missing": "TranscriptNotFound"}
+    assert started == []
+    assert sqs.deleted == ["0"]
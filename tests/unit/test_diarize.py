@@ -0,0 +1,47 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  SPDX-License-Identifier: MIT-0
+
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("pyannote.audio")
+
+import diarize
+
+
+class FlakyPipeline:
+    def __init__(self, failures):
+        self.failures = failures
+        self.calls = 0
+
+    def from_pretrained(self, *args, **kwargs):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise OSError("model download failed")
+        return self
+
+    def to(self, device):
+        return self
+
+
+@pytest.fixture
+def service(monkeypatch):
+    monkeypatch.setattr(diarize.DiarizationService, "pipeline", None)
+    monkeypatch.setattr(diarize.time, "sleep", lambda seconds: None)
+    return diarize.DiarizationService
+
+
+def test_load_retries_after_failure(monkeypatch, service):
+    pipeline = FlakyPipeline(failures=2)
+    monkeypatch.setattr(diarize, "Pipeline", pipeline)
+    assert service.load_with_retries()
+    assert service.is_ready()
+    assert pipeline.calls == 3
+
+
+def test_load_gives_up_after_all_attempts(monkeypatch, service):
+    pipeline = FlakyPipeline(failures=diarize.warm_up_attempts)
+    monkeypatch.setattr(diarize, "Pipeline", pipeline)
+    assert not service.load_with_retries()
+    assert not service.is_ready()
+    assert pipeline.calls == diarize.warm_up_attempts
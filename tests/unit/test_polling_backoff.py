@@ -0,0 +1,100 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  SPDX-License-Identifier: MIT-0
+
+import pytest
+
+import polling_backoff
+
+
+@pytest.fixture(autouse=True)
+def default_rates(monkeypatch):
+    # No stats table, every stage runs at its default rate
+    monkeypatch.setattr(polling_backoff, "stats_table", None)
+
+
+def test_notification_timeout_follows_call_length():
+    # 15 seconds overhead plus 0.1 seconds per second of audio, twice over
+    assert polling_backoff.notification_timeout_seconds("diarize", 1800) == 2 * (15 + 180)
+
+
+def test_notification_timeout_bounds():
+    assert polling_backoff.notification_timeout_seconds("diarize", 30) == \
+        polling_backoff.notification_min_timeout_seconds
+    assert polling_backoff.notification_timeout_seconds("diarize", 0) == \
+        polling_backoff.notification_min_timeout_seconds
+    assert polling_backoff.notification_timeout_seconds("transcribe", 10 * 3600) == \
+        polling_backoff.notification_max_timeout_seconds
+
+
+class FakeStatsTable:
+    def __init__(self):
+        self.items = dict()
+
+    def get_item(self, Key):
+        item = self.items.get(Key["stage"])
+        return {"Item": item} if item else {}
+
+    def put_item(self, Item):
+        self.items[Item["stage"]] = Item
+
+
+@pytest.fixture
+def now(monkeypatch):
+    now = 1_000_000.0
+    monkeypatch.setattr(polling_backoff.time, "time", lambda: now)
+    return now
+
+
+def test_first_check_when_result_is_expected(now):
+    # 15 seconds overhead plus 0.1 seconds per second of audio
+    assert polling_backoff.next_wait_seconds("diarize", 1800, now, 0) == 195
+    assert polling_backoff.next_wait_seconds("diarize", 1800, now - 100, 1) == 95
+
+
+def test_wait_grows_with_retries_once_overdue(now):
+    started_at = now - 1000
+    waits = [polling_backoff.next_wait_seconds("diarize", 60, started_at, retries) for retries in range(12)]
+    assert waits[0] == polling_backoff.min_wait_seconds
+    assert waits == sorted(waits)
+    assert waits[-1] == polling_backoff.max_wait_seconds
+
+
+def test_last_wait_ends_at_give_up_time(now):
+    started_at = now - polling_backoff.max_elapsed_seconds + 100
+    assert polling_backoff.next_wait_seconds("diarize", 60, started_at, 30) == 100
+
+
+def test_gave_up_after_max_elapsed_time(now):
+    assert not polling_backoff.gave_up("diarize", 60, now - polling_backoff.max_elapsed_seconds + 1)
+    assert polling_backoff.gave_up("diarize", 60, now - polling_backoff.max_elapsed_seconds - 1)
+
+
+def test_long_calls_get_longer_to_finish(now):
+    # Three times the expected 15 + 0.15 * 36000 seconds of a ten hour call
+    started_at = now - polling_backoff.max_elapsed_seconds - 1
+    assert not polling_backoff.gave_up("transcribe", 36000, started_at)
+    assert polling_backoff.gave_up("transcribe", 36000, now - 3 * (15 + 0.15 * 36000) - 1)
+
+
+def test_polling_stops_within_max_elapsed_time(now, monkeypatch):
+    # Checking as the workflow does, the give up time is reached without an overshoot of the longest wait
+    started_at = now
+    elapsed, retries = 0, 0
+    while not polling_backoff.gave_up("diarize", 60, started_at):
+        wait = polling_backoff.next_wait_seconds("diarize", 60, started_at, retries)
+        elapsed += wait
+        retries += 1
+        monkeypatch.setattr(polling_backoff.time, "time", lambda: started_at + elapsed)
+    assert polling_backoff.max_elapsed_seconds < elapsed <= polling_backoff.max_elapsed_seconds + \
+        polling_backoff.min_wait_seconds
+    assert retries < 30
+
+
+def test_record_completion_updates_running_average(monkeypatch):
+    table = FakeStatsTable()
+    monkeypatch.setattr(polling_backoff, "stats_table", table)
+    polling_backoff.record_completion("diarize", 1000, 200)
+    # 0.8 of the default 0.1 plus 0.2 of the observed 0.2 seconds per second of audio
+    assert polling_backoff.seconds_per_unit("diarize") == pytest.approx(0.12)
+    polling_backoff.record_completion("diarize", 0, 200)
+    assert polling_backoff.seconds_per_unit("diarize") == pytest.approx(0.12)
@@ -0,0 +1,101 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  SPDX-License-Identifier: MIT-0
+
+import io
+import json
+import tarfile
+
+import pytest
+
+import post_processor
+
+BUCKET = "bucket"
+
+
+def job_output(records, members=1):
+    # Tarball like the Comprehend job output, the records spread over the given number of members
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w:gz") as tar:
+        for m in range(members):
+            data = "".join(json.dumps(record) + "\n" for record in records[m::members]).encode("utf-8")
+            member = tarfile.TarInfo(f"output-{m}")
+            member.size = len(data)
+            tar.addfile(member, io.BytesIO(data))
+    return buffer.getvalue()
+
+
+class UnseekableBody:
+    def __init__(self, data):
+        self.stream = io.BytesIO(data)
+
+    def read(self, amount=None):
+        return self.stream.read(amount)
+
+
+def line_records(records, members=1):
+    return post_processor.LineRecords(post_processor.read_job_records(UnseekableBody(job_output(records, members))))
+
+
+def test_records_in_line_order():
+    records = line_records([{"Line": line} for line in range(5)])
+    assert [records.get(line) for line in range(5)] == [{"Line": line} for line in range(5)]
+    assert records.ahead == {}
+
+
+def test_records_out_of_order_are_kept():
+    records = line_records([{"Line": line} for line in [3, 1, 0, 4, 2]])
+    assert [records.get(line) for line in range(5)] == [{"Line": line} for line in range(5)]
+
+
+def test_records_across_members():
+    records = line_records([{"Line": line} for line in range(6)], members=3)
+    assert [records.get(line) for line in range(6)] == [{"Line": line} for line in range(6)]
+
+
+def test_lines_without_record():
+    records = line_records([{"Line": 2}, {"Line": 0}])
+    assert [records.get(line) for line in range(4)] == [{"Line": 0}, {}, {"Line": 2}, {}]
+
+
+class FakeTable:
+    def get_item(self, **kwargs):
+        return {}
+
+
+@pytest.fixture
+def fake_s3(s3, monkeypatch):
+    monkeypatch.setattr(post_processor, "s3_client", s3)
+    monkeypatch.setattr(post_processor, "table", FakeTable())
+    return s3
+
+
+def test_handler_merges_out_of_order_job_output(fake_s3):
+    fake_s3.objects[(BUCKET, "output/chat/chat.original.txt")] = \
+        "Agent: Hello, how can I help?\nCustomer: My order is late.\nAgent: Sorry about that.\n".encode("utf-8")
+    sentiment = [{"Line": line, "Sentiment": sentiment, "SentimentScore": {"Positive": 0.5}}
+                 for line, sentiment in [(2, "NEUTRAL"), (0, "POSITIVE"), (1, "NEGATIVE")]]
+    entities = [{"Line": 1, "Entities": [{"Type": "OTHER", "Text": "order"}]}, {"Line": 0, "Entities": []}]
+    fake_s3.objects[(BUCKET, "output/chat/sentiment/output.tar.gz")] = job_output(sentiment)
+    fake_s3.objects[(BUCKET, "output/chat/entities/output.tar.gz")] = job_output(entities)
+    event = {
+        "bucket": BUCKET, "key": "calls/chat.txt", "content_type": "text/plain", "output_s3_key": "output/chat",
+        "input_file": "chat", "segment_index": "segment_index.json", "diarization_file": "chat.diarization.txt",
+        "original_transcription_file": "chat.original.txt",
+        "sentiment_job_output_file": "output/chat/sentiment/output.tar.gz",
+        "entities_job_output_file": "output/chat/entities/output.tar.gz",
+        "dominant_language_code": "en", "dominant_language": "English", "Summarization": "", "ActionItems": "",
+        "Topic": "", "Politeness": "", "Callback": "", "Product": "", "Resolution": "", "AgentSentiment": "",
+        "CustomerSentiment": "",
+    }
+
+    result = post_processor.handler({"event": event}, None)
+
+    assert result["event"]["processed_file"] == "output/chat/chat.json"
+    transcript = json.loads(fake_s3.objects[(BUCKET, "output/chat/chat.json")])
+    segments = transcript["SpeechSegments"]
+    assert [segment["BaseSentiment"] for segment in segments] == ["POSITIVE", "NEGATIVE", "NEUTRAL"]
+    assert [len(segment["EntitiesDetected"]) for segment in segments] == [0, 1, 0]
+    assert [record["Line"] for record in json.loads(fake_s3.objects[(BUCKET, "output/chat/sentiment.json")])] == \
+        [0, 1, 2]
+    assert transcript["ConversationAnalytics"]["CustomEntities"] == [
+        {"Name": "OTHER", "Values": ["order"], "Instances": 1}]
@@ -0,0 +1,163 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  SPDX-License-Identifier: MIT-0
+
+import json
+
+import summarize
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def bucket(monkeypatch, rate_per_minute):
+    clock = FakeClock()
+    monkeypatch.setattr(summarize.time, "monotonic", clock.monotonic)
+    monkeypatch.setattr(summarize.time, "sleep", clock.sleep)
+    return summarize.TokenBucket(rate_per_minute), clock
+
+
+def test_token_bucket_starts_full(monkeypatch):
+    limiter, clock = bucket(monkeypatch, 60)
+    for _ in range(60):
+        limiter.acquire()
+    assert clock.sleeps == []
+
+
+def test_token_bucket_waits_for_refill(monkeypatch):
+    limiter, clock = bucket(monkeypatch, 60)
+    limiter.acquire(60)
+    limiter.acquire(30)
+    # 60 per minute refills one token per second
+    assert clock.sleeps == [30.0]
+    assert limiter.tokens == 0
+
+
+def test_token_bucket_caps_requests_to_capacity(monkeypatch):
+    limiter, clock = bucket(monkeypatch, 10)
+    limiter.acquire(1000)
+    assert clock.sleeps == []
+    assert limiter.tokens == 0
+
+
+def test_token_bucket_disabled(monkeypatch):
+    limiter, clock = bucket(monkeypatch, 0)
+    for _ in range(1000):
+        limiter.acquire(1000)
+    assert clock.sleeps == []
+
+
+def test_failed_prompts_leave_their_field_unset(monkeypatch):
+    prompts = [("summary_prompt", "Summarization", None), ("topic_prompt", "Topic", None),
+               ("missing_prompt", "Product", None), ("agent_prompt", "AgentSentiment", summarize.first_label)]
+    templates = {"summary_prompt": "summary", "topic_prompt": "topic", "agent_prompt": "agent"}
+
+    def generate_bedrock_query(prompt, transcript, question, max_tokens=None):
+        if prompt == "topic":
+            raise RuntimeError("model error")
+        return {"summary": "A short call.", "agent": "Positive, the agent was helpful."}[prompt]
+
+    monkeypatch.setattr(summarize, "get_prompt_templates", lambda names: templates)
+    monkeypatch.setattr(summarize, "generate_bedrock_query", generate_bedrock_query)
+    results = summarize.run_analysis_prompts("Agent: Hi", prompts)
+    assert results == {"Summarization": "A short call.", "AgentSentiment": "Positive"}
+
+
+ALL_INSIGHTS = {
+    "Summarization": "The customer asked about a late order.",
+    "ActionItems": "The agent checked the order.",
+    "Topic": "order delay",
+    "Politeness": "yes",
+    "Callback": "no",
+    "Product": "mobile phone",
+    "Resolution": "yes",
+    "AgentSentiment": "Positive",
+    "CustomerSentiment": "Neutral",
+}
+
+
+class FakeBedrock:
+    """
+    Stands in for call_bedrock. The combined prompt is answered from the queued answers in turn, every individual
+    prompt with the text of its field.
+    """
+
+    def __init__(self, monkeypatch, combined_answers):
+        self.combined_answers = list(combined_answers)
+        self.combined_questions = []
+        self.individual_prompts = []
+        templates = {prompt_name: f"individual:{field}" for prompt_name, field, _ in summarize.ANALYSIS_PROMPTS}
+        templates[summarize.SSM_LLM_COMBINED_PROMPT] = "combined:{question}"
+        monkeypatch.setattr(summarize, "get_prompt_templates",
+                            lambda names: {name: templates[name] for name in names})
+        monkeypatch.setattr(summarize, "call_bedrock", self.call_bedrock)
+
+    def call_bedrock(self, parameters, prompt, max_tokens=None):
+        if prompt.startswith("combined:"):
+            self.combined_questions.append(prompt[len("combined:"):])
+            return self.combined_answers.pop(0)
+        field = prompt[len("individual:"):]
+        self.individual_prompts.append(field)
+        return f"individual {field}, details"
+
+
+def test_combined_prompt_answer(monkeypatch):
+    bedrock = FakeBedrock(monkeypatch, ["Here are the insights:\n" + json.dumps(ALL_INSIGHTS)])
+    results = summarize.run_combined_prompt("Agent: Hi")
+    assert results == ALL_INSIGHTS
+    assert len(bedrock.combined_questions) == 1
+    assert bedrock.individual_prompts == []
+
+
+def test_combined_prompt_asks_again_for_missing_fields(monkeypatch):
+    first = {field: value for field, value in ALL_INSIGHTS.items() if field not in ("Topic", "CustomerSentiment")}
+    # An unknown sentiment label is malformed too
+    first["AgentSentiment"] = "Cheerful"
+    second = {"Topic": "order delay", "AgentSentiment": "Positive, helpful", "CustomerSentiment": "Neutral"}
+    bedrock = FakeBedrock(monkeypatch, [json.dumps(first), json.dumps(second)])
+
+    results = summarize.run_combined_prompt("Agent: Hi")
+
+    assert results == ALL_INSIGHTS
+    assert len(bedrock.combined_questions) == 2
+    asked_again = bedrock.combined_questions[1]
+    assert all(f'"{field}"' in asked_again for field in ("Topic", "AgentSentiment", "CustomerSentiment"))
+    assert '"Summarization"' not in asked_again
+    assert bedrock.individual_prompts == []
+
+
+def test_combined_prompt_falls_back_to_individual_prompts(monkeypatch):
+    answers = ["I could not produce JSON for this call."] * (summarize.COMBINED_MAX_REPAIRS + 1)
+    bedrock = FakeBedrock(monkeypatch, answers)
+
+    results = summarize.run_combined_prompt("Agent: Hi")
+
+    assert len(bedrock.combined_questions) == summarize.COMBINED_MAX_REPAIRS + 1
+    assert sorted(bedrock.individual_prompts) == sorted(ALL_INSIGHTS)
+    assert results["Topic"] == "individual Topic, details"
+    assert results["AgentSentiment"] == "individual AgentSentiment"
+
+
+def test_combined_prompt_falls_back_for_fields_still_missing(monkeypatch):
+    partial = {field: value for field, value in ALL_INSIGHTS.items() if field != "Product"}
+    bedrock = FakeBedrock(monkeypatch, [json.dumps(partial)] * (summarize.COMBINED_MAX_REPAIRS + 1))
+
+    results = summarize.run_combined_prompt("Agent: Hi")
+
+    assert bedrock.individual_prompts == ["Product"]
+    assert results == dict(ALL_INSIGHTS, Product="individual Product, details")
+
+
+def test_parse_insights_joins_lists_and_drops_empty_fields():
+    text = 'Answer: {"ActionItems": ["Checked the order", "Sent an email"], "Topic": " ", "Callback": 3}'
+    insights = summarize.parse_insights(text, ["ActionItems", "Topic", "Callback"])
+    assert insights == {"ActionItems": "Checked the order\nSent an email"}
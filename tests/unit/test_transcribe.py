@@ -0,0 +1,164 @@
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#  SPDX-License-Identifier: MIT-0
+
+import json
+import threading
+
+import numpy as np
+import pytest
+
+pytest.importorskip("faster_whisper")
+pytest.importorskip("flask")
+
+import transcribe
+
+TranslateService = transcribe.TranslateService
+
+
+def chunk(seconds, value):
+    return np.full(int(seconds * transcribe.sampling_rate), value, dtype=np.float32)
+
+
+def test_decode_buffered_detects_language_per_chunk(monkeypatch):
+    # The fill value of a chunk stands for its language
+    languages = {0.1: "en", 0.2: "es"}
+    batch_calls = []
+
+    def decode_batch(audios, whisper_task, language=None):
+        batch_calls.append((whisper_task, language, len(audios)))
+        return [(f"{whisper_task}:{language}", []) for _ in audios]
+
+    monkeypatch.setattr(TranslateService, "detect_language", lambda audio: languages[round(float(audio[0]), 1)])
+    monkeypatch.setattr(TranslateService, "decode_batch", decode_batch)
+
+    batch = [("0.wav", chunk(2, 0.1)), ("1.wav", chunk(3, 0.2)), ("2.wav", chunk(4, 0.1))]
+    outputs = TranslateService.decode_buffered(batch, ["translate", "transcribe"])
+
+    assert [voice_file for voice_file, _ in outputs] == ["0.wav", "1.wav", "2.wav"]
+    assert [[text for text, _ in texts] for _, texts in outputs] == [
+        ["translate:en", "transcribe:en"],
+        ["translate:es", "transcribe:es"],
+        ["translate:en", "transcribe:en"],
+    ]
+    # One batched call per language and task
+    assert sorted(batch_calls) == [("transcribe", "en", 2), ("transcribe", "es", 1),
+                                   ("translate", "en", 2), ("translate", "es", 1)]
+
+
+def test_packed_records_hold_their_own_text(monkeypatch, tmp_path):
+    def decode_files(voice_files, whisper_tasks, vad_stats=None):
+        for voice_file in voice_files:
+            yield voice_file, [(f" {whisper_task} text", [transcribe.timed_segment(0.0, 1.0, f" {whisper_task} text")])
+                               for whisper_task in whisper_tasks]
+
+    monkeypatch.setattr(TranslateService, "decode_files", decode_files)
+    monkeypatch.setattr(transcribe, "nfs_path", str(tmp_path) + "/")
+    written = []
+    TranslateService.transcribe(["3.wav"], "translate_transcribe", "s3://bucket/chunks/", written.append, "jsonl")
+
+    records = dict()
+    for out_file in written:
+        with open(out_file) as f:
+            records[out_file.rsplit("/", 1)[-1]] = [json.loads(line) for line in f]
+    for name, expected in [("chunks.translated.jsonl", " translate text"), ("chunks.original.jsonl", " transcribe text")]:
+        record, = records[name]
+        assert record["gidx"] == 3
+        assert record["text"].strip() == expected.strip()
+        assert record["text"].strip() == "".join(segment["text"] for segment in record["segments"]).strip()
+
+
+class Segment:
+    def __init__(self, start, end, text):
+        self.start, self.end, self.text = start, end, text
+
+
+class WindowedBatchedModel:
+    """
+    Groups the clips into windows with the pipeline's own collect_chunks and answers every window with two
+    timed segments, one per turn of a 4 second chunk.
+    """
+
+    def __init__(self):
+        self.kwargs = None
+        self.windows = None
+
+    def transcribe(self, audio, **kwargs):
+        from faster_whisper.vad import collect_chunks
+
+        self.kwargs = kwargs
+        clips = [{key: int(value * transcribe.sampling_rate) for key, value in clip.items()}
+                 for clip in kwargs["clip_timestamps"]]
+        _, self.windows = collect_chunks(audio, clips, max_duration=kwargs["chunk_length"])
+        segments = []
+        for window in self.windows:
+            segments.append(Segment(window["offset"], window["offset"] + 1.5, " Hello there."))
+            segments.append(Segment(window["offset"] + 2.5, window["offset"] + 4.0, " Hi, my order is late."))
+        return iter(segments), None
+
+
+def test_batched_chunks_are_decoded_in_their_own_window(monkeypatch):
+    model = WindowedBatchedModel()
+    monkeypatch.setattr(TranslateService, "batched_model", model)
+    audios = [chunk(4, 0.0), chunk(6, 0.0), chunk(transcribe.batch_max_chunk_seconds, 0.0)]
+    results = TranslateService.decode_batch(audios, "transcribe", "en")
+
+    # Short chunks of different turns would fit in one window together, the padding keeps them apart
+    assert [(window["offset"], window["duration"]) for window in model.windows] == [
+        (i * transcribe.batch_max_chunk_seconds, transcribe.batch_max_chunk_seconds) for i in range(len(audios))]
+    for (text, segments), audio in zip(results, audios):
+        assert text == " Hello there. Hi, my order is late."
+        assert [segment["start"] for segment in segments] == [0.0, 2.5]
+        assert segments[-1]["end"] <= len(audio) / transcribe.sampling_rate
+
+
+def test_merged_chunk_keeps_text_of_both_turns(monkeypatch):
+    import combine_transcription_files
+
+    model = WindowedBatchedModel()
+    monkeypatch.setattr(TranslateService, "batched_model", model)
+    (text, segments), = TranslateService.decode_batch([chunk(4, 0.0)], "transcribe", "en")
+    assert model.kwargs["without_timestamps"] is False
+
+    # The chunk covers an agent turn from 0 to 2 seconds and a customer turn from 2 to 4 seconds
+    chunks = [{"start_ms": 0, "end_ms": 4000, "turns": [[0, 0, 2000], [1, 2000, 4000]]}]
+    records = {0: {"gidx": 0, "text": text, "segments": segments}}
+    captions = combine_transcription_files.packed_turn_captions(records, chunks)
+    assert "".join(captions[0]).strip() == "Hello there."
+    assert "".join(captions[1]).strip() == "Hi, my order is late."
+
+
+def test_downloads_are_yielded_while_listing_continues(monkeypatch, tmp_path):
+    first_file_yielded = threading.Event()
+    listed_after_first_file = []
+
+    def list_s3_objects(bucket_name, key_prefix):
+        yield {"Key": "chunks/0.wav"}
+        yield {"Key": "chunks/"}
+        # The next page is only listed once the first download reached the consumer
+        listed_after_first_file.append(first_file_yielded.wait(timeout=5))
+        yield {"Key": "chunks/1.wav"}
+
+    monkeypatch.setattr(transcribe, "list_s3_objects", list_s3_objects)
+    monkeypatch.setattr(transcribe, "download_s3_object",
+                        lambda bucket_name, key, local_file_path, stats=None: local_file_path)
+
+    downloaded = []
+    for local_file in transcribe.download_s3_bucket_from_uri("s3://bucket/chunks/", str(tmp_path)):
+        downloaded.append(local_file)
+        first_file_yielded.set()
+
+    assert listed_after_first_file == [True]
+    assert downloaded == [str(tmp_path / "0.wav"), str(tmp_path / "1.wav")]
+
+
+def test_listing_errors_reach_the_consumer(monkeypatch, tmp_path):
+    def list_s3_objects(bucket_name, key_prefix):
+        yield {"Key": "chunks/0.wav"}
+        raise RuntimeError("AccessDenied")
+
+    monkeypatch.setattr(transcribe, "list_s3_objects", list_s3_objects)
+    monkeypatch.setattr(transcribe, "download_s3_object",
+                        lambda bucket_name, key, local_file_path, stats=None: local_file_path)
+
+    with pytest.raises(RuntimeError, match="AccessDenied"):
+        list(transcribe.download_s3_bucket_from_uri("s3://bucket/chunks/", str(tmp_path)))